@@ -0,0 +1,447 @@
+"""Headless HTTP API for the ChemViz pipeline
+
+Serves the ``ChemVizService`` steps as JSON endpoints for scripts and
+pipelines, without the Streamlit page:
+
+    GET /resolve?q=caffeine                   resolved record
+    GET /conformer?q=caffeine&format=sdf      3D structure as SDF or XYZ text
+    GET /properties?q=caffeine                descriptor values
+    GET /viewer?q=caffeine&style=stick        3Dmol.js viewer document
+    GET /health                               limits, queue depths, rejections and coalescing
+    GET /metrics                              Prometheus text (``telemetry``)
+
+Every endpoint also takes POST with the same parameters as a JSON object.
+
+The server is a stdlib ``ThreadingHTTPServer``. At most
+CHEMVIZ_API_CONCURRENCY requests are handled at once and up to
+CHEMVIZ_API_QUEUE more wait for a slot; anything beyond that, or waiting
+longer than CHEMVIZ_API_QUEUE_TIMEOUT seconds, gets ``503`` with
+``Retry-After`` straight away, so a burst cannot pile up unbounded work.
+
+3D embedding is CPU-bound, so it runs on a bounded pool of
+CHEMVIZ_API_WORKERS spawned processes, one single-threaded embedding each,
+behind its own limit of two queued embeddings per worker. Stored conformers
+are answered from the conformer store without touching the pool, and
+resolutions and properties (computed from the 2D molecule) never wait for it.
+
+Usage:
+    python api.py serve --port 8600
+    python api.py load http://localhost:8600 --endpoint conformer --concurrency 16 --duration 30
+"""
+import argparse
+import contextlib
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from dotenv import load_dotenv
+from rdkit import Chem
+
+from cache import ResolutionCache
+from conformers import ConformerStore, build_3d_molecule, canonical_smiles, embedding_key, mol_from_coordinates
+from service import ChemVizService
+from singleflight import flights
+from telemetry import metrics, span
+from viewer import MOLECULE_STYLES
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8600
+FORMATS = ('sdf', 'xyz')
+# Seconds a client may take to send its request before the connection is dropped
+REQUEST_TIMEOUT = 30
+
+
+class Overloaded(Exception):
+    """No capacity left for a request; answered with 503"""
+
+
+class HTTPError(Exception):
+    """Error answered with an HTTP status and a JSON message"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Limiter:
+    """At most ``limit`` concurrent holders; ``queue`` more may wait up to ``timeout`` seconds"""
+
+    def __init__(self, limit, queue, timeout):
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self._slots = threading.Semaphore(limit)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold a slot for the block; raises Overloaded when the queue is full or the wait times out"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.waiting >= self.queue:
+                    self.rejected += 1
+                    raise Overloaded("queue full")
+                self.waiting += 1
+            try:
+                admitted = self._slots.acquire(timeout=self.timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+            if not admitted:
+                with self._lock:
+                    self.rejected += 1
+                raise Overloaded(f"no slot within {self.timeout:g}s")
+        with self._lock:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {'limit': self.limit, 'queue': self.queue, 'active': self.active,
+                    'waiting': self.waiting, 'rejected': self.rejected}
+
+
+_worker_store = None
+
+
+def _init_worker():
+    global _worker_store
+    _worker_store = ConformerStore()
+
+
+def _embed(smiles):
+    # Runs in a pool process; the molecule is rebuilt in the server from coordinates
+    mol = build_3d_molecule(smiles, store=_worker_store, threads=1)
+    if mol is None:
+        return None, None
+    return mol.GetConformer().GetPositions(), mol.GetProp('embedding')
+
+
+def _setting(name, default, kind=int):
+    return kind(os.getenv(name, default))
+
+
+class ChemVizAPI:
+    """The service steps behind the HTTP endpoints, with admission and embedding limits"""
+
+    def __init__(self, service=None, workers=None, concurrency=None, queue=None, queue_timeout=None):
+        self.service = service or ChemVizService(
+            cache=ResolutionCache(),
+            conformer_store=ConformerStore(),
+            # Parallelism comes from the embedding pool and concurrent requests
+            embed_threads=1
+        )
+        self.workers = workers or _setting('CHEMVIZ_API_WORKERS', 0) or os.cpu_count() or 1
+        queue_timeout = queue_timeout or _setting('CHEMVIZ_API_QUEUE_TIMEOUT', 10, float)
+        self.requests = Limiter(concurrency or _setting('CHEMVIZ_API_CONCURRENCY', 16),
+                                _setting('CHEMVIZ_API_QUEUE', 64) if queue is None else queue, queue_timeout)
+        self.embeddings = Limiter(self.workers, 2 * self.workers, queue_timeout)
+        self._pool_lock = threading.Lock()
+        self._pool = None
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
+
+    def _get_pool(self):
+        # Spawned rather than forked: the server is threaded
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_init_worker)
+            return self._pool
+
+    def _discard_pool(self, pool):
+        # A crashed worker breaks the whole pool; the next embedding starts a new one
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def resolve(self, query):
+        record = self.service.parse_chemical_input(query)
+        if not record or not record.get('smiles'):
+            raise HTTPError(404, f"could not resolve {query!r}")
+        return record
+
+    def structure(self, smiles):
+        """3D molecule for a SMILES: stored coordinates if any, else embedded on the pool"""
+        canonical = canonical_smiles(smiles)
+        if canonical is None:
+            raise HTTPError(422, f"not a valid SMILES: {smiles!r}")
+        store = self.service.conformer_store
+        if store is not None:
+            with span('conformer_store') as stage:
+                mol = store.get(canonical)
+                stage.set(cache_hit=mol is not None)
+            if mol is not None:
+                return mol
+        # Identical requests wait for one embedding without taking pool slots
+        mol = flights.do(embedding_key(canonical), lambda: self._embed(canonical), share=Chem.Mol)
+        if mol is None:
+            raise HTTPError(422, f"could not generate a 3D structure for {canonical}")
+        return mol
+
+    def _embed(self, canonical):
+        with self.embeddings.slot(), span('api.embed') as stage:
+            pool = self._get_pool()
+            try:
+                positions, embedding = pool.submit(_embed, canonical).result()
+            except BrokenProcessPool:
+                self._discard_pool(pool)
+                raise
+            stage.set(path=embedding)
+        return mol_from_coordinates(canonical, positions, embedding) if positions is not None else None
+
+    def properties(self, query):
+        record = self.resolve(query)
+        # Descriptors need no coordinates, so this never waits for an embedding
+        mol = self.service.create_molecule_2d(record['smiles'])
+        return {'smiles': record['smiles'], 'properties': self.service.get_molecule_properties(mol)}
+
+    def conformer(self, query, format='sdf'):
+        if format not in FORMATS:
+            raise HTTPError(400, f"format must be one of {', '.join(FORMATS)}")
+        record = self.resolve(query)
+        mol = self.structure(record['smiles'])
+        text = Chem.MolToMolBlock(mol) + '$$$$\n' if format == 'sdf' else Chem.MolToXYZBlock(mol)
+        return {'smiles': record['smiles'], 'embedding': mol.GetProp('embedding'), 'format': format,
+                'structure': text}
+
+    def viewer(self, query, style='ball_and_stick', spin=True, width=800, height=600):
+        if style not in MOLECULE_STYLES:
+            raise HTTPError(400, f"style must be one of {', '.join(MOLECULE_STYLES)}")
+        record = self.resolve(query)
+        mol = self.structure(record['smiles'])
+        html = self.service.visualize_molecule_3d(mol, width=width, height=height, style=style, spin=spin)
+        return {'smiles': record['smiles'], 'embedding': mol.GetProp('embedding'), 'html': html}
+
+    def health(self):
+        return {'status': 'ok', 'workers': self.workers,
+                'requests': self.requests.stats(), 'embeddings': self.embeddings.stats(),
+                'coalescing': flights.stats()}
+
+
+def _flag(value):
+    return str(value).lower() not in ('0', 'false', 'no', 'off')
+
+
+def _size(value, name):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        raise HTTPError(400, f"{name} must be an integer")
+    if not 50 <= size <= 4000:
+        raise HTTPError(400, f"{name} must be between 50 and 4000")
+    return size
+
+
+def _query(params):
+    query = str(params.get('q') or '').strip()
+    if not query:
+        raise HTTPError(400, "missing parameter q")
+    return query
+
+
+# Endpoint name -> handler taking (api, params); all admitted through the request limiter
+ROUTES = {
+    'resolve': lambda api, params: api.resolve(_query(params)),
+    'properties': lambda api, params: api.properties(_query(params)),
+    'conformer': lambda api, params: api.conformer(_query(params), str(params.get('format', 'sdf')).lower()),
+    'viewer': lambda api, params: api.viewer(
+        _query(params), str(params.get('style', 'ball_and_stick')), _flag(params.get('spin', True)),
+        _size(params.get('width', 800), 'width'), _size(params.get('height', 600), 'height')),
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = REQUEST_TIMEOUT
+    # Headers and body are separate writes; without this keep-alive clients wait out delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self._dispatch(url.path.strip('/'), {k: v[-1] for k, v in parse_qs(url.query).items()})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            params = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(params, dict):
+                raise ValueError
+        except ValueError:
+            self._send(400, {'error': "body must be a JSON object"})
+            return
+        self._dispatch(url.path.strip('/'), params)
+
+    def _dispatch(self, endpoint, params):
+        api = self.server.api
+        if endpoint == 'health':
+            self._send(200, api.health())
+            return
+        if endpoint == 'metrics':
+            self._send(200, metrics.to_prometheus().encode(), 'text/plain; version=0.0.4')
+            return
+        route = ROUTES.get(endpoint)
+        if route is None:
+            self._send(404, {'error': f"no endpoint /{endpoint}"})
+            return
+        try:
+            with api.requests.slot(), span(f'api.{endpoint}'):
+                status, body = 200, route(api, params)
+        except HTTPError as e:
+            status, body = e.status, {'error': str(e)}
+        except Overloaded as e:
+            status, body = 503, {'error': f"server busy: {e}"}
+        except Exception as e:
+            logger.exception("%s failed", self.path)
+            status, body = 500, {'error': str(e)}
+        metrics.increment('chemviz_api_requests_total', endpoint=endpoint, status=str(status))
+        self._send(status, body)
+
+    def _send(self, status, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if status == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+
+class APIServer(ThreadingHTTPServer):
+    """Threaded HTTP server for a ``ChemVizAPI``"""
+
+    daemon_threads = True
+    # Listen backlog; admission control happens once a request is read
+    request_queue_size = 128
+
+    def __init__(self, address, api):
+        super().__init__(address, _Handler)
+        self.api = api
+
+
+def load_test(url, queries, endpoint='resolve', concurrency=8, duration=10.0, params=None):
+    """Drive an endpoint from ``concurrency`` keep-alive clients for ``duration`` seconds
+
+    Each client cycles through ``queries``. Returns request counts by status,
+    throughput and latency percentiles over the completed requests.
+    """
+    target = urlsplit(url)
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(offset):
+        connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=120)
+        count = offset
+        try:
+            while time.monotonic() < deadline:
+                query = {'q': queries[count % len(queries)], **(params or {})}
+                body = json.dumps(query)
+                started = time.perf_counter()
+                try:
+                    connection.request('POST', f'/{endpoint}', body, {'Content-Type': 'application/json'})
+                    response = connection.getresponse()
+                    response.read()
+                    status = str(response.status)
+                except (OSError, http.client.HTTPException) as e:
+                    status = type(e).__name__
+                    connection.close()
+                elapsed = time.perf_counter() - started
+                with lock:
+                    statuses[status] = statuses.get(status, 0) + 1
+                    if status == '200':
+                        latencies.append(elapsed)
+                count += 1
+        finally:
+            connection.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+
+    def percentile(q):
+        return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 1) if latencies else None
+
+    return {'endpoint': endpoint, 'concurrency': concurrency, 'seconds': round(elapsed, 2),
+            'requests': sum(statuses.values()), 'statuses': statuses,
+            'ok_per_second': round(len(latencies) / elapsed, 1),
+            'p50_ms': percentile(0.5), 'p95_ms': percentile(0.95), 'p99_ms': percentile(0.99)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the ChemViz pipeline over HTTP, or load-test a server")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help="Run the API server")
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=DEFAULT_PORT)
+    serve.add_argument('--workers', type=int, help="Embedding processes (default: CHEMVIZ_API_WORKERS or CPU count)")
+    serve.add_argument('--concurrency', type=int, help="Requests handled at once (default: CHEMVIZ_API_CONCURRENCY)")
+    load = commands.add_parser('load', help="Measure throughput and latency of a running server")
+    load.add_argument('url')
+    load.add_argument('--endpoint', default='resolve', choices=sorted(ROUTES))
+    load.add_argument('--concurrency', type=int, default=8, help="Concurrent keep-alive clients")
+    load.add_argument('--duration', type=float, default=10.0, help="Seconds to run")
+    load.add_argument('--corpus', help="CSV with a smiles column to cycle through (default: the benchmark corpus)")
+    load.add_argument('--tier', action='append', help="Only corpus rows of these tiers (repeatable)")
+    args = parser.parse_args(argv)
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    if args.command == 'load':
+        from benchmark import DEFAULT_CORPUS, read_corpus
+
+        rows = [row for row in read_corpus(args.corpus or DEFAULT_CORPUS) if not args.tier or row['tier'] in args.tier]
+        result = load_test(args.url, [row['smiles'] for row in rows], args.endpoint, args.concurrency, args.duration)
+        print(json.dumps(result, indent=2))
+        return 0
+
+    api = ChemVizAPI(workers=args.workers, concurrency=args.concurrency)
+    server = APIServer((args.host, args.port), api)
+    logger.info("Serving on http://%s:%d with %d embedding workers", args.host, args.port, api.workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        api.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,19 +1,25 @@
-import streamlit as st
-import openai
-import os
-from dotenv import load_dotenv
-import py3Dmol
-from rdkit import Chem
-from rdkit.Chem import AllChem, Descriptors, rdMolDescriptors
-import pandas as pd
-import numpy as np
-import json
-import requests
-import pubchempy as pcp
-import plotly.graph_objects as go
-from streamlit_option_menu import option_menu
 import time
+
+# Script runs are timed from here, imports included, for the first-paint metric
+RUN_STARTED = time.perf_counter()
+
+import base64
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import wait
+
+import streamlit as st
 import streamlit.components.v1 as components
+from dotenv import load_dotenv
+
+# Only light modules at the top: RDKit, OpenAI, pandas and pyarrow are
+# imported by the functions that need them, so a cold process paints the
+# page before paying for them
+from telemetry import metrics, span, trace
+
+STYLESHEET_URL = "app/static/chemviz.css"
 
 # Load environment variables
 load_dotenv()
@@ -26,472 +32,766 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-st.markdown("""
-<style>
-    @import url('https://fonts.googleapis.com/css2?family=SF+Pro+Display:wght@300;400;500;600;700&display=swap');
-    
-    .stApp {
-        background: linear-gradient(135deg, #0a0a0a 0%, #1a1a1a 25%, #2d2d2d 50%, #1a1a1a 75%, #0a0a0a 100%);
-        font-family: 'SF Pro Display', -apple-system, BlinkMacSystemFont, sans-serif;
-        color: #ffffff;
-        min-height: 100vh;
-    }
-    
-    /* Hide Streamlit branding */
-    #MainMenu {visibility: hidden;}
-    footer {visibility: hidden;}
-    header {visibility: hidden;}
-    
-    /* Main container */
-    .main .block-container {
-        padding-top: 2rem;
-        padding-bottom: 2rem;
-        max-width: 1200px;
-    }
-    
-    /* Hero Section - Dark Premium Style */
-    .hero-section {
-        text-align: center;
-        padding: 4rem 0 3rem 0;
-        background: rgba(255, 255, 255, 0.03);
-        backdrop-filter: blur(20px);
-        border-radius: 24px;
-        margin-bottom: 3rem;
-        border: 1px solid rgba(255, 255, 255, 0.1);
-        box-shadow: 0 8px 32px rgba(0, 0, 0, 0.4), inset 0 1px 0 rgba(255, 255, 255, 0.1);
-    }
-    
-    .main-title {
-        font-size: 4.5rem;
-        font-weight: 700;
-        background: linear-gradient(135deg, #ffffff 0%, #a0a0a0 100%);
-        -webkit-background-clip: text;
-        -webkit-text-fill-color: transparent;
-        background-clip: text;
-        margin-bottom: 0.5rem;
-        letter-spacing: -0.02em;
-        line-height: 1.1;
-        text-shadow: 0 0 30px rgba(255, 255, 255, 0.3);
-    }
-    
-    .main-subtitle {
-        font-size: 1.5rem;
-        font-weight: 400;
-        color: #b0b0b0;
-        margin-bottom: 2rem;
-        letter-spacing: -0.01em;
-    }
-    
-    .tagline {
-        font-size: 1.1rem;
-        color: #888888;
-        font-weight: 400;
-        max-width: 600px;
-        margin: 0 auto;
-        line-height: 1.5;
-    }
-    
-    /* Input Section - Dark Premium Style */
-    .input-section {
-        background: rgba(255, 255, 255, 0.05);
-        backdrop-filter: blur(20px);
-        border-radius: 20px;
-        padding: 2.5rem;
-        margin: 2rem 0;
-        border: 1px solid rgba(255, 255, 255, 0.15);
-        box-shadow: 0 8px 32px rgba(0, 0, 0, 0.6), inset 0 1px 0 rgba(255, 255, 255, 0.1);
-    }
-    
-    /* Custom input styling */
-    .stTextInput > div > div > input {
-        background: rgba(255, 255, 255, 0.08) !important;
-        border: 2px solid rgba(255, 255, 255, 0.2) !important;
-        border-radius: 12px !important;
-        padding: 1rem 1.5rem !important;
-        font-size: 1.1rem !important;
-        font-weight: 400 !important;
-        color: #ffffff !important;
-        transition: all 0.3s ease !important;
-        box-shadow: 0 4px 12px rgba(0, 0, 0, 0.3) !important;
-    }
-    
-    .stTextInput > div > div > input:focus {
-        border-color: #0a84ff !important;
-        box-shadow: 0 0 0 4px rgba(10, 132, 255, 0.3), 0 4px 12px rgba(0, 0, 0, 0.3) !important;
-        outline: none !important;
-        background: rgba(255, 255, 255, 0.12) !important;
-    }
-    
-    .stTextInput > div > div > input::placeholder {
-        color: #888888 !important;
-    }
-    
-    /* Premium Dark Button */
-    .stButton > button {
-        background: linear-gradient(135deg, #0a84ff 0%, #007aff 100%);
-        color: white;
-        border: none;
-        border-radius: 12px;
-        padding: 1rem 2rem;
-        font-size: 1.1rem;
-        font-weight: 600;
-        letter-spacing: -0.01em;
-        transition: all 0.3s ease;
-        width: 100%;
-        box-shadow: 0 8px 24px rgba(10, 132, 255, 0.4), inset 0 1px 0 rgba(255, 255, 255, 0.2);
-        border: 1px solid rgba(255, 255, 255, 0.1);
-    }
-    
-    .stButton > button:hover {
-        background: linear-gradient(135deg, #0056cc 0%, #0040a0 100%);
-        transform: translateY(-2px);
-        box-shadow: 0 12px 32px rgba(10, 132, 255, 0.5), inset 0 1px 0 rgba(255, 255, 255, 0.3);
-    }
-    
-    .stButton > button:active {
-        transform: translateY(-1px);
-        box-shadow: 0 6px 16px rgba(10, 132, 255, 0.4), inset 0 1px 0 rgba(255, 255, 255, 0.2);
-    }
-    
-    /* Content cards - Dark Glass morphism */
-    .content-card {
-        background: rgba(255, 255, 255, 0.06);
-        backdrop-filter: blur(20px);
-        border-radius: 20px;
-        padding: 2rem;
-        margin: 1.5rem 0;
-        border: 1px solid rgba(255, 255, 255, 0.15);
-        box-shadow: 0 8px 32px rgba(0, 0, 0, 0.6), inset 0 1px 0 rgba(255, 255, 255, 0.1);
-    }
-    
-    /* Visualization container */
-    .viz-container {
-        background: rgba(255, 255, 255, 0.08);
-        backdrop-filter: blur(20px);
-        border-radius: 20px;
-        padding: 2rem;
-        margin: 2rem 0;
-        border: 1px solid rgba(255, 255, 255, 0.2);
-        box-shadow: 0 12px 40px rgba(0, 0, 0, 0.8), inset 0 1px 0 rgba(255, 255, 255, 0.15);
-        text-align: center;
-    }
-    
-    /* Sidebar styling */
-    .css-1d391kg {
-        background: rgba(0, 0, 0, 0.4) !important;
-        backdrop-filter: blur(20px);
-        border-right: 1px solid rgba(255, 255, 255, 0.1);
-    }
-    
-    /* Metrics styling */
-    .metric-container {
-        background: rgba(255, 255, 255, 0.08);
-        backdrop-filter: blur(10px);
-        border-radius: 16px;
-        padding: 1.5rem;
-        margin: 0.5rem;
-        border: 1px solid rgba(255, 255, 255, 0.15);
-        text-align: center;
-        transition: all 0.3s ease;
-        box-shadow: 0 4px 12px rgba(0, 0, 0, 0.4), inset 0 1px 0 rgba(255, 255, 255, 0.1);
-    }
-    
-    .metric-container:hover {
-        transform: translateY(-2px);
-        box-shadow: 0 8px 25px rgba(0, 0, 0, 0.6), inset 0 1px 0 rgba(255, 255, 255, 0.15);
-        background: rgba(255, 255, 255, 0.12);
-    }
-    
-    /* Typography improvements */
-    h1, h2, h3 {
-        color: #ffffff;
-        font-weight: 600;
-        letter-spacing: -0.02em;
-    }
-    
-    p {
-        color: #b0b0b0;
-        line-height: 1.6;
-    }
+# The theme is a static file: the browser caches it instead of every rerun resending it
+st.markdown(f'<link rel="stylesheet" href="{STYLESHEET_URL}">', unsafe_allow_html=True)
+
+# Display labels for the resolver tier that answered a query
+RESOLVER_SOURCES = {
+    'rdkit': 'RDKit (SMILES/InChI)',
+    'local': 'Local compound table',
+    'dictionary': 'Offline compound dictionary',
+    'pubchem': 'PubChem',
+    'llm': 'OpenAI',
+}
+
+# Results kept per session for the history
+HISTORY_SIZE = 8
+
+# Viewer style choices, by label, as viewer.MOLECULE_STYLES names
+VIEWER_STYLES = {
+    'Ball & stick': 'ball_and_stick',
+    'Sticks': 'stick',
+    'Space-filling': 'spacefill',
+}
+
+EMBEDDING_NOTES = {
+    'random_coords': "Structure embedded from random coordinates; geometry may be less refined",
+    '2d': "3D embedding ran out of time; showing a flat 2D layout",
+}
+
+@st.cache_resource
+def get_resolution_cache():
+    """Process-wide resolution cache shared by every session"""
+    from cache import ResolutionCache
+    return ResolutionCache()
+
+@st.cache_resource
+def get_conformer_store():
+    """Process-wide 3D conformer store shared by every session"""
+    from conformers import ConformerStore
+    return ConformerStore()
+
+@st.cache_resource
+def get_embedding_jobs():
+    """Background 3D builds shared by every session"""
+    from conformers import EmbeddingJobs
+    return EmbeddingJobs(store=get_conformer_store())
+
+@st.cache_resource
+def get_suggestion_index():
+    """Process-wide typeahead index over known names and past queries"""
+    from compound_dictionary import get_dictionary
+    from suggest import SuggestionIndex
+    return SuggestionIndex.from_sources(cache=get_resolution_cache(), dictionary=get_dictionary())
+
+def report_error(message):
+    """Show an error in whichever session's script run is calling"""
+    st.error(message)
+
+@st.cache_resource
+def get_service():
+    """Process-wide service shared by every session, with its clients
+
+    Built on first use rather than at startup: constructing it imports RDKit
+    and OpenAI. Errors go to the calling session through ``report_error``.
+    """
+    with span('startup.service'):
+        from service import ChemVizService
+        return ChemVizService(
+            cache=get_resolution_cache(),
+            conformer_store=get_conformer_store(),
+            report_error=report_error
+        )
+
+def record_first_paint():
+    """Time from the start of the script run until the input form has been sent"""
+    metrics.observe('chemviz_stage_seconds', time.perf_counter() - RUN_STARTED, stage='first_paint')
+
+def pick_suggestion(name):
+    """Button callback: put the suggestion in the input and visualize it"""
+    st.session_state.molecule_input = name
+    st.session_state.picked_suggestion = name
+
+def render_suggestions(user_input):
+    """Completions and did-you-mean buttons for the current input"""
+    if not user_input or len(user_input) < 2:
+        return
+    index = get_suggestion_index()
+    suggestions = [s for s in index.suggest(user_input) if s['name'] != user_input.strip().casefold()]
+    if not suggestions:
+        return
+    typo = index.did_you_mean(user_input)
+    label = f"Did you mean <strong style=\"color: #ffffff;\">{typo}</strong>?" if typo else "Suggestions"
+    st.markdown(f'''<p style="color: #888888; font-size: 0.85rem; margin: 0.5rem 0;">{label}</p>''', unsafe_allow_html=True)
+    cols = st.columns(len(suggestions))
+    for col, suggestion in zip(cols, suggestions):
+        with col:
+            st.button(suggestion['name'], key=f"suggestion-{suggestion['name']}",
+                      on_click=pick_suggestion, args=(suggestion['name'],))
+
+def result_key(smiles, smarts=None):
+    """History key of a molecule: its canonical SMILES, plus any highlighted pattern"""
+    return f"{smiles}|{smarts or ''}"
+
+def input_key(user_input, smarts=None):
+    """Key of a query before it is resolved: the input as typed, case kept (SMILES is case-sensitive)"""
+    return f"{user_input.strip()}|{smarts or ''}"
+
+def get_history():
+    """This session's recent results by key, least recently shown first"""
+    if 'history' not in st.session_state:
+        st.session_state.history = OrderedDict()
+    return st.session_state.history
+
+def get_history_inputs():
+    """Result keys of the queries that produced this session's results, by input key"""
+    if 'history_inputs' not in st.session_state:
+        st.session_state.history_inputs = {}
+    return st.session_state.history_inputs
+
+def abandon_build(result):
+    """Stop waiting for a result's 3D build; it is resubmitted if shown again"""
+    job = result.get('job')
+    if job is not None and not job.done():
+        get_embedding_jobs().cancel(job)
+        result['job'] = None
+
+def show_result(key):
+    """Make a stored result the current one (None shows nothing)"""
+    history = get_history()
+    previous = history.get(st.session_state.get('current_result'))
+    if previous is not None and previous['key'] != key:
+        abandon_build(previous)
+    if key is not None:
+        history.move_to_end(key)
+    st.session_state.current_result = key
+
+def remember_result(result, query=None):
+    """Add a result to the bounded history and show it; ``query`` is the input key that asked for it"""
+    history = get_history()
+    # Shown after the new job was submitted, so resubmitting a molecule reuses its job
+    history[result['key']] = result
+    show_result(result['key'])
+    while len(history) > HISTORY_SIZE:
+        _, dropped = history.popitem(last=False)
+        abandon_build(dropped)
+    inputs = get_history_inputs()
+    if query is not None:
+        inputs[query] = result['key']
+    for stale in [q for q, key in inputs.items() if key not in history]:
+        del inputs[stale]
+
+def build_result(service, user_input, picked, smarts=None):
+    """Resolve and profile a molecule, or None if the input cannot be resolved
+
+    Everything the result view shows is computed here once and kept in the
+    session, except the 3D structure, which builds in the background. A
+    molecule already in the history, asked for by another name, is returned
+    as it is.
+    """
+    from cache import canonical_keys
+    from descriptors import format_properties
+    from similarity import get_similarity_index
+    from substructure import match_atoms
+    
+    # Resolve input, falling back to PubChem and OpenAI only when needed
+    if picked == user_input:
+        parsed_data = service.resolve_locally(user_input)
+    else:
+        parsed_data = service.parse_chemical_input(user_input)
+    if not parsed_data or not parsed_data.get('smiles'):
+        return None
     
-    /* Loading spinner */
-    .stSpinner > div {
-        border-color: #0a84ff transparent transparent transparent;
+    smiles = parsed_data['smiles']
+    key = result_key(canonical_keys(smiles)[0] or smiles, smarts)
+    if key in get_history():
+        return get_history()[key]
+    # Only names: the index casefolds, and SMILES or InChI would come back as another molecule
+    if parsed_data.get('source') != 'rdkit':
+        get_suggestion_index().add(user_input)
+    get_similarity_index().add(smiles, parsed_data.get('common_name'))
+    result = {
+        'key': key,
+        'label': parsed_data.get('common_name') or user_input,
+        'record': parsed_data,
+        'smarts': smarts,
+        'svg': None,
+        'job': None,
+        'mol': None,
+        'failed': False,
+        'viewers': {},
+        'ensemble': None,
     }
+    mol_2d = service.create_molecule_2d(smiles)
+    if mol_2d is None:
+        result['failed'] = True
+        return result
+    
+    # Everything that needs only the 2D structure is ready right away;
+    # the 3D conformer is built in the background and swapped in
+    result['job'] = get_embedding_jobs().submit(smiles)
+    result['svg'] = service.depict_molecule_2d(mol_2d, highlight=smarts and match_atoms(mol_2d, smarts))
+    result['descriptors'] = service.get_molecule_properties(mol_2d)
+    result['properties'] = format_properties(result['descriptors'])
+    started = time.time()
+    result['similar'] = service.find_similar(smiles)
+    result['similar_note'] = f"Morgan fingerprint Tanimoto over {len(get_similarity_index()):,} compounds · {(time.time() - started) * 1000:.0f} ms"
+    return result
+
+def render_similar(result):
+    """Nearest neighbours from the fingerprint library; a click visualizes one"""
+    hits = result['similar']
+    if not hits:
+        return
+    st.markdown(f"""
+    <div class="content-card" style="margin-top: 3rem;">
+        <h3 style="margin-bottom: 0.5rem; color: #ffffff; font-size: 1.5rem;">Similar Molecules</h3>
+        <p style="color: #888888; font-size: 0.85rem; margin: 0;">{result['similar_note']}</p>
+    </div>
+    """, unsafe_allow_html=True)
+    for i in range(0, len(hits), 4):
+        cols = st.columns(4, gap="medium")
+        for col, hit in zip(cols, hits[i:i+4]):
+            with col:
+                label = hit['name'] or hit['smiles']
+                st.button(f"{label} · {hit['similarity']:.2f}", key=f"similar-{hit['smiles']}",
+                          on_click=pick_suggestion, args=(hit['smiles'],), help=hit['smiles'])
+
+def pick_match(smiles, smarts):
+    """Button callback: visualize a substructure hit with its match highlighted"""
+    pick_suggestion(smiles)
+    st.session_state.highlight = {'smiles': smiles, 'smarts': smarts}
+
+def turn_page(step):
+    """Button callback: move through substructure search results"""
+    st.session_state.substructure_page = max(0, st.session_state.get('substructure_page', 0) + step)
+
+def render_substructure_mode():
+    """Find library compounds containing a SMARTS pattern, a page at a time"""
+    with st.expander("🔎 Substructure search — find compounds containing a SMARTS pattern"):
+        smarts = st.text_input(
+            "SMARTS pattern",
+            placeholder="e.g. c1ccccc1C(=O)[OH], [NX3][CX3](=O)",
+            help="Searches the similarity library; the matching atoms are highlighted"
+        )
+        if not smarts:
+            return
+        from substructure import SubstructureSearch, get_substructure_index
+        service = get_service()
+        
+        # A new pattern starts a new search; paging reuses the running one
+        search = st.session_state.get('substructure')
+        if search is None or search.smarts != smarts:
+            try:
+                search = SubstructureSearch(get_substructure_index(), smarts)
+            except ValueError as e:
+                st.error(f"❌ {e}")
+                return
+            st.session_state.substructure = search
+            st.session_state.substructure_page = 0
+        page = st.session_state.get('substructure_page', 0)
+        
+        started = time.time()
+        try:
+            hits = search.page(page)
+        except ValueError as e:
+            st.error(f"❌ {e}")
+            return
+        found = f"{len(search.hits):,}" if search.done else f"{len(search.hits):,}+"
+        st.markdown(f'''<p style="color: #888888; font-size: 0.85rem;">{found} matches · {search.stats['candidates']:,} fingerprint-screen survivors checked of {search.stats['screened']:,} compounds · page {page + 1} in {(time.time() - started) * 1000:.0f} ms</p>''', unsafe_allow_html=True)
+        
+        for i in range(0, len(hits), 4):
+            cols = st.columns(4, gap="medium")
+            for col, hit in zip(cols, hits[i:i+4]):
+                with col:
+                    svg = service.depict_molecule_2d(service.create_molecule_2d(hit['smiles']), width=220, height=160, highlight=hit['atoms'])
+                    if svg:
+                        st.markdown(f'''<img src="data:image/svg+xml;base64,{base64.b64encode(svg.encode()).decode()}" style="max-width: 100%;"/>''', unsafe_allow_html=True)
+                    st.button(hit['name'] or hit['smiles'], key=f"match-{hit['index']}",
+                              on_click=pick_match, args=(hit['smiles'], smarts), help=hit['smiles'])
+        
+        previous_col, _, next_col = st.columns([1, 4, 1])
+        with previous_col:
+            st.button("← Previous", key="substructure-previous", disabled=page == 0,
+                      on_click=turn_page, args=(-1,))
+        with next_col:
+            st.button("Next →", key="substructure-next", disabled=not search.has_page(page + 1),
+                      on_click=turn_page, args=(1,))
+
+def render_structure_3d(result, slot):
+    """Wait for a result's background 3D build, then put the viewer in its slot
+
+    Streamlit stops a run at its next element update when a new query comes
+    in, so polling here never holds up the next submission.
+    """
+    if result['mol'] is None and not result['failed']:
+        job = result['job']
+        if job is None:
+            # Abandoned while another molecule was shown; a finished build is a store hit
+            job = result['job'] = get_embedding_jobs().submit(result['record']['smiles'])
+        started = time.time()
+        while not job.done():
+            slot.markdown(f'''<p style="color: #888888; text-align: center;">🏗️ Building 3D structure... {time.time() - started:.0f}s</p>''', unsafe_allow_html=True)
+            wait([job], timeout=0.25)
+        try:
+            mol = job.result()
+        except Exception as e:
+            report_error(f"Error creating molecule: {str(e)}")
+            mol = None
+        result['job'] = None
+        result['mol'] = mol
+        result['failed'] = mol is None
+        if mol is not None:
+            save_molecule(result)
+    if result['failed']:
+        slot.error("❌ Could not generate 3D structure for this molecule.")
+        return
+    with slot.container():
+        render_viewer(result)
+
+def save_molecule(result):
+    """Keep a built molecule in the persistent molecule store"""
+    from molecule_store import get_molecule_store
+    try:
+        with span('molecule_store.add'):
+            get_molecule_store().add(result['record'], result['mol'], result['descriptors'])
+    except Exception:
+        # Losing the saved copy must not lose the result on screen
+        logging.getLogger(__name__).exception("Could not save %s to the molecule store", result['label'])
+
+@st.fragment
+def render_viewer(result):
+    """3D viewer and its display options; changing an option reruns only this fragment"""
+    mol = result['mol']
+    # Say so when the embedding budget forced a fallback
+    embedding = mol.GetProp('embedding') if mol.HasProp('embedding') else 'etkdg'
+    if embedding in EMBEDDING_NOTES:
+        st.markdown(f'''<p style="color: #ff9500; font-size: 0.85rem; text-align: center;">{EMBEDDING_NOTES[embedding]}</p>''', unsafe_allow_html=True)
+    
+    col1, col2, col3 = st.columns([3, 1, 2])
+    with col1:
+        style = st.radio("Style", list(VIEWER_STYLES), horizontal=True, key="viewer_style",
+                         label_visibility="collapsed")
+    with col2:
+        spin = st.toggle("Spin", value=True, key="viewer_spin")
+    with col3:
+        show_ensemble = st.toggle("Conformer ensemble", value=False, key="viewer_ensemble",
+                                  help="Sample, cluster and animate low-energy conformers")
+    
+    # Each combination of options is rendered once per result
+    options = (VIEWER_STYLES[style], spin)
+    if options not in result['viewers']:
+        atoms = None
+        if result['smarts']:
+            from substructure import match_atoms
+            atoms = match_atoms(mol, result['smarts'])
+        result['viewers'][options] = get_service().visualize_molecule_3d(
+            mol, width=900, height=600, highlight=atoms, style=options[0], spin=spin)
+    components.html(result['viewers'][options], height=600, width=900)
+    if show_ensemble:
+        render_ensemble(result)
+
+def render_ensemble(result):
+    """Play the low-energy conformer ensemble of a result as an animation"""
+    if result['ensemble'] is None:
+        from ensembles import build_ensemble
+        from trajectories import Trajectory
+        with st.spinner("🎞️ Sampling conformers..."):
+            ensemble = build_ensemble(result['record']['smiles'])
+        result['ensemble'] = False
+        if ensemble is not None:
+            html_viewer = get_service().visualize_trajectory(Trajectory.from_molecule(ensemble), width=900, height=600,
+                                                             interval=800)
+            result['ensemble'] = (html_viewer, f"{ensemble.GetNumConformers()} distinct conformers · lowest energy first · {ensemble.GetDoubleProp('seconds'):.1f}s")
+    if not result['ensemble']:
+        st.error("❌ Could not generate a conformer ensemble within the time budget.")
+        return
+    
+    html_viewer, caption = result['ensemble']
+    st.markdown(f'''<p style="color: #888888; font-size: 0.85rem; text-align: center;">{caption}</p>''', unsafe_allow_html=True)
+    components.html(html_viewer, height=600, width=900)
+
+def render_history(slot):
+    """Recent molecules of this session; a click shows one again without recomputing it"""
+    history = get_history()
+    if not history:
+        return
+    current = st.session_state.get('current_result')
+    with slot.container():
+        st.markdown('''<h3 style="margin: 2rem 0 1rem 0; color: #ffffff; font-size: 1.2rem; font-weight: 600;">Recent Molecules</h3>''', unsafe_allow_html=True)
+        for key, result in reversed(history.items()):
+            st.button(result['label'], key=f"history-{key}", on_click=show_result, args=(key,),
+                      disabled=key == current, help=result['record']['smiles'])
+
+def render_result(result):
+    """Draw a stored result; only its 3D structure may still be building"""
+    parsed_data = result['record']
+    
+    # Display molecule information - Dark Premium style
+    source_label = RESOLVER_SOURCES.get(parsed_data.get('source'), 'Unknown source')
+    if parsed_data.get('cached'):
+        source_label += " (cached)"
+    st.markdown(f"""
+    <div class="content-card">
+        <h3 style="margin-bottom: 1.5rem; color: #ffffff; font-size: 1.5rem;">Molecular Profile</h3>
+        <p style="color: #888888; font-size: 0.85rem; margin: 0;">Resolved via {source_label}</p>
+    </div>
+    """, unsafe_allow_html=True)
     
-    /* Success/Error messages */
-    .stSuccess {
-        background: rgba(52, 199, 89, 0.15);
-        border: 1px solid rgba(52, 199, 89, 0.4);
-        border-radius: 12px;
-        color: #34c759;
-    }
+    # Information cards
+    col1, col2 = st.columns(2, gap="large")
     
-    .stError {
-        background: rgba(255, 59, 48, 0.15);
-        border: 1px solid rgba(255, 59, 48, 0.4);
-        border-radius: 12px;
-        color: #ff3b30;
-    }
+    with col1:
+        st.markdown(f"""
+        <div class="metric-container">
+            <h4 style="color: #888888; font-size: 0.9rem; margin-bottom: 0.5rem; text-transform: uppercase; letter-spacing: 0.5px;">IUPAC Name</h4>
+            <p style="color: #ffffff; font-size: 1.1rem; font-weight: 500; margin: 0;">{parsed_data.get('iupac_name') or 'Not available'}</p>
+        </div>
+        """, unsafe_allow_html=True)
+        
+        st.markdown(f"""
+        <div class="metric-container">
+            <h4 style="color: #888888; font-size: 0.9rem; margin-bottom: 0.5rem; text-transform: uppercase; letter-spacing: 0.5px;">Molecular Formula</h4>
+            <p style="color: #ffffff; font-size: 1.3rem; font-weight: 600; margin: 0; font-family: 'SF Mono', monospace;">{parsed_data.get('molecular_formula', 'N/A')}</p>
+        </div>
+        """, unsafe_allow_html=True)
     
-    .stWarning {
-        background: rgba(255, 149, 0, 0.15);
-        border: 1px solid rgba(255, 149, 0, 0.4);
-        border-radius: 12px;
-        color: #ff9500;
-    }
+    with col2:
+        st.markdown(f"""
+        <div class="metric-container">
+            <h4 style="color: #888888; font-size: 0.9rem; margin-bottom: 0.5rem; text-transform: uppercase; letter-spacing: 0.5px;">Common Name</h4>
+            <p style="color: #ffffff; font-size: 1.1rem; font-weight: 500; margin: 0;">{parsed_data.get('common_name') or 'Not available'}</p>
+        </div>
+        """, unsafe_allow_html=True)
+        
+        if parsed_data.get('pubchem_cid'):
+            st.markdown(f"""
+            <div class="metric-container">
+                <h4 style="color: #888888; font-size: 0.9rem; margin-bottom: 0.5rem; text-transform: uppercase; letter-spacing: 0.5px;">PubChem ID</h4>
+                <p style="color: #0a84ff; font-size: 1.1rem; font-weight: 500; margin: 0;">{parsed_data.get('pubchem_cid')}</p>
+            </div>
+            """, unsafe_allow_html=True)
     
-    /* Atom legend styling */
-    .atom-legend {
-        background: rgba(255, 255, 255, 0.08);
-        backdrop-filter: blur(10px);
-        border-radius: 16px;
-        padding: 1.5rem;
-        border: 1px solid rgba(255, 255, 255, 0.15);
-        box-shadow: 0 4px 12px rgba(0, 0, 0, 0.4), inset 0 1px 0 rgba(255, 255, 255, 0.1);
-    }
+    if parsed_data.get('description'):
+        st.markdown(f"""
+        <div class="content-card">
+            <h4 style="color: #888888; font-size: 0.9rem; margin-bottom: 1rem; text-transform: uppercase; letter-spacing: 0.5px;">About This Molecule</h4>
+            <p style="color: #b0b0b0; font-size: 1rem; line-height: 1.6; margin: 0;">{parsed_data.get('description')}</p>
+        </div>
+        """, unsafe_allow_html=True)
     
-    /* Footer */
-    .footer {
-        text-align: center;
-        padding: 3rem 0 2rem 0;
-        color: #888888;
-        font-size: 0.9rem;
-        border-top: 1px solid rgba(255, 255, 255, 0.1);
-        margin-top: 4rem;
-    }
+    # SMILES notation in a special code block
+    st.markdown(f"""
+    <div class="content-card">
+        <h4 style="color: #888888; font-size: 0.9rem; margin-bottom: 1rem; text-transform: uppercase; letter-spacing: 0.5px;">SMILES Notation</h4>
+        <div style="background: rgba(255, 255, 255, 0.08); border-radius: 8px; padding: 1rem; font-family: 'SF Mono', monospace; font-size: 1rem; color: #ffffff; border: 1px solid rgba(255, 255, 255, 0.15); box-shadow: inset 0 1px 3px rgba(0, 0, 0, 0.3);">
+            {parsed_data.get('smiles', 'N/A')}
+        </div>
+    </div>
+    """, unsafe_allow_html=True)
     
-    .footer a {
-        color: #0a84ff;
-        text-decoration: none;
-        transition: color 0.3s ease;
-    }
+    if result.get('svg') is None:
+        st.error("❌ Could not generate 3D structure for this molecule.")
+        return
     
-    .footer a:hover {
-        color: #40a0ff;
-        text-decoration: underline;
-    }
-</style>
-""", unsafe_allow_html=True)
-
-class ChemVizService:
-    def __init__(self):
-        self.openai_client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        self.atom_colors = {
-            'H': '#FFFFFF',   # White
-            'C': '#909090',   # Gray
-            'N': '#3050F8',   # Blue
-            'O': '#FF0D0D',   # Red
-            'F': '#90E050',   # Green
-            'Cl': '#1FF01F',  # Bright Green
-            'Br': '#A62929',  # Brown
-            'I': '#940094',   # Purple
-            'P': '#FF8000',   # Orange
-            'S': '#FFFF30',   # Yellow
-            'B': '#FFB5B5',   # Pink
-            'Si': '#F0C8A0',  # Tan
-            'default': '#FF1493'  # Hot Pink for unknown atoms
-        }
+    st.markdown(f"""
+    <div class="content-card" style="text-align: center;">
+        <h4 style="color: #888888; font-size: 0.9rem; margin-bottom: 1rem; text-transform: uppercase; letter-spacing: 0.5px;">2D Structure</h4>
+        <img src="data:image/svg+xml;base64,{base64.b64encode(result['svg'].encode()).decode()}" style="max-width: 100%;"/>
+    </div>
+    """, unsafe_allow_html=True)
     
-    def parse_chemical_input(self, user_input):
-        """Use OpenAI to parse and understand chemical input"""
-        try:
-            prompt = f"""
-            You are a chemistry expert. Given the input: "{user_input}"
-            
-            Please provide a JSON response with the following information:
-            1. "smiles": The SMILES notation for this molecule (if possible)
-            2. "iupac_name": The IUPAC name of the compound
-            3. "common_name": Common name(s) of the compound
-            4. "molecular_formula": The molecular formula
-            5. "description": A brief description of the molecule
-            6. "pubchem_cid": PubChem CID if known (or null)
-            
-            If the input is unclear or not a valid chemical compound, set all fields to null except "description" which should explain the issue.
-            
-            Return ONLY valid JSON with no additional text, comments, or formatting.
-            
-            Example for aspirin:
-            {{"smiles": "CC(=O)OC1=CC=CC=C1C(=O)O", "iupac_name": "2-acetoxybenzoic acid", "common_name": "aspirin", "molecular_formula": "C9H8O4", "description": "A common pain reliever and anti-inflammatory drug", "pubchem_cid": 2244}}
-            """
-            
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o-mini",  # Using available model instead of gpt-5-nano
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0
-            )
-            
-            content = response.choices[0].message.content.strip()
-            
-            # Try to extract JSON if there's extra text
-            if content.startswith('```json'):
-                content = content.replace('```json', '').replace('```', '').strip()
-            elif content.startswith('```'):
-                content = content.replace('```', '').strip()
-            
-            # Find JSON object in the response
-            start_idx = content.find('{')
-            end_idx = content.rfind('}') + 1
-            
-            if start_idx != -1 and end_idx != 0:
-                json_str = content[start_idx:end_idx]
-                return json.loads(json_str)
-            else:
-                return json.loads(content)
-                
-        except json.JSONDecodeError as e:
-            st.error(f"Error parsing JSON response: {str(e)}")
-            # Fallback: try to get basic info from PubChem
-            return self.get_fallback_data(user_input)
-        except Exception as e:
-            st.error(f"Error with OpenAI API: {str(e)}")
-            return self.get_fallback_data(user_input)
+    # 3D Visualization - Dark Premium style
+    st.markdown("""
+    <div class="viz-container">
+        <h3 style="margin-bottom: 2rem; color: #ffffff; font-size: 1.8rem; font-weight: 600;">3D Molecular Structure</h3>
+    </div>
+    """, unsafe_allow_html=True)
+    viewer_slot = st.empty()
     
-    def get_fallback_data(self, user_input):
-        """Fallback method to get basic chemical data"""
-        try:
-            # Try PubChem first
-            pubchem_data = self.get_molecule_from_pubchem(user_input)
-            if pubchem_data:
-                return {
-                    'smiles': pubchem_data.get('smiles'),
-                    'iupac_name': None,
-                    'common_name': user_input,
-                    'molecular_formula': pubchem_data.get('molecular_formula'),
-                    'description': f"Chemical compound: {user_input}",
-                    'pubchem_cid': pubchem_data.get('cid')
-                }
-            
-            # If PubChem fails, try to parse as SMILES directly
-            mol = Chem.MolFromSmiles(user_input)
-            if mol:
-                return {
-                    'smiles': user_input,
-                    'iupac_name': None,
-                    'common_name': None,
-                    'molecular_formula': rdMolDescriptors.CalcMolFormula(mol),
-                    'description': f"SMILES notation: {user_input}",
-                    'pubchem_cid': None
-                }
-            
-            return None
-        except:
-            return None
-    
-    def get_molecule_from_pubchem(self, compound_name):
-        """Get molecule data from PubChem"""
-        try:
-            compounds = pcp.get_compounds(compound_name, 'name')
-            if compounds:
-                compound = compounds[0]
-                return {
-                    'smiles': compound.canonical_smiles,
-                    'molecular_formula': compound.molecular_formula,
-                    'molecular_weight': compound.molecular_weight,
-                    'cid': compound.cid
-                }
-        except:
-            pass
-        return None
+    # Molecular properties - Apple metrics style
+    properties = result['properties']
+    if properties:
+        st.markdown("""
+        <div class="content-card" style="margin-top: 3rem;">
+            <h3 style="margin-bottom: 2rem; color: #ffffff; font-size: 1.5rem;">Molecular Properties</h3>
+        </div>
+        """, unsafe_allow_html=True)
+        
+        # Create elegant property cards
+        prop_items = list(properties.items())
+        
+        # Split into rows of 4
+        for i in range(0, len(prop_items), 4):
+            cols = st.columns(4, gap="medium")
+            for j, (prop, value) in enumerate(prop_items[i:i+4]):
+                with cols[j]:
+                    st.markdown(f"""
+                    <div class="metric-container">
+                        <h4 style="color: #888888; font-size: 0.8rem; margin-bottom: 0.5rem; text-transform: uppercase; letter-spacing: 0.5px;">{prop}</h4>
+                        <p style="color: #ffffff; font-size: 1.4rem; font-weight: 600; margin: 0;">{value}</p>
+                    </div>
+                    """, unsafe_allow_html=True)
     
-    def create_molecule_from_smiles(self, smiles):
-        """Create RDKit molecule from SMILES"""
-        try:
-            mol = Chem.MolFromSmiles(smiles)
-            if mol is None:
-                return None
-            
-            # Add hydrogens and generate 3D coordinates
-            mol = Chem.AddHs(mol)
-            AllChem.EmbedMolecule(mol, randomSeed=42)
-            AllChem.MMFFOptimizeMolecule(mol)
-            
-            return mol
-        except Exception as e:
-            st.error(f"Error creating molecule: {str(e)}")
-            return None
+    render_similar(result)
     
-    def visualize_molecule_3d(self, mol, width=800, height=600):
-        """Create 3D visualization using py3Dmol"""
-        if mol is None:
-            return None
+    render_structure_3d(result, viewer_slot)
+
+def render_trajectory(service, uploaded):
+    """Play an uploaded XYZ or multi-model PDB file frame by frame"""
+    from trajectories import load_trajectory
+    cached = st.session_state.get('trajectory')
+    if cached is None or cached[0] != uploaded.file_id:
+        with st.spinner("Reading trajectory..."):
+            started = time.time()
+            trajectory = load_trajectory(uploaded, name=uploaded.name)
+            cached = (uploaded.file_id, trajectory, time.time() - started)
+        st.session_state.trajectory = cached
+    _, trajectory, seconds = cached
+    
+    sampled = f" (every {trajectory.stride} frames)" if trajectory.stride > 1 else ""
+    st.markdown(f'''<p style="color: #888888; font-size: 0.85rem;">{len(trajectory.elements):,} atoms · {len(trajectory)} frames{sampled} · read in {seconds:.2f}s</p>''', unsafe_allow_html=True)
+    components.html(service.visualize_trajectory(trajectory, width=900, height=600), height=620, width=920)
+
+def render_structure_mode():
+    """Open a PDB/mmCIF file, drawn at a level of detail that suits its size"""
+    with st.expander("🧬 Structure mode — open a PDB/mmCIF file or trajectory"):
+        uploaded = st.file_uploader(
+            "Structure file",
+            type=["pdb", "ent", "cif", "mmcif", "xyz", "gz"],
+            help="PDB or mmCIF, optionally gzip-compressed; only the first model is shown unless animated. XYZ files play as trajectories"
+        )
+        animate = st.checkbox(
+            "Animate all models (trajectory)",
+            value=False,
+            help="Play every MODEL of a multi-model PDB file; long trajectories are evenly sampled"
+        )
+        focus = st.text_input(
+            "Residues to show in full",
+            placeholder="e.g. A:45-60, HEM",
+            help="Chain:range or residue names; ligands are always shown in full"
+        )
+        if uploaded is None:
+            return
+        from structures import level_of_detail, load_structure
+        from trajectories import is_trajectory_file
+        from viewer import structure_html
         
-        # Convert to mol block
-        mol_block = Chem.MolToMolBlock(mol)
+        if animate or is_trajectory_file(uploaded.name):
+            try:
+                render_trajectory(get_service(), uploaded)
+            except (ValueError, OSError, EOFError) as e:
+                # Malformed frames, a broken gzip stream or a cut-off download
+                st.error(f"❌ Could not read trajectory: {e}")
+            return
         
-        # Create HTML for 3D viewer
-        html_template = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <script src="https://3Dmol.csb.pitt.edu/build/3Dmol-min.js"></script>
-            <style>
-                #container {{
-                    width: {width}px;
-                    height: {height}px;
-                    margin: 0 auto;
-                    border: 1px solid #ddd;
-                    border-radius: 10px;
-                    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                }}
-            </style>
-        </head>
-        <body>
-            <div id="container"></div>
-            <script>
-                let element = document.getElementById('container');
-                let config = {{ backgroundColor: 'white' }};
-                let viewer = $3Dmol.createViewer(element, config);
-                
-                let moldata = `{mol_block}`;
-                viewer.addModel(moldata, "mol");
-                
-                // Set style with color-coded atoms
-                viewer.setStyle({{}}, {{stick: {{radius: 0.15}}, sphere: {{scale: 0.25}}}});
-                
-                // Color atoms by element
-                viewer.setStyle({{elem: 'C'}}, {{sphere: {{color: '#909090', scale: 0.4}}, stick: {{color: '#909090'}}}});
-                viewer.setStyle({{elem: 'N'}}, {{sphere: {{color: '#3050F8', scale: 0.4}}, stick: {{color: '#3050F8'}}}});
-                viewer.setStyle({{elem: 'O'}}, {{sphere: {{color: '#FF0D0D', scale: 0.4}}, stick: {{color: '#FF0D0D'}}}});
-                viewer.setStyle({{elem: 'H'}}, {{sphere: {{color: '#FFFFFF', scale: 0.3}}, stick: {{color: '#FFFFFF'}}}});
-                viewer.setStyle({{elem: 'S'}}, {{sphere: {{color: '#FFFF30', scale: 0.4}}, stick: {{color: '#FFFF30'}}}});
-                viewer.setStyle({{elem: 'P'}}, {{sphere: {{color: '#FF8000', scale: 0.4}}, stick: {{color: '#FF8000'}}}});
-                viewer.setStyle({{elem: 'F'}}, {{sphere: {{color: '#90E050', scale: 0.4}}, stick: {{color: '#90E050'}}}});
-                viewer.setStyle({{elem: 'Cl'}}, {{sphere: {{color: '#1FF01F', scale: 0.4}}, stick: {{color: '#1FF01F'}}}});
-                
-                viewer.zoomTo();
-                viewer.spin(true);
-                viewer.render();
-            </script>
-        </body>
-        </html>
-        """
+        # Parse once per upload, not on every rerun
+        cached = st.session_state.get('structure')
+        if cached is None or cached[0] != uploaded.file_id:
+            with st.spinner("Reading structure..."):
+                started = time.time()
+                try:
+                    structure = load_structure(uploaded, name=uploaded.name)
+                except KeyError as e:
+                    st.error(f"❌ Could not read structure: missing field {e}")
+                    return
+                except (ValueError, OSError, EOFError) as e:
+                    # Malformed records, e.g. hybrid-36 numbers, a broken gzip stream or a cut-off download
+                    st.error(f"❌ Could not read structure: {e}")
+                    return
+                cached = (uploaded.file_id, structure, time.time() - started)
+            st.session_state.structure = cached
+        _, structure, seconds = cached
+        if not len(structure):
+            st.error("❌ No atoms found in this file.")
+            return
         
-        return html_template
-    
-    def get_molecule_properties(self, mol):
-        """Calculate molecular properties"""
+        view = level_of_detail(structure, focus)
+        summary = structure.summary()
+        ligands = ", ".join(summary['ligands']) or "none"
+        st.markdown(f'''<p style="color: #888888; font-size: 0.85rem;">{summary['atoms']:,} atoms · {summary['residues']:,} residues · {summary['chains']} chains · ligands: {ligands} · read in {seconds:.2f}s · drawing {len(view['index']):,} atoms as {view['level']}</p>''', unsafe_allow_html=True)
+        components.html(structure_html(structure, view), height=620, width=920)
+
+def render_debug_panel():
+    """Stage timings of the last request and process-wide latency histograms"""
+    import pandas as pd
+    with st.expander("🛠️ Debug — pipeline timings and metrics"):
+        last_trace = st.session_state.get('last_trace')
+        if last_trace:
+            st.markdown("**Last request**")
+            st.dataframe(pd.DataFrame([
+                {'stage': ' ' * s['depth'] + ('└ ' if s['depth'] else '') + s['name'], 'ms': s['ms'], 'error': s['error'],
+                 'details': ', '.join(f"{k}={v}" for k, v in s.items()
+                                      if k not in ('name', 'depth', 'started', 'ms', 'error') and v is not None)}
+                for s in (span.as_dict() for span in list(last_trace))
+            ]), hide_index=True)
+        
+        snapshot = metrics.snapshot()
+        stages = [h for h in snapshot['histograms'] if h['name'] == 'chemviz_stage_seconds']
+        if stages:
+            st.markdown("**All requests in this process**")
+            st.dataframe(pd.DataFrame([
+                {'stage': h['labels']['stage'], 'count': h['count'],
+                 'p50 ms': round(h['p50'] * 1000, 1), 'p95 ms': round(h['p95'] * 1000, 1),
+                 'total s': round(h['sum'], 2)}
+                for h in stages
+            ]), hide_index=True)
+        
+        from singleflight import flights
+        coalesced = flights.stats()['calls']
+        if coalesced:
+            st.markdown("**Shared in-flight work** (requests answered by another session's lookup or embedding)")
+            st.dataframe(pd.DataFrame([{'kind': kind, **counts} for kind, counts in coalesced.items()]),
+                         hide_index=True)
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button("Metrics (JSON)", metrics.to_json(), file_name="chemviz-metrics.json",
+                               mime="application/json")
+        with col2:
+            st.download_button("Metrics (Prometheus)", metrics.to_prometheus(), file_name="chemviz-metrics.prom",
+                               mime="text/plain")
+
+def build_comparison(service, text):
+    """Resolve and build every molecule listed, one per line, for the compare mode"""
+    inputs = list(dict.fromkeys(line.strip() for line in text.splitlines() if line.strip()))
+    records = service.resolve_many(inputs)
+    jobs = get_embedding_jobs()
+    futures = {text: jobs.submit(record['smiles']) for text, record in records.items() if record}
+    progress = st.progress(0.0, text="🏗️ Building 3D structures...")
+    while futures:
+        finished, pending = wait(list(futures.values()), timeout=0.25)
+        progress.progress(len(finished) / len(futures), text=f"🏗️ Building 3D structures... {len(finished)}/{len(futures)}")
+        if not pending:
+            break
+    progress.empty()
+    comparison = {'labels': [], 'molecules': [], 'failed': [], 'aligned': {}, 'viewers': {}}
+    for text in inputs:
+        future = futures.get(text)
+        mol = future.result() if future is not None and future.exception() is None else None
         if mol is None:
-            return {}
+            comparison['failed'].append(text)
+            continue
+        comparison['labels'].append(records[text].get('common_name') or text)
+        comparison['molecules'].append(mol)
+    return comparison
+
+def render_comparison_mode():
+    """Load a list of molecules into one viewer, on a grid or aligned and overlaid"""
+    with st.expander("⚖️ Compare mode — view many molecules in one viewer"):
+        text = st.text_area(
+            "Molecules to compare",
+            placeholder="One name or SMILES per line, e.g.\naspirin\nsalicylic acid\nmethyl salicylate",
+            help="Every molecule is aligned onto the reference and drawn in a single viewer"
+        )
+        if st.button("Compare") and text.strip():
+            with trace() as spans, st.spinner("🔬 Resolving molecules..."):
+                st.session_state.comparison = build_comparison(get_service(), text)
+            st.session_state.comparison_reference = 0
+            st.session_state.last_trace = spans
+        comparison = st.session_state.get('comparison')
+        if comparison is None:
+            return
+        if comparison['failed']:
+            st.warning("Could not build: " + ", ".join(comparison['failed']))
+        if comparison['molecules']:
+            render_comparison_viewer(comparison)
+
+@st.fragment
+def render_comparison_viewer(comparison):
+    """Shared viewer for the compare mode; its options rerun only this fragment"""
+    labels = comparison['labels']
+    col1, col2, col3 = st.columns([2, 3, 1])
+    with col1:
+        layout = st.radio("Layout", ["Grid", "Overlay"], horizontal=True, key="comparison_layout")
+    with col2:
+        reference = st.selectbox("Align onto", range(len(labels)), format_func=labels.__getitem__,
+                                 key="comparison_reference")
+    with col3:
+        # Hydrogens roughly double the atoms drawn; large sets start without them
+        hydrogens = st.toggle("Hydrogens", value=len(labels) <= 20, key="comparison_hydrogens")
+    style = st.radio("Style", list(VIEWER_STYLES), index=1, horizontal=True, key="comparison_style",
+                     label_visibility="collapsed")
+
+    if reference not in comparison['aligned']:
+        from comparison import align_molecules
+        with st.spinner(f"📐 Aligning {len(labels)} molecules..."):
+            comparison['aligned'][reference] = align_molecules(comparison['molecules'], reference)
+    aligned = comparison['aligned'][reference]
+
+    # Each combination of options is rendered once per comparison
+    options = (layout.lower(), reference, hydrogens, VIEWER_STYLES[style])
+    if options not in comparison['viewers']:
+        # The overlay legend lists the reference first
+        order = [reference] + [i for i in range(len(labels)) if i != reference]
+        comparison['viewers'][options] = get_service().visualize_comparison(
+            [aligned[i] for i in order], [labels[i] for i in order], layout=options[0], width=900, height=600,
+            style=options[3], hydrogens=hydrogens)
+    components.html(comparison['viewers'][options], height=600, width=900)
+
+    import pandas as pd
+    st.dataframe(pd.DataFrame([
+        {'molecule': label,
+         'alignment': mol.GetProp('alignment'),
+         'shape similarity': round(mol.GetDoubleProp('shape_similarity'), 3) if mol.HasProp('shape_similarity') else None,
+         'RMSD Å': round(mol.GetDoubleProp('rmsd'), 2) if mol.HasProp('rmsd') else None}
+        for label, mol in zip(labels, aligned)
+    ]), hide_index=True)
+
+def render_batch_mode():
+    """Upload a CSV/SDF/text file and run it through the batch pipeline"""
+    with st.expander("📦 Batch mode — process a file of molecules"):
+        uploaded = st.file_uploader(
+            "Molecule file",
+            type=["csv", "tsv", "sdf", "txt"],
+            help="CSV with an input/smiles/name column, an SDF, or one molecule per line"
+        )
+        use_llm = st.checkbox("Fall back to OpenAI for unresolved names", value=False)
+        if uploaded is None or not st.button("Run batch"):
+            if 'batch_outputs' in st.session_state:
+                render_batch_downloads(st.session_state.batch_outputs)
+            return
+        from batch import count_inputs, read_inputs, run_batch
         
-        return {
-            'Molecular Weight': f"{Descriptors.MolWt(mol):.2f} g/mol",
-            'LogP': f"{Descriptors.MolLogP(mol):.2f}",
-            'TPSA': f"{Descriptors.TPSA(mol):.2f} Ų",
-            'Rotatable Bonds': Descriptors.NumRotatableBonds(mol),
-            'H-Bond Donors': Descriptors.NumHDonors(mol),
-            'H-Bond Acceptors': Descriptors.NumHAcceptors(mol),
-            'Heavy Atoms': mol.GetNumHeavyAtoms(),
-            'Rings': Descriptors.RingCount(mol)
+        workdir = tempfile.mkdtemp(prefix="chemviz-batch-")
+        input_path = os.path.join(workdir, uploaded.name)
+        with open(input_path, "wb") as handle:
+            handle.write(uploaded.getbuffer())
+        outputs = {
+            'parquet': os.path.join(workdir, "results.parquet"),
+            'sdf': os.path.join(workdir, "structures.sdf"),
         }
+        
+        total = max(count_inputs(input_path), 1)
+        progress_bar = st.progress(0.0, text="Starting workers...")
+        
+        def report(done, failed):
+            progress_bar.progress(min(done / total, 1.0), text=f"Processed {done}/{total} ({failed} failed)")
+        
+        summary = run_batch(
+            read_inputs(input_path),
+            parquet_path=outputs['parquet'],
+            sdf_path=outputs['sdf'],
+            use_llm=use_llm,
+            progress=report
+        )
+        outputs['summary'] = summary
+        st.session_state.batch_outputs = outputs
+        render_batch_downloads(outputs)
+
+def render_batch_downloads(outputs):
+    """Summary and download buttons for the last batch run"""
+    summary = outputs['summary']
+    st.success(f"Processed {summary['rows']} molecules in {summary['seconds']:.1f}s — {summary['failed']} failed")
+    col1, col2 = st.columns(2)
+    with col1:
+        with open(outputs['parquet'], "rb") as handle:
+            st.download_button("⬇️ Results (Parquet)", handle, file_name="chemviz-results.parquet")
+    with col2:
+        with open(outputs['sdf'], "rb") as handle:
+            st.download_button("⬇️ 3D structures (SDF)", handle, file_name="chemviz-structures.sdf")
 
 def main():
-    # Initialize service
-    if 'chemviz_service' not in st.session_state:
-        st.session_state.chemviz_service = ChemVizService()
-    
-    service = st.session_state.chemviz_service
-    
     # Hero Section - Steve Jobs style
     st.markdown("""
     <div class="hero-section">
@@ -536,6 +836,9 @@ def main():
             </p>
         </div>
         """, unsafe_allow_html=True)
+        
+        # Filled at the end of the run, once this run's molecule is in the history
+        history_slot = st.empty()
     
     # Main input section - Apple-inspired
     st.markdown('<div class="input-section">', unsafe_allow_html=True)
@@ -545,127 +848,50 @@ def main():
         "Molecule Input",
         placeholder="Enter molecule name, formula, or SMILES notation...",
         help="Examples: caffeine, C8H10N4O2, CCO, c1ccccc1",
-        label_visibility="collapsed"
+        label_visibility="collapsed",
+        key="molecule_input"
     )
     
+    render_suggestions(user_input)
+    
     # Center the button perfectly
     col1, col2, col3 = st.columns([2, 1, 2])
     with col2:
         visualize_btn = st.button("✨ Visualize Molecule", type="primary")
     
     st.markdown('</div>', unsafe_allow_html=True)
+    record_first_paint()
+    
+    # A picked suggestion is visualized straight away, resolved without OpenAI
+    picked = st.session_state.pop('picked_suggestion', None)
+    if picked:
+        visualize_btn = True
+    # Substructure matches stay highlighted only on the hit they came from
+    highlight = st.session_state.pop('highlight', None)
+    if highlight and highlight['smiles'] != picked:
+        highlight = None
+    
+    render_structure_mode()
+    render_substructure_mode()
+    render_comparison_mode()
+    render_batch_mode()
     
     # Processing and visualization
     if visualize_btn and user_input:
-        with st.spinner("🔬 Analyzing chemical structure..."):
-            # Parse input with OpenAI
-            parsed_data = service.parse_chemical_input(user_input)
-            
-            if parsed_data and parsed_data.get('smiles'):
-                # Display molecule information - Dark Premium style
-                st.markdown("""
-                <div class="content-card">
-                    <h3 style="margin-bottom: 1.5rem; color: #ffffff; font-size: 1.5rem;">Molecular Profile</h3>
-                </div>
-                """, unsafe_allow_html=True)
-                
-                # Information cards
-                col1, col2 = st.columns(2, gap="large")
-                
-                with col1:
-                    st.markdown(f"""
-                    <div class="metric-container">
-                        <h4 style="color: #888888; font-size: 0.9rem; margin-bottom: 0.5rem; text-transform: uppercase; letter-spacing: 0.5px;">IUPAC Name</h4>
-                        <p style="color: #ffffff; font-size: 1.1rem; font-weight: 500; margin: 0;">{parsed_data.get('iupac_name', 'Not available')}</p>
-                    </div>
-                    """, unsafe_allow_html=True)
-                    
-                    st.markdown(f"""
-                    <div class="metric-container">
-                        <h4 style="color: #888888; font-size: 0.9rem; margin-bottom: 0.5rem; text-transform: uppercase; letter-spacing: 0.5px;">Molecular Formula</h4>
-                        <p style="color: #ffffff; font-size: 1.3rem; font-weight: 600; margin: 0; font-family: 'SF Mono', monospace;">{parsed_data.get('molecular_formula', 'N/A')}</p>
-                    </div>
-                    """, unsafe_allow_html=True)
-                
-                with col2:
-                    st.markdown(f"""
-                    <div class="metric-container">
-                        <h4 style="color: #888888; font-size: 0.9rem; margin-bottom: 0.5rem; text-transform: uppercase; letter-spacing: 0.5px;">Common Name</h4>
-                        <p style="color: #ffffff; font-size: 1.1rem; font-weight: 500; margin: 0;">{parsed_data.get('common_name', 'Not available')}</p>
-                    </div>
-                    """, unsafe_allow_html=True)
-                    
-                    if parsed_data.get('pubchem_cid'):
-                        st.markdown(f"""
-                        <div class="metric-container">
-                            <h4 style="color: #888888; font-size: 0.9rem; margin-bottom: 0.5rem; text-transform: uppercase; letter-spacing: 0.5px;">PubChem ID</h4>
-                            <p style="color: #0a84ff; font-size: 1.1rem; font-weight: 500; margin: 0;">{parsed_data.get('pubchem_cid')}</p>
-                        </div>
-                        """, unsafe_allow_html=True)
-                
-                if parsed_data.get('description'):
-                    st.markdown(f"""
-                    <div class="content-card">
-                        <h4 style="color: #888888; font-size: 0.9rem; margin-bottom: 1rem; text-transform: uppercase; letter-spacing: 0.5px;">About This Molecule</h4>
-                        <p style="color: #b0b0b0; font-size: 1rem; line-height: 1.6; margin: 0;">{parsed_data.get('description')}</p>
-                    </div>
-                    """, unsafe_allow_html=True)
-                
-                # SMILES notation in a special code block
-                st.markdown(f"""
-                <div class="content-card">
-                    <h4 style="color: #888888; font-size: 0.9rem; margin-bottom: 1rem; text-transform: uppercase; letter-spacing: 0.5px;">SMILES Notation</h4>
-                    <div style="background: rgba(255, 255, 255, 0.08); border-radius: 8px; padding: 1rem; font-family: 'SF Mono', monospace; font-size: 1rem; color: #ffffff; border: 1px solid rgba(255, 255, 255, 0.15); box-shadow: inset 0 1px 3px rgba(0, 0, 0, 0.3);">
-                        {parsed_data.get('smiles', 'N/A')}
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-                
-                # Create molecule
-                with st.spinner("🏗️ Building 3D structure..."):
-                    mol = service.create_molecule_from_smiles(parsed_data['smiles'])
-                    
-                    if mol:
-                        # 3D Visualization - Dark Premium style
-                        st.markdown("""
-                        <div class="viz-container">
-                            <h3 style="margin-bottom: 2rem; color: #ffffff; font-size: 1.8rem; font-weight: 600;">3D Molecular Structure</h3>
-                        </div>
-                        """, unsafe_allow_html=True)
-                        
-                        # Create 3D visualization
-                        html_viewer = service.visualize_molecule_3d(mol, width=900, height=600)
-                        if html_viewer:
-                            components.html(html_viewer, height=600, width=900)
-                        
-                        # Molecular properties - Apple metrics style
-                        properties = service.get_molecule_properties(mol)
-                        if properties:
-                            st.markdown("""
-                            <div class="content-card" style="margin-top: 3rem;">
-                                <h3 style="margin-bottom: 2rem; color: #ffffff; font-size: 1.5rem;">Molecular Properties</h3>
-                            </div>
-                            """, unsafe_allow_html=True)
-                            
-                            # Create elegant property cards
-                            prop_items = list(properties.items())
-                            
-                            # Split into rows of 4
-                            for i in range(0, len(prop_items), 4):
-                                cols = st.columns(4, gap="medium")
-                                for j, (prop, value) in enumerate(prop_items[i:i+4]):
-                                    with cols[j]:
-                                        st.markdown(f"""
-                                        <div class="metric-container">
-                                            <h4 style="color: #888888; font-size: 0.8rem; margin-bottom: 0.5rem; text-transform: uppercase; letter-spacing: 0.5px;">{prop}</h4>
-                                            <p style="color: #ffffff; font-size: 1.4rem; font-weight: 600; margin: 0;">{value}</p>
-                                        </div>
-                                        """, unsafe_allow_html=True)
-                    
-                    else:
-                        st.error("❌ Could not generate 3D structure for this molecule.")
-            
-            else:
+        smarts = highlight['smarts'] if highlight else None
+        query = input_key(user_input, smarts)
+        key = get_history_inputs().get(query)
+        if key in get_history():
+            # Asked for before in this session: nothing to recompute
+            show_result(key)
+        else:
+            # Every stage below is timed into this trace for the debug panel
+            with trace() as spans, st.spinner("🔬 Analyzing chemical structure..."):
+                result = build_result(get_service(), user_input, picked, smarts)
+            # The list stays live, so spans of the background 3D build land in it too
+            st.session_state.last_trace = spans
+            if result is None:
+                show_result(None)
                 st.markdown("""
                 <div class="content-card" style="border: 2px solid rgba(255, 59, 48, 0.3); background: rgba(255, 59, 48, 0.05);">
                     <h4 style="color: #ff3b30; margin-bottom: 1rem;">Unable to Process Molecule</h4>
@@ -677,6 +903,8 @@ def main():
                     </ul>
                 </div>
                 """, unsafe_allow_html=True)
+            else:
+                remember_result(result, query)
     
     elif visualize_btn and not user_input:
         st.markdown("""
@@ -686,6 +914,15 @@ def main():
         </div>
         """, unsafe_allow_html=True)
     
+    # The current result survives reruns from any other widget
+    result = get_history().get(st.session_state.get('current_result'))
+    if result is not None:
+        render_result(result)
+    render_history(history_slot)
+    
+    if st.query_params.get('debug') == '1' or os.getenv('CHEMVIZ_DEBUG') == '1':
+        render_debug_panel()
+    
     # Footer - Apple style
     st.markdown("""
     <div class="footer">
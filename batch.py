@@ -0,0 +1,345 @@
+"""Batch resolution, 3D build and property profiling
+
+Runs every input of a CSV, SDF or plain-text file through the same
+ChemVizService steps as the app (resolve, 3D structure, properties) on a
+process pool. Results are streamed to Parquet and/or SDF in input order, and a
+failing row is recorded with its error instead of aborting the run. Resolved
+molecules can also be appended to a ``molecule_store`` directory.
+
+Usage:
+    python batch.py molecules.csv -o results.parquet --sdf structures.sdf --store data/molecules
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+from rdkit import Chem, rdBase
+
+from cache import ResolutionCache
+from conformers import ConformerStore
+from descriptors import CORE_DESCRIPTORS, is_integer_descriptor
+from molecule_store import MoleculeStore
+from service import ChemVizService
+
+DEFAULT_CHUNK_SIZE = 50
+ROW_GROUP_SIZE = 5000
+
+# Column names tried, in order, when a CSV does not name its input column
+INPUT_COLUMNS = ('input', 'smiles', 'name', 'molecule', 'compound')
+
+RESULT_SCHEMA = pa.schema([
+    ('row', pa.int64()),
+    ('input', pa.string()),
+    ('status', pa.string()),
+    ('error', pa.string()),
+    ('source', pa.string()),
+    ('smiles', pa.string()),
+    ('iupac_name', pa.string()),
+    ('common_name', pa.string()),
+    ('molecular_formula', pa.string()),
+    ('pubchem_cid', pa.int64()),
+    ('embedding', pa.string()),
+] + [
+    (name, pa.int64() if is_integer_descriptor(name) else pa.float64())
+    for name in CORE_DESCRIPTORS
+])
+
+
+def _input_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.sdf', '.sd', '.mol'):
+        return 'sdf'
+    if ext in ('.csv', '.tsv'):
+        return 'csv'
+    return 'text'
+
+
+def _read_header(path, handle):
+    # (csv reader positioned after the header, column names), or None for an empty file
+    delimiter = '\t' if path.lower().endswith('.tsv') else ','
+    reader = csv.reader(handle, delimiter=delimiter)
+    header = next(reader, None)
+    if header is None:
+        return None
+    return reader, [h.strip() for h in header]
+
+
+def column_error(path, column):
+    """Why ``column`` cannot be read from ``path``, or None if it can (or the file is not a CSV)"""
+    if column is None or _input_format(path) != 'csv':
+        return None
+    with open(path, newline='', encoding='utf-8') as handle:
+        table = _read_header(path, handle)
+    # An empty file has no rows to read from any column
+    if table is not None and column.lower() not in [name.lower() for name in table[1]]:
+        return f"no column {column!r} in {path}; columns: {', '.join(table[1])}"
+    return None
+
+
+def read_inputs(path, column=None):
+    """Yield input strings from a CSV/TSV column, SDF records or text lines
+
+    Raises ValueError if ``column`` is not in the CSV header; see ``column_error``.
+    """
+    fmt = _input_format(path)
+    if fmt == 'sdf':
+        with open(path, 'rb') as handle, rdBase.BlockLogs():
+            for mol in Chem.ForwardSDMolSupplier(handle):
+                # Unparseable records still count as rows so failures line up
+                yield Chem.MolToSmiles(mol) if mol is not None else ''
+        return
+
+    with open(path, newline='', encoding='utf-8') as handle:
+        if fmt == 'text':
+            for line in handle:
+                if line.strip():
+                    yield line.strip()
+            return
+
+        table = _read_header(path, handle)
+        if table is None:
+            return
+        reader, header = table
+        lowered = [name.lower() for name in header]
+        if column is not None:
+            if column.lower() not in lowered:
+                raise ValueError(column_error(path, column))
+            index = lowered.index(column.lower())
+        else:
+            index = next((lowered.index(c) for c in INPUT_COLUMNS if c in lowered), 0)
+        for values in reader:
+            if index < len(values) and values[index].strip():
+                yield values[index].strip()
+
+
+def count_inputs(path, column=None):
+    """Number of inputs ``read_inputs`` yields, for progress reporting
+
+    Counted with the same reader, so blank cells and the column choice agree
+    with the rows processed; SDF records are parsed, which costs a small
+    fraction of processing them.
+    """
+    return sum(1 for _ in read_inputs(path, column))
+
+
+_worker_service = None
+
+
+def _init_worker(use_llm):
+    global _worker_service
+    _worker_service = ChemVizService(
+        cache=ResolutionCache(),
+        conformer_store=ConformerStore(),
+        use_llm=use_llm,
+        # Parallelism comes from the worker processes
+        embed_threads=1
+    )
+
+
+def process_input(service, index, text, with_structure=False, records=None):
+    """Resolve, build and profile one input; errors are recorded, not raised
+
+    ``records`` maps inputs already resolved by ``resolve_many`` to their
+    record, or None when they could not be resolved.
+    """
+    result = {name: None for name in RESULT_SCHEMA.names}
+    result.update({'row': index, 'input': text, 'status': 'ok'})
+    try:
+        record = records[text] if records is not None and text in records else service.parse_chemical_input(text)
+        if not record:
+            raise ValueError("could not resolve input")
+        for key in ('source', 'smiles', 'iupac_name', 'common_name', 'molecular_formula'):
+            result[key] = record.get(key)
+        result['pubchem_cid'] = int(record['pubchem_cid']) if record.get('pubchem_cid') else None
+
+        mol = service.create_molecule_from_smiles(record['smiles'])
+        if mol is None:
+            raise ValueError("could not generate 3D structure")
+        result['embedding'] = mol.GetProp('embedding')
+        result.update(service.get_molecule_properties(mol))
+        if with_structure:
+            result['mol_block'] = Chem.MolToMolBlock(mol)
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+    return result
+
+
+def process_error(index, text, error):
+    """Result row for an input whose chunk could not be processed"""
+    result = {name: None for name in RESULT_SCHEMA.names}
+    result.update({'row': index, 'input': text, 'status': 'error', 'error': str(error)})
+    return result
+
+
+def _process_chunk(chunk, with_structure):
+    # One PubChem fan-out and a few batched OpenAI requests for the whole chunk
+    try:
+        records = _worker_service.resolve_many([text for _, text in chunk])
+    except Exception:
+        # Resolve row by row instead
+        records = None
+    return [process_input(_worker_service, index, text, with_structure, records) for index, text in chunk]
+
+
+def _chunks(inputs, size):
+    chunk = []
+    for item in enumerate(inputs):
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class _ResultWriter:
+    """Stream results to Parquet row groups, SDF records and a molecule store"""
+
+    def __init__(self, parquet_path=None, sdf_path=None, store_path=None):
+        self._parquet = pq.ParquetWriter(parquet_path, RESULT_SCHEMA) if parquet_path else None
+        self._sdf = open(sdf_path, 'w', encoding='utf-8') if sdf_path else None
+        self._store = MoleculeStore(store_path) if store_path else None
+        self._buffer = []
+        self._molecules = []
+
+    def write(self, results):
+        for result in results:
+            if self._sdf is not None and result.get('mol_block'):
+                self._write_sdf(result)
+            if self._parquet is not None:
+                self._buffer.append(result)
+            if self._store is not None and result.get('mol_block'):
+                mol = Chem.MolFromMolBlock(result['mol_block'], removeHs=False)
+                if mol is not None:
+                    mol.SetProp('embedding', result['embedding'])
+                    # Results carry the record fields and descriptor values
+                    self._molecules.append((result, mol, result))
+        if len(self._buffer) >= ROW_GROUP_SIZE:
+            self._flush()
+        if len(self._molecules) >= ROW_GROUP_SIZE:
+            self._flush_store()
+
+    def close(self):
+        self._flush()
+        self._flush_store()
+        if self._parquet is not None:
+            self._parquet.close()
+        if self._sdf is not None:
+            self._sdf.close()
+
+    def _flush(self):
+        if self._buffer and self._parquet is not None:
+            columns = {name: [r[name] for r in self._buffer] for name in RESULT_SCHEMA.names}
+            self._parquet.write_table(pa.table(columns, schema=RESULT_SCHEMA))
+        self._buffer = []
+
+    def _flush_store(self):
+        if self._molecules:
+            self._store.add_many(self._molecules)
+        self._molecules = []
+
+    def _write_sdf(self, result):
+        self._sdf.write(result['mol_block'].rstrip('\n') + '\n')
+        fields = {'input': result['input'], 'source': result['source']}
+        fields.update((name, result[name]) for name in CORE_DESCRIPTORS)
+        for name, value in fields.items():
+            if value is not None:
+                self._sdf.write(f">  <{name}>\n{value}\n\n")
+        self._sdf.write('$$$$\n')
+
+
+def run_batch(inputs, parquet_path=None, sdf_path=None, workers=None, chunk_size=DEFAULT_CHUNK_SIZE,
+              use_llm=True, progress=None, store_path=None):
+    """Process an iterable of inputs on a process pool and stream the results
+
+    Molecules that resolve and build are also added to the molecule store
+    at ``store_path``, if given. ``progress`` is called as ``progress(done, failed)`` after every chunk.
+    Returns a summary dict with row and failure counts and elapsed seconds.
+    """
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    done = failed = 0
+    writer = _ResultWriter(parquet_path, sdf_path, store_path)
+    # Spawned workers avoid forking a multi-threaded parent (e.g. Streamlit)
+    context = multiprocessing.get_context('spawn')
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_worker, initargs=(use_llm,)) as pool:
+            pending = deque()
+
+            def collect():
+                nonlocal done, failed
+                chunk, future = pending.popleft()
+                try:
+                    results = future.result()
+                except Exception as e:
+                    # A crashed worker fails its chunk, not the run
+                    results = [process_error(index, text, e) for index, text in chunk]
+                writer.write(results)
+                done += len(results)
+                failed += sum(1 for r in results if r['status'] != 'ok')
+                if progress:
+                    progress(done, failed)
+
+            # Bounded in-flight chunks keep memory flat for any input size
+            for chunk in _chunks(inputs, chunk_size):
+                with_structure = sdf_path is not None or store_path is not None
+                pending.append((chunk, pool.submit(_process_chunk, chunk, with_structure)))
+                if len(pending) >= workers * 2:
+                    collect()
+            while pending:
+                collect()
+    finally:
+        writer.close()
+    return {'rows': done, 'failed': failed, 'seconds': time.perf_counter() - started}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resolve, embed and profile molecules in bulk")
+    parser.add_argument('input', help="CSV/TSV, SDF or text file with one molecule per line")
+    parser.add_argument('-o', '--output', help="Parquet file for results")
+    parser.add_argument('--sdf', help="SDF file for 3D structures with properties")
+    parser.add_argument('--store', help="Molecule store directory to add resolved molecules to")
+    parser.add_argument('--column', help="CSV column holding the molecule input")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--no-llm', action='store_true', help="Never fall back to OpenAI")
+    args = parser.parse_args(argv)
+    load_dotenv()
+    if not args.output and not args.sdf and not args.store:
+        parser.error("give at least one of --output, --sdf or --store")
+    error = column_error(args.input, args.column)
+    if error:
+        parser.error(error)
+
+    total = count_inputs(args.input, args.column)
+
+    def report(done, failed):
+        sys.stderr.write(f"\rProcessed {done}/{total} ({failed} failed)")
+        sys.stderr.flush()
+
+    summary = run_batch(
+        read_inputs(args.input, args.column),
+        parquet_path=args.output,
+        sdf_path=args.sdf,
+        store_path=args.store,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        use_llm=not args.no_llm,
+        progress=report
+    )
+    sys.stderr.write(f"\nDone: {summary['rows']} rows, {summary['failed']} failed in {summary['seconds']:.1f}s\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
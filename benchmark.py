@@ -0,0 +1,375 @@
+"""Benchmarks for resolution, 3D build, descriptors and viewer rendering
+
+Runs the expensive ``ChemVizService`` paths over a tiered corpus
+(``benchmarks/corpus.csv``: small molecules, drug-like, macrocycles,
+peptides) and records, per molecule and stage:
+
+    median_ms / min_ms    wall time over the timed repeats, after a warm-up
+    peak_kb               peak Python heap allocation (tracemalloc) in one run
+    payload_bytes         size of what the stage produces, where it has one
+
+PubChem and OpenAI are replaced by local stand-ins that answer from the
+corpus itself, so runs are deterministic and need no network or API key;
+the resolution cache, conformer store and compound dictionary are not used,
+so every repeat does the full work. Embedding runs on a fixed number of
+threads (default 1), since the thread count changes how many conformers are
+tried and therefore the coordinates.
+
+The ``startup`` tier times cold starts of the Streamlit app, each in a fresh
+interpreter, so that imports moving back to the top of ``app.py`` show up.
+
+Results are compared against a stored baseline, and the run fails when a
+stage is slower, larger or heavier than the baseline by more than the
+thresholds. Timings only compare meaningfully on the machine that recorded
+the baseline; payload sizes compare anywhere.
+
+Usage:
+    python benchmark.py                        # run, compare with benchmarks/baseline.json
+    python benchmark.py --save                 # run and store as the new baseline
+    python benchmark.py --tier peptide --stage structure_3d -o results.json
+    python benchmark.py --tier startup         # cold-start times only
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+from rdkit import Chem, rdBase
+from rdkit.Chem import Descriptors, rdMolDescriptors
+
+from service import ChemVizService
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_DIR = os.path.join(ROOT, 'benchmarks')
+DEFAULT_CORPUS = os.path.join(BENCHMARK_DIR, 'corpus.csv')
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+TIERS = ('small', 'drug-like', 'macrocycle', 'peptide')
+STAGES = ('resolve_smiles', 'resolve_name', 'resolve_llm', 'structure_3d', 'properties', 'render_3d')
+# Cold starts of the app, each in a fresh interpreter: time until the input
+# form is sent, the whole first script run, and importing the service, which
+# the first query pays for
+STARTUP_STAGES = ('first_paint', 'first_run', 'import_service')
+
+# Allowed growth over the baseline before a stage counts as a regression;
+# time and memory also need an absolute slack so tiny stages are not noise
+DEFAULT_THRESHOLDS = {'time': 0.5, 'time_slack_ms': 2.0, 'memory': 0.25, 'memory_slack_kb': 64.0, 'payload': 0.05}
+
+
+# Embedding paths from best to worst; None means the build failed
+_EMBEDDING_RANK = {'etkdg': 3, 'random_coords': 2, '2d': 1, None: 0}
+
+
+def read_corpus(path=DEFAULT_CORPUS):
+    """``{'tier', 'name', 'smiles'}`` rows of a corpus CSV"""
+    with open(path, newline='', encoding='utf-8') as handle:
+        return [{k: (v or '').strip() for k, v in row.items()} for row in csv.DictReader(handle)]
+
+
+class StandInPubChem:
+    """PubChem client answering name lookups from the corpus"""
+
+    def __init__(self, corpus):
+        self._records = {}
+        with rdBase.BlockLogs():
+            for row in corpus:
+                mol = Chem.MolFromSmiles(row['smiles'])
+                self._records[row['name'].lower()] = {
+                    'cid': None,
+                    'smiles': row['smiles'],
+                    'molecular_formula': rdMolDescriptors.CalcMolFormula(mol),
+                    'molecular_weight': round(Descriptors.MolWt(mol), 2),
+                    'iupac_name': None,
+                }
+
+    def properties_by_name(self, name):
+        record = self._records.get(name.strip().lower())
+        return dict(record) if record else None
+
+    def lookup_names(self, names):
+        return {name: self.properties_by_name(name) for name in dict.fromkeys(names)}
+
+
+class StandInOpenAI:
+    """Chat-completions client replying with the corpus record for the prompted input"""
+
+    _INPUT = re.compile(r'Given the input: "(.*)"')
+
+    def __init__(self, corpus):
+        self._pubchem = StandInPubChem(corpus)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, **options):
+        prompt = messages[-1]['content']
+        match = self._INPUT.search(prompt)
+        name = match.group(1) if match else ''
+        record = self._pubchem.properties_by_name(name) or {}
+        content = json.dumps({
+            'smiles': record.get('smiles'),
+            'iupac_name': None,
+            'common_name': name if record else None,
+            'molecular_formula': record.get('molecular_formula'),
+            'description': f"Chemical compound: {name}" if record else "Not a known compound",
+            'pubchem_cid': None,
+        })
+        # Roughly four characters per token, like the real tokenizer on English
+        usage = SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=len(content) // 4)
+        message = SimpleNamespace(content=content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+def make_service(corpus, threads=1):
+    """Service with stand-in remote tiers and no caches"""
+    return ChemVizService(
+        cache=None, conformer_store=None, report_error=logger.warning, use_llm=True, hedge=False,
+        pubchem_client=StandInPubChem(corpus), openai_client=StandInOpenAI(corpus), offline=False,
+        embed_threads=threads,
+    )
+
+
+def _payload_size(result):
+    if isinstance(result, str):
+        return len(result.encode('utf-8'))
+    if isinstance(result, dict):
+        return len(json.dumps(result, default=str).encode('utf-8'))
+    return None
+
+
+def measure(function, repeats):
+    """Median and min milliseconds, peak heap KiB and payload bytes of a call
+
+    Returns the measurements and the result of the call.
+    """
+    result = function()  # warm-up; also gives the payload
+    times = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - started) * 1000)
+    # Measured on a separate call: tracing allocations slows everything down
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    function()
+    peak = tracemalloc.get_traced_memory()[1] - before
+    if not tracing:
+        tracemalloc.stop()
+    return {
+        'median_ms': round(statistics.median(times), 3),
+        'min_ms': round(min(times), 3),
+        'peak_kb': round(max(peak, 0) / 1024, 1),
+        'payload_bytes': _payload_size(result),
+    }, result
+
+
+def _stage_calls(service, row):
+    # Stage name -> zero-argument callable, in pipeline order; later stages
+    # reuse one 3D molecule so they do not re-embed
+    smiles, name = row['smiles'], row['name']
+    calls = {
+        'resolve_smiles': lambda: service.parse_chemical_input(smiles),
+        'resolve_name': lambda: service.parse_chemical_input(name),
+        'resolve_llm': lambda: service.resolve_with_llm(name),
+        'structure_3d': lambda: service.create_molecule_from_smiles(smiles),
+    }
+    mol = []
+
+    def built():
+        if not mol:
+            mol.append(service.create_molecule_from_smiles(smiles))
+        return mol[0]
+
+    calls['properties'] = lambda: service.get_molecule_properties(built())
+    calls['render_3d'] = lambda: service.visualize_molecule_3d(built())
+    return calls
+
+
+def run_benchmarks(corpus, stages=STAGES, repeats=3, threads=1, progress=None):
+    """Measurements for every corpus row and stage, as a list of dicts"""
+    service = make_service(corpus, threads)
+    results = []
+    for row in corpus:
+        calls = _stage_calls(service, row)
+        for stage in stages:
+            measurement, result = measure(calls[stage], repeats)
+            if stage == 'structure_3d':
+                # A fallback to random coordinates or 2D is a regression on its own
+                measurement['embedding'] = result.GetProp('embedding') if result is not None else None
+            results.append({'tier': row['tier'], 'molecule': row['name'], 'stage': stage, **measurement})
+            if progress:
+                progress(results[-1])
+    return results
+
+
+_STARTUP_SCRIPT = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+from streamlit.testing.v1 import AppTest
+from telemetry import metrics
+started = time.perf_counter()
+AppTest.from_file({app!r}, default_timeout=120).run()
+first_run = time.perf_counter() - started
+paint = [h['sum'] for h in metrics.snapshot()['histograms'] if h['labels'].get('stage') == 'first_paint']
+started = time.perf_counter()
+import service
+print(json.dumps({{'first_paint': paint[0] * 1000, 'first_run': first_run * 1000,
+                  'import_service': (time.perf_counter() - started) * 1000}}))
+"""
+
+
+def measure_startup(stages=STARTUP_STAGES, repeats=3, progress=None):
+    """Cold-start timings of the app, one fresh interpreter per repeat"""
+    script = _STARTUP_SCRIPT.format(root=ROOT, app=os.path.join(ROOT, 'app.py'))
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                                cwd=ROOT).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    results = []
+    for stage in stages:
+        times = [run[stage] for run in runs]
+        results.append({'tier': 'startup', 'molecule': 'app', 'stage': stage,
+                        'median_ms': round(statistics.median(times), 3), 'min_ms': round(min(times), 3),
+                        'peak_kb': None, 'payload_bytes': None})
+        if progress:
+            progress(results[-1])
+    return results
+
+
+def environment(repeats, threads):
+    """What a run was measured on; timings only compare within one environment"""
+    return {
+        'python': platform.python_version(),
+        'rdkit': rdBase.rdkitVersion,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'repeats': repeats,
+        'threads': threads,
+    }
+
+
+def compare(results, baseline, thresholds=None):
+    """Rows of ``results`` with their baseline values and any regressions found
+
+    Each row gets ``baseline_ms`` and a ``regressions`` list naming the
+    metrics that grew beyond their threshold (or ``embedding`` when a 3D
+    build fell back to a worse path); stages missing from the baseline are
+    marked ``new``.
+    """
+    thresholds = {**DEFAULT_THRESHOLDS, **(thresholds or {})}
+    previous = {(r['molecule'], r['stage']): r for r in baseline.get('results', [])}
+    compared = []
+    for row in results:
+        old = previous.get((row['molecule'], row['stage']))
+        row = dict(row, regressions=[])
+        if old is None:
+            row['new'] = True
+            compared.append(row)
+            continue
+        row['baseline_ms'] = old['median_ms']
+        # The fastest run is the least disturbed by other load on the machine
+        slowdown = row['min_ms'] - old['min_ms']
+        if slowdown > old['min_ms'] * thresholds['time'] and slowdown > thresholds['time_slack_ms']:
+            row['regressions'].append('time')
+        growth = (row['peak_kb'] or 0) - (old['peak_kb'] or 0)
+        if growth > (old['peak_kb'] or 0) * thresholds['memory'] and growth > thresholds['memory_slack_kb']:
+            row['regressions'].append('memory')
+        if row['payload_bytes'] is not None and old.get('payload_bytes') is not None \
+                and row['payload_bytes'] > old['payload_bytes'] * (1 + thresholds['payload']):
+            row['regressions'].append('payload')
+        if _EMBEDDING_RANK.get(row.get('embedding'), 0) < _EMBEDDING_RANK.get(old.get('embedding'), 0):
+            row['regressions'].append('embedding')
+        compared.append(row)
+    return compared
+
+
+def _report_line(row):
+    change = ''
+    if row.get('baseline_ms'):
+        change = f"{(row['median_ms'] / row['baseline_ms'] - 1) * 100:+.0f}%"
+    payload = row['payload_bytes'] if row['payload_bytes'] is not None else row.get('embedding') or '-'
+    peak = f"{row['peak_kb']:.1f}" if row['peak_kb'] is not None else '-'
+    flags = 'NEW' if row.get('new') else ' '.join(r.upper() for r in row.get('regressions', []))
+    return (f"{row['tier']:<11} {row['molecule']:<15} {row['stage']:<15} {row['median_ms']:>10.2f} "
+            f"{change:>6} {peak:>9} {payload:>9}  {flags}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark resolution, 3D build, descriptors and rendering")
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save', action='store_true', help="Store this run as the baseline instead of comparing")
+    parser.add_argument('--tier', action='append', choices=TIERS + ('startup',),
+                        help="Only these tiers (repeatable)")
+    parser.add_argument('--stage', action='append', choices=STAGES + STARTUP_STAGES,
+                        help="Only these stages (repeatable)")
+    parser.add_argument('--repeats', type=int, default=3, help="Timed runs per stage after the warm-up")
+    parser.add_argument('--threads', type=int, default=1, help="Embedding threads")
+    parser.add_argument('--time-threshold', type=float, default=DEFAULT_THRESHOLDS['time'],
+                        help="Allowed slowdown as a fraction of the baseline")
+    parser.add_argument('--memory-threshold', type=float, default=DEFAULT_THRESHOLDS['memory'])
+    parser.add_argument('--payload-threshold', type=float, default=DEFAULT_THRESHOLDS['payload'])
+    parser.add_argument('-o', '--output', help="Also write the results as JSON")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    # Local data would change what the resolvers do between machines
+    os.environ.pop('CHEMVIZ_COMPOUND_DICT', None)
+
+    corpus = [row for row in read_corpus(args.corpus) if not args.tier or row['tier'] in args.tier]
+    print(f"{'tier':<11} {'molecule':<15} {'stage':<15} {'median ms':>10} {'':>6} {'peak KiB':>9} {'bytes':>9}")
+    def report(row):
+        print(_report_line(row), flush=True)
+
+    stages = [stage for stage in args.stage or STAGES if stage in STAGES]
+    results = run_benchmarks(corpus, stages=stages, repeats=args.repeats, threads=args.threads, progress=report)
+    if not args.tier or 'startup' in args.tier:
+        stages = [stage for stage in args.stage or STARTUP_STAGES if stage in STARTUP_STAGES]
+        results += measure_startup(stages, repeats=args.repeats, progress=report)
+    run = {'environment': environment(args.repeats, args.threads), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(run, handle, indent=2)
+
+    if args.save or not os.path.exists(args.baseline):
+        with open(args.baseline, 'w') as handle:
+            json.dump(run, handle, indent=2)
+            handle.write('\n')
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+
+    with open(args.baseline) as handle:
+        baseline = json.load(handle)
+    if baseline.get('environment') != run['environment']:
+        print("\nWarning: the baseline was recorded in a different environment; timings may not compare:\n"
+              f"  baseline {baseline.get('environment')}\n  this run {run['environment']}")
+    thresholds = {'time': args.time_threshold, 'memory': args.memory_threshold, 'payload': args.payload_threshold}
+    compared = compare(results, baseline, thresholds)
+    regressions = [row for row in compared if row['regressions']]
+    print(f"\nCompared with {args.baseline}")
+    for row in regressions:
+        print("REGRESSION " + _report_line(row))
+    if regressions:
+        print(f"{len(regressions)} of {len(compared)} stages regressed")
+        return 1
+    print(f"No regressions in {len(compared)} stages")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+"""Persistent SQLite cache for resolved molecule records
+
+Records are stored once per molecule (keyed by InChIKey, or canonical SMILES
+when no InChIKey can be computed) and every normalized query that resolved to
+that molecule is stored as an alias, so "caffeine", "Caffeine " and
+"1,3,7-trimethylxanthine" share one entry. Entries are evicted least recently
+used first once the size cap is reached, and expire after a TTL.
+
+Lookups never write: an expired entry is a miss and is removed by the next
+``put`` along with the least recently used ones. Hit/miss counters and last-access times are kept in
+memory and written in one transaction at most every FLUSH_INTERVAL seconds,
+before an eviction, and on ``flush``/``close``, so read-heavy traffic does
+not queue on SQLite's single writer lock.
+"""
+import atexit
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+import weakref
+
+from rdkit import Chem, rdBase
+
+from resolver import normalize_name
+
+DEFAULT_MAX_ENTRIES = 50000
+DEFAULT_TTL_SECONDS = 30 * 24 * 3600
+# Seconds between writes of buffered counters and access times
+FLUSH_INTERVAL = 5.0
+
+
+def default_cache_dir():
+    """Directory for ChemViz caches, overridable with CHEMVIZ_CACHE_DIR"""
+    path = os.getenv('CHEMVIZ_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'chemviz')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def open_database(path):
+    """Open a SQLite database that can be shared by threads and processes"""
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def canonical_keys(smiles):
+    """Return (canonical SMILES, InChIKey) for a SMILES string, or (None, None)"""
+    with rdBase.BlockLogs():
+        mol = Chem.MolFromSmiles(smiles) if smiles else None
+        if mol is None:
+            return None, None
+        return Chem.MolToSmiles(mol), Chem.MolToInchiKey(mol) or None
+
+
+class ResolutionCache:
+    """Map normalized user input to resolved records, shared across sessions"""
+
+    def __init__(self, path=None, max_entries=None, ttl_seconds=None):
+        self.path = path or os.path.join(default_cache_dir(), 'resolution.sqlite3')
+        self.max_entries = max_entries or int(os.getenv('CHEMVIZ_RESOLUTION_CACHE_SIZE', DEFAULT_MAX_ENTRIES))
+        self.ttl_seconds = ttl_seconds or float(os.getenv('CHEMVIZ_RESOLUTION_CACHE_TTL', DEFAULT_TTL_SECONDS))
+        self._lock = threading.Lock()
+        self._conn = open_database(self.path)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS molecules (
+                key TEXT PRIMARY KEY,
+                canonical_smiles TEXT NOT NULL,
+                inchikey TEXT,
+                record TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS molecules_smiles ON molecules (canonical_smiles);
+            CREATE INDEX IF NOT EXISTS molecules_accessed ON molecules (accessed_at);
+            CREATE INDEX IF NOT EXISTS molecules_created ON molecules (created_at);
+            CREATE TABLE IF NOT EXISTS aliases (
+                query TEXT PRIMARY KEY,
+                key TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS aliases_key ON aliases (key);
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+        self.hits = 0
+        self.misses = 0
+        self._counts = collections.Counter()
+        self._touched = {}
+        self._flushed_at = time.monotonic()
+        atexit.register(_flush_at_exit, weakref.ref(self))
+
+    def get(self, user_input):
+        """Return the cached record for a query, or None on a miss"""
+        query = normalize_name(user_input)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT m.key, m.record, m.created_at FROM aliases a "
+                "JOIN molecules m ON m.key = a.key WHERE a.query = ?", (query,)
+            ).fetchone()
+            if row is not None and row[2] < time.time() - self.ttl_seconds:
+                row = None
+            self._count('hits' if row else 'misses')
+            if row is not None:
+                self._touched[row[0]] = time.time()
+            if time.monotonic() - self._flushed_at >= FLUSH_INTERVAL:
+                self._flush()
+        if row is None:
+            return None
+        record = json.loads(row[1])
+        record['cached'] = True
+        return record
+
+    def get_by_smiles(self, smiles):
+        """Look up a record by canonical SMILES or InChIKey of any SMILES"""
+        canonical, inchikey = canonical_keys(smiles)
+        if canonical is None:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT record FROM molecules WHERE key = ? OR canonical_smiles = ? LIMIT 1",
+                (inchikey or canonical, canonical)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, user_input, record):
+        """Store a resolved record and alias the query to it"""
+        canonical, inchikey = canonical_keys(record.get('smiles'))
+        if canonical is None:
+            return
+        key = inchikey or canonical
+        record = {k: v for k, v in record.items() if k != 'cached'}
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO molecules (key, canonical_smiles, inchikey, record, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+                    "record = excluded.record, created_at = excluded.created_at, accessed_at = excluded.accessed_at",
+                    (key, canonical, inchikey, json.dumps(record), now, now)
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO aliases (query, key) VALUES (?, ?)",
+                    (normalize_name(user_input), key)
+                )
+                # Eviction must see recent accesses
+                self._write_pending()
+                self._evict()
+                self._conn.execute("COMMIT")
+                self._counts.clear()
+                self._touched.clear()
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def queries(self, limit=50000):
+        """Most recently used queries, e.g. to seed typeahead suggestions"""
+        with self._lock:
+            self._flush()
+            rows = self._conn.execute(
+                "SELECT a.query FROM aliases a JOIN molecules m ON m.key = a.key "
+                "ORDER BY m.accessed_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [query for (query,) in rows]
+
+    def stats(self):
+        """Hit/miss counters for this process and in total, plus current size"""
+        with self._lock:
+            self._flush()
+            counters = dict(self._conn.execute("SELECT name, value FROM counters").fetchall())
+            entries = self._conn.execute("SELECT COUNT(*) FROM molecules").fetchone()[0]
+            aliases = self._conn.execute("SELECT COUNT(*) FROM aliases").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'total_hits': counters.get('hits', 0),
+            'total_misses': counters.get('misses', 0),
+            'entries': entries,
+            'aliases': aliases,
+            'max_entries': self.max_entries,
+            'size_bytes': os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+        }
+
+    def clear(self):
+        """Drop every cached record"""
+        with self._lock:
+            self._conn.execute("DELETE FROM aliases")
+            self._conn.execute("DELETE FROM molecules")
+            self._touched.clear()
+
+    def flush(self):
+        """Write buffered counters and access times now"""
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """Flush and close the database connection"""
+        with self._lock:
+            self._flush()
+            self._conn.close()
+
+    def _count(self, name):
+        setattr(self, name, getattr(self, name) + 1)
+        self._counts[name] += 1
+
+    def _flush(self):
+        # Caller holds the lock; a failed write keeps the buffers for next time
+        if not self._counts and not self._touched:
+            self._flushed_at = time.monotonic()
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._write_pending()
+            self._conn.execute("COMMIT")
+            self._counts.clear()
+            self._touched.clear()
+        except sqlite3.Error:
+            self._conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._flushed_at = time.monotonic()
+
+    def _write_pending(self):
+        # Inside the caller's transaction, which clears the buffers once committed
+        self._conn.executemany(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", list(self._counts.items())
+        )
+        self._conn.executemany(
+            "UPDATE molecules SET accessed_at = MAX(accessed_at, ?) WHERE key = ?",
+            [(accessed, key) for key, accessed in self._touched.items()]
+        )
+
+    def _delete_molecule(self, key):
+        self._conn.execute("DELETE FROM aliases WHERE key = ?", (key,))
+        self._conn.execute("DELETE FROM molecules WHERE key = ?", (key,))
+
+    def _evict(self):
+        # Expired molecules go first, then the least recently used, together with their aliases
+        expired = self._conn.execute(
+            "SELECT key FROM molecules WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+        ).fetchall()
+        for (key,) in expired:
+            self._delete_molecule(key)
+        excess = self._conn.execute("SELECT COUNT(*) FROM molecules").fetchone()[0] - self.max_entries
+        if excess <= 0:
+            return
+        keys = self._conn.execute(
+            "SELECT key FROM molecules ORDER BY accessed_at LIMIT ?", (excess,)
+        ).fetchall()
+        for (key,) in keys:
+            self._delete_molecule(key)
+
+
+def _flush_at_exit(ref):
+    cache = ref()
+    if cache is not None:
+        try:
+            cache.flush()
+        except sqlite3.Error:
+            pass
@@ -0,0 +1,194 @@
+"""Compare many molecules in one viewer: parallel alignment onto a reference
+
+Analogs are drawn together in a single 3Dmol.js viewer
+(``viewer.comparison_html``), laid out on a grid or overlaid, rather than one
+iframe and WebGL context per molecule. To make them comparable every molecule
+is first aligned onto a reference with RDKit's Open3DAlign (O3A), using MMFF
+atom types and charges and falling back to Crippen contributions where MMFF
+has no parameters. Each alignment is scored by the shape Tanimoto similarity
+of the aligned pair.
+
+Alignments are independent of each other, so they run in batches on a
+spawned process pool (CHEMVIZ_ALIGN_WORKERS) once there are enough of them
+to pay for starting it; a handful is aligned in-process.
+
+Usage:
+    python comparison.py "OC(=O)c1ccccc1O" "CC(=O)Oc1ccccc1C(=O)O" "NC(=O)c1ccccc1O"
+    python comparison.py --overlay --html compare.html aspirin.smi
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from rdkit import Chem, rdBase
+from rdkit.Chem import AllChem, rdMolAlign, rdShapeHelpers
+from rdkit.Geometry import Point3D
+
+from telemetry import span
+
+# Fewer probes than this are aligned in-process
+INLINE_LIMIT = 8
+# Probes sent to a worker at a time
+ALIGN_BATCH = 16
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def default_workers():
+    """Alignment processes from CHEMVIZ_ALIGN_WORKERS; 0 means every core"""
+    return int(os.getenv('CHEMVIZ_ALIGN_WORKERS', 0)) or os.cpu_count() or 1
+
+
+def _get_pool():
+    # Spawned rather than forked: the caller may be a threaded server
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(default_workers(), mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def _mmff_properties(mol):
+    with rdBase.BlockLogs():
+        return AllChem.MMFFGetMoleculeProperties(mol)
+
+
+def align_pair(reference, probe, reference_properties=None):
+    """Align ``probe`` onto ``reference`` in place; ``{method, score, rmsd, shape}``
+
+    ``reference_properties`` are the reference's MMFF properties, if already
+    computed. ``shape`` is the shape Tanimoto similarity after alignment.
+    """
+    probe_properties = _mmff_properties(probe)
+    if reference_properties is None:
+        reference_properties = _mmff_properties(reference)
+    with rdBase.BlockLogs():
+        if probe_properties is not None and reference_properties is not None:
+            method = 'mmff'
+            o3a = rdMolAlign.GetO3A(probe, reference, probe_properties, reference_properties)
+        else:
+            method = 'crippen'
+            o3a = rdMolAlign.GetCrippenO3A(probe, reference)
+        rmsd = o3a.Align()
+        shape = 1.0 - rdShapeHelpers.ShapeTanimotoDist(reference, probe)
+    return {'method': method, 'score': o3a.Score(), 'rmsd': rmsd, 'shape': shape}
+
+
+def align_batch(reference, items):
+    """``(index, positions, alignment)`` for ``(index, molecule)`` items aligned onto ``reference``
+
+    ``positions`` and ``alignment`` are None for a molecule that could not be
+    aligned.
+    """
+    reference_properties = _mmff_properties(reference)
+    aligned = []
+    for index, probe in items:
+        # The caller's molecules may be shared with other sessions
+        probe = Chem.Mol(probe)
+        try:
+            alignment = align_pair(reference, probe, reference_properties)
+        except (RuntimeError, ValueError):
+            aligned.append((index, None, None))
+            continue
+        aligned.append((index, probe.GetConformer().GetPositions(), alignment))
+    return aligned
+
+
+def align_molecules(molecules, reference=0, workers=None):
+    """Copies of ``molecules`` aligned onto ``molecules[reference]``, in order
+
+    Each copy carries ``alignment`` (``reference``, ``mmff``, ``crippen`` or
+    ``none`` when alignment failed) and, once aligned, its O3A ``o3a_score``,
+    ``rmsd`` and ``shape_similarity`` as properties.
+    """
+    workers = default_workers() if workers is None else workers
+    target = molecules[reference]
+    probes = [(i, mol) for i, mol in enumerate(molecules) if i != reference]
+    results = {}
+    with span('compare.align', molecules=len(molecules)) as stage:
+        if workers > 1 and len(probes) >= INLINE_LIMIT:
+            size = max(1, min(ALIGN_BATCH, -(-len(probes) // workers)))
+            pool = _get_pool()
+            futures = [pool.submit(align_batch, target, probes[start:start + size])
+                       for start in range(0, len(probes), size)]
+            for future in futures:
+                for index, positions, alignment in future.result():
+                    results[index] = (positions, alignment)
+            stage.set(workers=min(workers, len(futures)), batches=len(futures))
+        else:
+            for index, positions, alignment in align_batch(target, probes):
+                results[index] = (positions, alignment)
+        stage.set(failed=sum(1 for positions, _ in results.values() if positions is None))
+
+    aligned = []
+    for i, mol in enumerate(molecules):
+        mol = Chem.Mol(mol)
+        if i == reference:
+            mol.SetProp('alignment', 'reference')
+        elif results[i][0] is None:
+            mol.SetProp('alignment', 'none')
+        else:
+            positions, alignment = results[i]
+            conformer = mol.GetConformer()
+            for atom, (x, y, z) in enumerate(positions):
+                conformer.SetAtomPosition(atom, Point3D(x, y, z))
+            mol.SetProp('alignment', alignment['method'])
+            mol.SetDoubleProp('o3a_score', alignment['score'])
+            mol.SetDoubleProp('rmsd', alignment['rmsd'])
+            mol.SetDoubleProp('shape_similarity', alignment['shape'])
+        aligned.append(mol)
+    return aligned
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Align molecules onto the first one and compare them")
+    parser.add_argument('molecules', nargs='+', help="SMILES, or files with one SMILES per line")
+    parser.add_argument('--overlay', action='store_true', help="Overlay the molecules instead of a grid")
+    parser.add_argument('--html', help="Write a viewer document with every molecule to this file")
+    parser.add_argument('--workers', type=int, help="Alignment processes (default: CHEMVIZ_ALIGN_WORKERS)")
+    args = parser.parse_args(argv)
+
+    from conformers import build_3d_molecule
+
+    inputs = []
+    for item in args.molecules:
+        if os.path.isfile(item):
+            with open(item) as handle:
+                inputs.extend(line.split()[0] for line in handle if line.strip())
+        else:
+            inputs.append(item)
+    labels, molecules = [], []
+    for smiles in inputs:
+        mol = build_3d_molecule(smiles)
+        if mol is None:
+            sys.stderr.write(f"Could not build {smiles}\n")
+            continue
+        labels.append(smiles)
+        molecules.append(mol)
+    if not molecules:
+        return 1
+
+    aligned = align_molecules(molecules, workers=args.workers)
+    for label, mol in zip(labels, aligned):
+        if mol.HasProp('shape_similarity'):
+            print(f"{mol.GetProp('alignment'):9s} shape {mol.GetDoubleProp('shape_similarity'):.3f} "
+                  f"rmsd {mol.GetDoubleProp('rmsd'):.2f}  {label}")
+        else:
+            print(f"{mol.GetProp('alignment'):9s} {'':22s}  {label}")
+    if args.html:
+        from service import ChemVizService
+
+        service = ChemVizService(cache=None, conformer_store=None, use_llm=False, offline=True)
+        html = service.visualize_comparison(aligned, labels, layout='overlay' if args.overlay else 'grid')
+        with open(args.html, 'w') as handle:
+            handle.write(html)
+        sys.stderr.write(f"Wrote {len(html)} bytes to {args.html}\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+"""Offline compound dictionary backed by a memory-mapped sorted index
+
+A dictionary is built once from a CSV/TSV we supply (name, SMILES and
+optionally CID, formula, IUPAC name and ``|``-separated synonyms) into a
+directory of flat files:
+
+    keys.bin / key_offsets.npy     sorted UTF-8 lookup keys and their offsets
+    key_targets.npy                record index for each key
+    records.bin / record_offsets.npy   JSON records
+
+Everything is memory-mapped on open, so loading takes milliseconds and the
+pages are shared between worker processes through the OS page cache instead
+of being copied into each one. Lookups are a binary search over the keys.
+
+Usage:
+    python compound_dictionary.py build compounds.csv data/compounds
+    python compound_dictionary.py lookup data/compounds caffeine
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+
+import numpy as np
+from rdkit import Chem, rdBase
+from rdkit.Chem import rdMolDescriptors
+
+from resolver import normalize_name, parse_formula
+
+# Formula keys sort before every name and can never be typed as a prefix
+FORMULA_PREFIX = '\x00formula:'
+
+
+def formula_key(counts):
+    """Order-independent lookup key for parsed formula element counts"""
+    return FORMULA_PREFIX + ''.join(f"{element}{counts[element]}" for element in sorted(counts))
+
+
+def _write_strings(directory, data_file, offsets_file, strings):
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    with open(os.path.join(directory, data_file), 'wb') as handle:
+        for i, value in enumerate(strings):
+            data = value.encode('utf-8')
+            handle.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+    np.save(os.path.join(directory, offsets_file), offsets)
+
+
+def _map_bytes(path):
+    # np.memmap refuses empty files
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+def build_dictionary(source, directory):
+    """Build a dictionary directory from a CSV/TSV of compounds; returns counts"""
+    os.makedirs(directory, exist_ok=True)
+    delimiter = '\t' if source.lower().endswith('.tsv') else ','
+    records = []
+    keys = {}
+    with open(source, newline='', encoding='utf-8') as handle, rdBase.BlockLogs():
+        for row in csv.DictReader(handle, delimiter=delimiter):
+            row = {k.strip().lower(): (v or '').strip() for k, v in row.items() if k}
+            mol = Chem.MolFromSmiles(row.get('smiles', ''))
+            if mol is None or not row.get('name'):
+                continue
+            formula = row.get('formula') or rdMolDescriptors.CalcMolFormula(mol)
+            index = len(records)
+            records.append(json.dumps({
+                'smiles': Chem.MolToSmiles(mol),
+                'iupac_name': row.get('iupac_name') or None,
+                'common_name': row['name'],
+                'molecular_formula': formula,
+                'pubchem_cid': int(row['cid']) if row.get('cid') else None,
+            }))
+            # Earlier rows win when names, synonyms or formulas collide
+            names = [row['name']] + [s for s in row.get('synonyms', '').split('|') if s.strip()]
+            for name in names:
+                keys.setdefault(normalize_name(name), index)
+            counts = parse_formula(formula)
+            if counts:
+                keys.setdefault(formula_key(counts), index)
+
+    ordered = sorted(keys, key=lambda key: key.encode('utf-8'))
+    _write_strings(directory, 'keys.bin', 'key_offsets.npy', ordered)
+    np.save(os.path.join(directory, 'key_targets.npy'), np.array([keys[k] for k in ordered], dtype=np.int32))
+    _write_strings(directory, 'records.bin', 'record_offsets.npy', records)
+    return {'records': len(records), 'keys': len(ordered)}
+
+
+class CompoundDictionary:
+    """Read-only, memory-mapped name/synonym/formula → compound index"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._keys = _map_bytes(os.path.join(directory, 'keys.bin'))
+        self._key_offsets = np.load(os.path.join(directory, 'key_offsets.npy'), mmap_mode='r')
+        self._key_targets = np.load(os.path.join(directory, 'key_targets.npy'), mmap_mode='r')
+        self._records = _map_bytes(os.path.join(directory, 'records.bin'))
+        self._record_offsets = np.load(os.path.join(directory, 'record_offsets.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self._record_offsets) - 1
+
+    def key(self, i):
+        """Lookup key at sorted position ``i``"""
+        return self._keys[self._key_offsets[i]:self._key_offsets[i + 1]].tobytes().decode('utf-8')
+
+    def record(self, index):
+        """Compound record by record index"""
+        data = self._records[self._record_offsets[index]:self._record_offsets[index + 1]].tobytes()
+        return json.loads(data)
+
+    def get(self, name):
+        """Record for an exact (normalized) name, synonym or formula key, or None"""
+        target = normalize_name(name) if not name.startswith(FORMULA_PREFIX) else name
+        i = self._bisect(target.encode('utf-8'))
+        if i < len(self._key_targets) and self.key(i) == target:
+            return self.record(int(self._key_targets[i]))
+        return None
+
+    def prefix(self, prefix, limit=10):
+        """Yield ``(key, record index)`` for keys starting with a normalized prefix"""
+        prefix = normalize_name(prefix)
+        if not prefix:
+            return
+        i = self._bisect(prefix.encode('utf-8'))
+        while i < len(self._key_targets) and limit > 0:
+            key = self.key(i)
+            if not key.startswith(prefix):
+                break
+            yield key, int(self._key_targets[i])
+            limit -= 1
+            i += 1
+
+    def resolve(self, user_input):
+        """Resolver tier: look up a name, synonym or molecular formula"""
+        record = self.get(user_input)
+        if record is None:
+            counts = parse_formula(user_input)
+            if counts:
+                record = self.get(formula_key(counts))
+        if record is None:
+            return None
+        record['description'] = f"Chemical compound: {record['common_name']}"
+        return record
+
+    def _bisect(self, target):
+        lo, hi = 0, len(self._key_targets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._keys[self._key_offsets[mid]:self._key_offsets[mid + 1]].tobytes() < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+_dictionary = None
+
+
+def get_dictionary():
+    """Process-wide dictionary from CHEMVIZ_COMPOUND_DICT, or None if unset"""
+    global _dictionary
+    path = os.getenv('CHEMVIZ_COMPOUND_DICT')
+    if _dictionary is None and path and os.path.isdir(path):
+        _dictionary = CompoundDictionary(path)
+    return _dictionary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query the offline compound dictionary")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help="Build a dictionary from a CSV/TSV")
+    build.add_argument('source')
+    build.add_argument('directory')
+    lookup = commands.add_parser('lookup', help="Look up a name or formula")
+    lookup.add_argument('directory')
+    lookup.add_argument('query')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        counts = build_dictionary(args.source, args.directory)
+        sys.stderr.write(f"Wrote {counts['records']} compounds under {counts['keys']} keys to {args.directory}\n")
+        return 0
+    record = CompoundDictionary(args.directory).resolve(args.query)
+    print(json.dumps(record, indent=2) if record else "Not found")
+    return 0 if record else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
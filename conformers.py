@@ -0,0 +1,263 @@
+"""3D conformer generation with a persistent coordinate store
+
+Embedding and force-field optimization are deterministic for a given
+canonical SMILES and parameter set, so the resulting coordinates are stored
+once as float32 arrays in SQLite and reused by every session and process. The
+molecule is rebuilt from the canonical SMILES (which fixes the atom order) and
+the stored coordinates, without re-embedding.
+
+Coordinates come from the adaptive embedding engine in ``embedding``; the
+path it took (``etkdg``, ``random_coords`` or ``2d``) is kept with them and
+set on every returned molecule as the ``embedding`` property. Only ETKDG
+results are stored: random-coordinate and flat 2D fallbacks come from a run
+that ran short of time, so the next request tries ETKDG again.
+
+Concurrent builds of the same molecule and parameters embed once, wherever
+they come from (``singleflight``). ``EmbeddingJobs`` runs builds in the
+background so callers can show everything else while a large molecule embeds.
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from rdkit import Chem, rdBase
+from rdkit.Geometry import Point3D
+
+from cache import default_cache_dir, open_database
+from embedding import embed_smiles
+from singleflight import Cancelled, flights
+from telemetry import span
+
+DEFAULT_MAX_MB = 256
+
+# Parameters that determine the generated coordinates; part of the store key
+DEFAULT_EMBED_PARAMS = {
+    'method': 'ETKDG',
+    'random_seed': 42,
+    'force_field': 'MMFF',
+}
+
+
+def canonical_smiles(smiles):
+    """Canonical SMILES for a SMILES string, or None if it does not parse"""
+    with rdBase.BlockLogs():
+        mol = Chem.MolFromSmiles(smiles) if smiles else None
+    return Chem.MolToSmiles(mol) if mol is not None else None
+
+
+def mol_from_coordinates(smiles, coords, embedding='etkdg'):
+    """Rebuild a hydrogen-complete molecule from canonical SMILES and coordinates"""
+    mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+    if mol.GetNumAtoms() != len(coords):
+        return None
+    conf = Chem.Conformer(mol.GetNumAtoms())
+    for idx, (x, y, z) in enumerate(coords.tolist()):
+        conf.SetAtomPosition(idx, Point3D(x, y, z))
+    conf.Set3D(embedding != '2d')
+    mol.AddConformer(conf, assignId=True)
+    mol.SetProp('embedding', embedding)
+    return mol
+
+
+class ConformerStore:
+    """Size-capped store of float32 conformer coordinates keyed by SMILES and parameters"""
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path or os.path.join(default_cache_dir(), 'conformers.sqlite3')
+        self.max_bytes = max_bytes or int(float(os.getenv('CHEMVIZ_CONFORMER_CACHE_MB', DEFAULT_MAX_MB)) * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._conn = open_database(self.path)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS conformers (
+                canonical_smiles TEXT NOT NULL,
+                params TEXT NOT NULL,
+                num_atoms INTEGER NOT NULL,
+                coords BLOB NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (canonical_smiles, params)
+            );
+            CREATE INDEX IF NOT EXISTS conformers_accessed ON conformers (accessed_at);
+        """)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(conformers)")}
+        if 'embedding' not in columns:
+            # Stores created before adaptive embedding hold plain ETKDG coordinates
+            self._conn.execute("ALTER TABLE conformers ADD COLUMN embedding TEXT NOT NULL DEFAULT 'etkdg'")
+        self.hits = 0
+        self.misses = 0
+
+    def get_coordinates(self, smiles, params=None):
+        """Return an (N, 3) float32 array for a canonical SMILES, or None"""
+        entry = self._lookup(smiles, params)
+        return entry[0] if entry else None
+
+    def get(self, smiles, params=None):
+        """Rebuild the stored molecule for a canonical SMILES, or None"""
+        entry = self._lookup(smiles, params)
+        if entry is None:
+            return None
+        return mol_from_coordinates(smiles, *entry)
+
+    def put(self, smiles, mol, params=None):
+        """Store the first conformer of a molecule built from a canonical SMILES"""
+        coords = np.ascontiguousarray(mol.GetConformer().GetPositions(), dtype=np.float32)
+        embedding = mol.GetProp('embedding') if mol.HasProp('embedding') else 'etkdg'
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO conformers (canonical_smiles, params, num_atoms, coords, accessed_at, embedding) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (smiles, self._params_key(params), len(coords), coords.tobytes(), time.time(), embedding)
+            )
+            self._evict()
+
+    def stats(self):
+        """Hit/miss counters and current size of the store"""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(coords)), 0) FROM conformers"
+            ).fetchone()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': entries,
+            'coordinate_bytes': size,
+            'max_bytes': self.max_bytes,
+        }
+
+    def _lookup(self, smiles, params):
+        # (coordinates, embedding path) or None
+        key = (smiles, self._params_key(params))
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT num_atoms, coords, embedding FROM conformers "
+                "WHERE canonical_smiles = ? AND params = ? AND embedding = 'etkdg'", key
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE conformers SET accessed_at = ? WHERE canonical_smiles = ? AND params = ?",
+                (time.time(),) + key
+            )
+        return np.frombuffer(row[1], dtype=np.float32).reshape(row[0], 3), row[2]
+
+    @staticmethod
+    def _params_key(params):
+        return json.dumps(params or DEFAULT_EMBED_PARAMS, sort_keys=True)
+
+    def _evict(self):
+        # Drop least recently used conformers until coordinates fit the cap
+        size = self._conn.execute("SELECT COALESCE(SUM(LENGTH(coords)), 0) FROM conformers").fetchone()[0]
+        if size <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT canonical_smiles, params, LENGTH(coords) FROM conformers ORDER BY accessed_at"
+        )
+        stale = []
+        for smiles, params, length in rows:
+            if size <= self.max_bytes:
+                break
+            stale.append((smiles, params))
+            size -= length
+        self._conn.executemany("DELETE FROM conformers WHERE canonical_smiles = ? AND params = ?", stale)
+
+
+def embedding_key(smiles, params=None):
+    """Single-flight key of the embedding of a canonical SMILES"""
+    return ('embed', smiles, ConformerStore._params_key(params))
+
+
+def build_3d_molecule(smiles, store=None, params=None, budget=None, threads=None, cancel=None):
+    """Return a 3D molecule for a SMILES, reusing stored coordinates when possible"""
+    canonical = canonical_smiles(smiles)
+    if canonical is None:
+        return None
+    if store is not None:
+        with span('conformer_store') as stage:
+            mol = store.get(canonical, params)
+            stage.set(cache_hit=mol is not None)
+        if mol is not None:
+            return mol
+
+    try:
+        # Callers may add conformers or properties, so waiters get their own copy
+        return flights.do(embedding_key(canonical, params),
+                          lambda: _embed_molecule(canonical, store, params, budget, threads, cancel),
+                          cancel=cancel, share=Chem.Mol)
+    except Cancelled:
+        return None
+
+
+def _embed_molecule(canonical, store, params, budget, threads, cancel):
+    params = params or DEFAULT_EMBED_PARAMS
+    positions, embedding = embed_smiles(canonical, seed=params['random_seed'], budget=budget,
+                                        threads=threads, cancel=cancel)
+    if positions is None:
+        if cancel is not None and cancel.is_set():
+            # Not a result: whoever else is waiting embeds it instead
+            raise Cancelled()
+        return None
+    # Rebuilt from canonical SMILES rather than the embedded molecule (whose
+    # aromaticity MMFF setup re-perceives) so descriptors match a store hit
+    mol = mol_from_coordinates(canonical, positions, embedding)
+    if store is not None and mol is not None and embedding == 'etkdg':
+        store.put(canonical, mol, params)
+    return mol
+
+
+class EmbeddingJobs:
+    """Background 3D builds shared by every session
+
+    Jobs are keyed by canonical SMILES, so concurrent requests for the same
+    molecule share one embedding. A job is cancelled once everyone who asked
+    for it has given up, which also kills an isolated embedding process.
+    """
+
+    def __init__(self, store=None, max_workers=2, threads=None):
+        self.store = store
+        self.threads = threads
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='chemviz-embed')
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def submit(self, smiles):
+        """Future for the 3D molecule of a SMILES; already done on a store hit"""
+        canonical = canonical_smiles(smiles)
+        mol = self.store.get(canonical) if self.store is not None and canonical else None
+        if canonical is None or mol is not None:
+            future = Future()
+            future.set_result(mol)
+            return future
+        with self._lock:
+            job = self._jobs.get(canonical)
+            if job is None:
+                cancel = threading.Event()
+                # Carry the caller's trace into the worker thread
+                future = self._executor.submit(contextvars.copy_context().run, build_3d_molecule, canonical,
+                                               self.store, threads=self.threads, cancel=cancel)
+                job = self._jobs[canonical] = {'future': future, 'cancel': cancel, 'waiters': 0}
+                future.add_done_callback(lambda done, key=canonical: self._finished(key, done))
+            job['waiters'] += 1
+            return job['future']
+
+    def cancel(self, future):
+        """Give up on a submitted job; it stops once nobody else is waiting"""
+        with self._lock:
+            for key, job in self._jobs.items():
+                if job['future'] is future:
+                    job['waiters'] -= 1
+                    if job['waiters'] <= 0:
+                        job['cancel'].set()
+                        future.cancel()
+                        del self._jobs[key]
+                    return
+
+    def _finished(self, key, future):
+        # A cancelled job may finish after a new one for the same key started
+        with self._lock:
+            if key in self._jobs and self._jobs[key]['future'] is future:
+                del self._jobs[key]
@@ -0,0 +1,193 @@
+"""Columnar molecular descriptor engine
+
+Descriptors are computed for many molecules at once into a pandas DataFrame
+of raw floats and integers, one column per descriptor (pandas is imported
+only then; single molecules get a plain dict). Only the requested
+columns are evaluated, large inputs can be split into chunks across a process
+pool, and display formatting (units, rounding) lives in ``format_properties``
+so it is applied only when values are shown.
+
+Usage:
+    python descriptors.py library.smi -o descriptors.parquet --set all --jobs 8
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from rdkit import Chem, rdBase
+from rdkit.Chem import Descriptors
+
+# Every RDKit descriptor, by RDKit's own name
+RDKIT_DESCRIPTORS = dict(Descriptors._descList)
+
+# Descriptors shown on the properties cards, in display order
+CORE_DESCRIPTORS = (
+    'MolWt', 'MolLogP', 'TPSA', 'NumRotatableBonds',
+    'NumHDonors', 'NumHAcceptors', 'HeavyAtomCount', 'RingCount',
+)
+
+DESCRIPTOR_SETS = {
+    'core': CORE_DESCRIPTORS,
+    'all': tuple(RDKIT_DESCRIPTORS),
+}
+
+INTEGER_DESCRIPTORS = {'HeavyAtomCount', 'RingCount', 'NHOHCount', 'NOCount'}
+
+# Display label and format for descriptors that appear in the UI
+DISPLAY_FORMATS = {
+    'MolWt': ('Molecular Weight', "{:.2f} g/mol"),
+    'MolLogP': ('LogP', "{:.2f}"),
+    'TPSA': ('TPSA', "{:.2f} Ų"),
+    'NumRotatableBonds': ('Rotatable Bonds', "{:d}"),
+    'NumHDonors': ('H-Bond Donors', "{:d}"),
+    'NumHAcceptors': ('H-Bond Acceptors', "{:d}"),
+    'HeavyAtomCount': ('Heavy Atoms', "{:d}"),
+    'RingCount': ('Rings', "{:d}"),
+}
+
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def is_integer_descriptor(name):
+    """Whether a descriptor is a count rather than a continuous value"""
+    return name in INTEGER_DESCRIPTORS or name.startswith(('Num', 'fr_'))
+
+
+def resolve_descriptor_names(descriptors):
+    """Expand a set name or list of names, rejecting unknown descriptors"""
+    if isinstance(descriptors, str):
+        if descriptors not in DESCRIPTOR_SETS:
+            raise ValueError(f"Unknown descriptor set: {descriptors}")
+        return list(DESCRIPTOR_SETS[descriptors])
+    names = list(descriptors)
+    unknown = [name for name in names if name not in RDKIT_DESCRIPTORS]
+    if unknown:
+        raise ValueError(f"Unknown descriptors: {', '.join(unknown)}")
+    return names
+
+
+def _as_mol(item):
+    if item is None or isinstance(item, Chem.Mol):
+        return item
+    with rdBase.BlockLogs():
+        return Chem.MolFromSmiles(item)
+
+
+def _compute_block(items, names):
+    """Fill one float64 array per descriptor; NaN marks unparseable molecules"""
+    columns = {name: np.full(len(items), np.nan) for name in names}
+    functions = [(name, RDKIT_DESCRIPTORS[name], columns[name]) for name in names]
+    for row, item in enumerate(items):
+        mol = _as_mol(item)
+        if mol is None:
+            continue
+        for name, function, column in functions:
+            try:
+                column[row] = function(mol)
+            except Exception:
+                pass
+    return columns
+
+
+def _compute_chunk(args):
+    smiles, names = args
+    return _compute_block(smiles, names)
+
+
+class DescriptorEngine:
+    """Compute a selectable set of descriptors for many molecules at once"""
+
+    def __init__(self, descriptors='core', n_jobs=1, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.columns = resolve_descriptor_names(descriptors)
+        self.n_jobs = n_jobs or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+
+    def compute(self, molecules, columns=None):
+        """Return a DataFrame with one row per molecule and one column per descriptor
+
+        ``molecules`` may hold RDKit molecules or SMILES strings. ``columns``
+        restricts the work to a subset; nothing else is evaluated.
+        """
+        import pandas as pd
+
+        names = resolve_descriptor_names(columns) if columns is not None else self.columns
+        items = list(molecules)
+        if self.n_jobs > 1 and len(items) > self.chunk_size:
+            blocks = self._compute_parallel(items, names)
+        else:
+            blocks = [_compute_block(items, names)]
+        data = {name: np.concatenate([block[name] for block in blocks]) for name in names}
+        frame = pd.DataFrame(data, columns=names)
+        for name in names:
+            if is_integer_descriptor(name):
+                frame[name] = frame[name].astype('Int64')
+        return frame
+
+    def compute_one(self, mol, columns=None):
+        """Raw descriptor values for a single molecule as a dict
+
+        Skips the DataFrame, so the app never needs pandas for its properties.
+        """
+        names = resolve_descriptor_names(columns) if columns is not None else self.columns
+        block = _compute_block([mol], names)
+        values = {}
+        for name in names:
+            value = float(block[name][0])
+            if np.isnan(value):
+                values[name] = None
+            else:
+                values[name] = int(value) if is_integer_descriptor(name) else value
+        return values
+
+    def _compute_parallel(self, items, names):
+        # Ship SMILES rather than molecules to keep worker pickling cheap
+        smiles = [Chem.MolToSmiles(item) if isinstance(item, Chem.Mol) else item for item in items]
+        chunks = [(smiles[i:i + self.chunk_size], names) for i in range(0, len(smiles), self.chunk_size)]
+        with ProcessPoolExecutor(max_workers=self.n_jobs) as pool:
+            return list(pool.map(_compute_chunk, chunks))
+
+
+def format_properties(values):
+    """Format raw descriptor values for display, keyed by display label"""
+    formatted = {}
+    for name, value in values.items():
+        label, template = DISPLAY_FORMATS.get(name, (name, "{:.3g}"))
+        if value is None:
+            formatted[label] = "N/A"
+        elif template.endswith("d}"):
+            formatted[label] = template.format(int(value))
+        else:
+            formatted[label] = template.format(float(value))
+    return formatted
+
+
+def main(argv=None):
+    from batch import column_error, read_inputs
+
+    parser = argparse.ArgumentParser(description="Compute descriptors for a molecule library")
+    parser.add_argument('input', help="SMILES file, CSV or SDF")
+    parser.add_argument('-o', '--output', required=True, help="Parquet file for the descriptor table")
+    parser.add_argument('--set', default='core', help="Descriptor set: core or all")
+    parser.add_argument('--descriptors', help="Comma-separated descriptor names (overrides --set)")
+    parser.add_argument('--column', help="CSV column holding SMILES")
+    parser.add_argument('--jobs', type=int, default=0, help="Worker processes (default: CPU count)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    error = column_error(args.input, args.column)
+    if error:
+        parser.error(error)
+
+    descriptors = args.descriptors.split(',') if args.descriptors else args.set
+    engine = DescriptorEngine(descriptors, n_jobs=args.jobs, chunk_size=args.chunk_size)
+    smiles = list(read_inputs(args.input, args.column))
+    frame = engine.compute(smiles)
+    frame.insert(0, 'smiles', smiles)
+    frame.to_parquet(args.output, index=False)
+    sys.stderr.write(f"Wrote {len(frame)} rows x {len(engine.columns)} descriptors to {args.output}\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
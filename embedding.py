@@ -0,0 +1,200 @@
+"""Adaptive 3D embedding with a wall-clock budget
+
+ETKDG settings are picked from the size and ring structure of the molecule:
+small molecules get a single conformer, medium ones and macrocycles a few
+conformers embedded and force-field optimized on all cores (RDKit's
+``numThreads``), keeping the lowest-energy one, and very large ones start from
+random coordinates with a capped iteration count.
+
+RDKit embedding cannot be interrupted, so every profile that can outrun the
+budget (medium, large and macrocycles) runs in a child process that is
+killed when the budget runs out. Only small molecules, at most 40 heavy
+atoms with no macrocycle, embed in-process: a single conformer of them takes
+well under a second. Conformer ensembles (``ensembles``) always run isolated. Embedding then falls back to random-coordinate ETKDG for the
+rest of the budget, and finally to a flat 2D layout, which always succeeds.
+The path taken is reported as ``etkdg``, ``random_coords`` or ``2d``.
+Callers may pass a ``threading.Event`` to abandon an embedding early, which
+also kills a running child process.
+"""
+import logging
+import multiprocessing
+import os
+import time
+
+from rdkit import Chem, rdBase
+from rdkit.Chem import AllChem
+
+from telemetry import span
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUDGET = 15.0
+MACROCYCLE_SIZE = 12
+# Profiles that embed in a child process so the budget can be enforced
+ISOLATED_PROFILES = ('medium', 'macrocycle', 'large')
+
+# ETKDG settings per molecule class; max_iterations 0 keeps RDKit's default
+# and num_confs is capped at the number of embedding threads
+PROFILES = {
+    'small': {'num_confs': 1, 'max_iterations': 0, 'random_coords': False, 'optimize_iters': 200},
+    'medium': {'num_confs': 4, 'max_iterations': 0, 'random_coords': False, 'optimize_iters': 500},
+    'macrocycle': {'num_confs': 8, 'max_iterations': 0, 'random_coords': False, 'optimize_iters': 1000},
+    'large': {'num_confs': 1, 'max_iterations': 200, 'random_coords': True, 'optimize_iters': 200},
+}
+FALLBACK_PROFILE = {'num_confs': 1, 'max_iterations': 100, 'random_coords': True, 'optimize_iters': 100}
+
+
+def choose_profile(mol):
+    """Name of the ETKDG profile for a molecule"""
+    heavy_atoms = mol.GetNumHeavyAtoms()
+    if any(len(ring) >= MACROCYCLE_SIZE for ring in mol.GetRingInfo().AtomRings()):
+        return 'macrocycle'
+    if heavy_atoms > 100:
+        return 'large'
+    if heavy_atoms > 40:
+        return 'medium'
+    return 'small'
+
+
+def needs_isolation(mol):
+    """Whether embedding a molecule may outrun its budget and must run in a child process"""
+    return choose_profile(mol) in ISOLATED_PROFILES
+
+
+def default_threads():
+    """Embedding threads from CHEMVIZ_EMBED_THREADS; 0 means every core"""
+    return int(os.getenv('CHEMVIZ_EMBED_THREADS', 0))
+
+
+def optimize_conformers(mol, max_iters, threads):
+    """Optimize every conformer with MMFF (UFF if MMFF lacks parameters)
+
+    Returns per-conformer energies, or None when no force field applies.
+    """
+    if AllChem.MMFFHasAllMoleculeParams(mol):
+        results = AllChem.MMFFOptimizeMoleculeConfs(mol, numThreads=threads, maxIters=max_iters)
+    elif AllChem.UFFHasAllMoleculeParams(mol):
+        results = AllChem.UFFOptimizeMoleculeConfs(mol, numThreads=threads, maxIters=max_iters)
+    else:
+        return None
+    return [energy for _, energy in results]
+
+
+def embed_coordinates(smiles, profile, seed=42, threads=0):
+    """Embed and optimize; positions of the best conformer or None
+
+    Atom order is that of ``Chem.AddHs(Chem.MolFromSmiles(smiles))``.
+    """
+    with rdBase.BlockLogs():
+        mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+        params = AllChem.ETKDGv3()
+        params.randomSeed = seed
+        params.numThreads = threads
+        params.maxIterations = profile['max_iterations']
+        params.useRandomCoords = profile['random_coords']
+        # Extra conformers only pay off when they embed in parallel
+        num_confs = max(1, min(profile['num_confs'], threads or os.cpu_count() or 1))
+        if num_confs > 1:
+            params.pruneRmsThresh = 0.5
+        with span('embed.etkdg', conformers=num_confs):
+            conf_ids = list(AllChem.EmbedMultipleConfs(mol, numConfs=num_confs, params=params))
+        if not conf_ids:
+            return None
+        with span('embed.forcefield'):
+            energies = optimize_conformers(mol, profile['optimize_iters'], threads)
+        best = conf_ids[min(range(len(conf_ids)), key=energies.__getitem__)] if energies else conf_ids[0]
+        return mol.GetConformer(best).GetPositions()
+
+
+def flat_coordinates(smiles):
+    """2D depiction coordinates (z = 0) for the hydrogen-complete molecule"""
+    mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+    AllChem.Compute2DCoords(mol)
+    return mol.GetConformer().GetPositions()
+
+
+def _isolated_worker(conn, function, args):
+    try:
+        conn.send(function(*args))
+    except Exception:
+        conn.send(None)
+    finally:
+        conn.close()
+
+
+def run_isolated(function, args, timeout, cancel=None):
+    """Run ``function(*args)`` in a child process killed after ``timeout`` seconds
+
+    Returns None on timeout, failure or cancellation. ``function`` must be
+    importable at module level.
+    """
+    # Spawned rather than forked: the caller may be a threaded server
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_isolated_worker, args=(sender, function, args), daemon=True)
+    process.start()
+    sender.close()
+    deadline = time.monotonic() + timeout
+    try:
+        # Poll in short slices so a cancellation is noticed promptly
+        while not (cancel is not None and cancel.is_set()):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if receiver.poll(min(remaining, 0.1)):
+                return receiver.recv()
+        return None
+    except EOFError:
+        return None
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        receiver.close()
+
+
+def embed_smiles(smiles, seed=42, budget=None, threads=None, cancel=None):
+    """Coordinates for a canonical SMILES within a time budget
+
+    Returns ``(positions, path)`` where ``path`` is ``etkdg``,
+    ``random_coords`` or ``2d``, or ``(None, None)`` once ``cancel`` is set.
+    Budget and threads default to CHEMVIZ_EMBED_BUDGET (seconds) and
+    CHEMVIZ_EMBED_THREADS.
+    """
+    budget = budget or float(os.getenv('CHEMVIZ_EMBED_BUDGET', DEFAULT_BUDGET))
+    threads = default_threads() if threads is None else threads
+    mol = Chem.MolFromSmiles(smiles)
+    name = choose_profile(mol)
+    isolate = name in ISOLATED_PROFILES
+    with span('embed', profile=name, isolated=isolate) as stage:
+        positions, path = _embed_within(smiles, name, isolate, seed, budget, threads, cancel)
+        stage.set(path=path)
+    return positions, path
+
+
+def _embed_within(smiles, name, isolate, seed, budget, threads, cancel):
+    # The ETKDG -> random coordinates -> 2D chain behind embed_smiles
+    deadline = time.monotonic() + budget
+
+    # Leave part of the budget for the random-coordinate fallback
+    stages = [('etkdg', PROFILES[name], 0.7), ('random_coords', FALLBACK_PROFILE, 1.0)]
+    for path, profile, share in stages:
+        if cancel is not None and cancel.is_set():
+            return None, None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        args = (smiles, profile, seed, threads)
+        if isolate:
+            positions = run_isolated(embed_coordinates, args, remaining * share, cancel)
+        else:
+            positions = embed_coordinates(*args)
+        if positions is not None:
+            return positions, path
+        logger.info("%s embedding failed for %s (%s profile)", path, smiles, name)
+
+    if cancel is not None and cancel.is_set():
+        return None, None
+
+    logger.warning("3D embedding exceeded %.1fs for %s; using 2D coordinates", budget, smiles)
+    return flat_coordinates(smiles), '2d'
@@ -0,0 +1,92 @@
+"""Conformer ensembles: multi-conformer embedding, optimization and clustering
+
+Conformers are embedded with ETKDGv3 and optimized with MMFF on all cores
+(RDKit's ``numThreads``), then clustered by heavy-atom RMSD (Butina) so near
+duplicates collapse into their lowest-energy member. The survivors are
+aligned onto the lowest-energy conformer and returned in order of energy,
+ready to be played as animation frames.
+
+Thirty conformers with MMFF can outrun the CHEMVIZ_EMBED_BUDGET time budget
+at any size, so every ensemble is built in a child process that is killed
+when the budget runs out or the caller cancels.
+"""
+import os
+import time
+
+import numpy as np
+from rdkit import Chem, rdBase
+from rdkit.Chem import AllChem, rdMolAlign
+from rdkit.ML.Cluster import Butina
+
+from conformers import canonical_smiles, mol_from_coordinates
+from embedding import DEFAULT_BUDGET, default_threads, optimize_conformers, run_isolated
+from telemetry import traced
+
+DEFAULT_CONFORMERS = 30
+DEFAULT_RMS_THRESHOLD = 0.5
+
+
+def ensemble_coordinates(smiles, num_confs=DEFAULT_CONFORMERS, rms_threshold=DEFAULT_RMS_THRESHOLD,
+                         seed=42, threads=0):
+    """Embed, optimize and cluster; ``(positions, energies)`` sorted by energy
+
+    ``positions`` is a (conformers, atoms, 3) array in the atom order of
+    ``Chem.AddHs(Chem.MolFromSmiles(smiles))``, or None if nothing embeds.
+    """
+    with rdBase.BlockLogs():
+        mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+        params = AllChem.ETKDGv3()
+        params.randomSeed = seed
+        params.numThreads = threads
+        params.pruneRmsThresh = rms_threshold / 2
+        conf_ids = list(AllChem.EmbedMultipleConfs(mol, numConfs=num_confs, params=params))
+        if not conf_ids:
+            return None
+        energies = optimize_conformers(mol, 500, threads) or [0.0] * len(conf_ids)
+
+        # Optimization pulls conformers together; cluster what is left
+        heavy = Chem.RemoveHs(mol)
+        distances = AllChem.GetConformerRMSMatrix(heavy, prealigned=False)
+        clusters = Butina.ClusterData(distances, len(conf_ids), rms_threshold, isDistData=True, reordering=True)
+        keep = sorted((min(cluster, key=lambda i: energies[i]) for cluster in clusters), key=lambda i: energies[i])
+
+        heavy_atoms = [atom.GetIdx() for atom in mol.GetAtoms() if atom.GetAtomicNum() > 1]
+        keep_ids = [conf_ids[i] for i in keep]
+        rdMolAlign.AlignMolConformers(mol, confIds=keep_ids, atomIds=heavy_atoms)
+        positions = np.stack([mol.GetConformer(cid).GetPositions() for cid in keep_ids])
+        return positions, [energies[i] for i in keep]
+
+
+@traced('ensemble')
+def build_ensemble(smiles, num_confs=DEFAULT_CONFORMERS, rms_threshold=DEFAULT_RMS_THRESHOLD,
+                   budget=None, threads=None, cancel=None):
+    """Molecule with one conformer per ensemble member, lowest energy first
+
+    Each conformer carries its MMFF energy (kcal/mol, relative to the
+    lowest) as the ``energy`` property. Returns None if embedding fails, the
+    budget runs out or ``cancel`` (a ``threading.Event``) is set.
+    """
+    canonical = canonical_smiles(smiles)
+    if canonical is None:
+        return None
+    budget = budget or float(os.getenv('CHEMVIZ_EMBED_BUDGET', DEFAULT_BUDGET))
+    threads = default_threads() if threads is None else threads
+    args = (canonical, num_confs, rms_threshold, 42, threads)
+
+    mol = Chem.MolFromSmiles(canonical)
+    started = time.monotonic()
+    result = run_isolated(ensemble_coordinates, args, budget, cancel)
+    if result is None:
+        return None
+
+    positions, energies = result
+    ensemble = mol_from_coordinates(canonical, positions[0])
+    for frame in positions[1:]:
+        conf = Chem.Conformer(ensemble.GetConformer())
+        for idx, (x, y, z) in enumerate(frame.tolist()):
+            conf.SetAtomPosition(idx, (x, y, z))
+        ensemble.AddConformer(conf, assignId=True)
+    for conf, energy in zip(ensemble.GetConformers(), energies):
+        conf.SetDoubleProp('energy', energy - energies[0])
+    ensemble.SetDoubleProp('seconds', time.monotonic() - started)
+    return ensemble
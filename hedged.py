@@ -0,0 +1,109 @@
+"""Concurrent, deadline-bound lookups across remote resolution sources
+
+Remote sources (PubChem, OpenAI) are queried at the same time. The first one
+to return a record with an RDKit-valid SMILES wins and the others are
+cancelled. Each source has its own deadline and the whole lookup has an
+overall latency budget, so a slow service can no longer stall a script run.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rdkit import Chem, rdBase
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUDGET = 20.0
+
+# Blocking lookups run here rather than on the loop's default executor, which
+# asyncio.run would wait on at shutdown even after the lookup was abandoned
+_BLOCKING_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix='chemviz-lookup')
+
+
+async def run_blocking(function, *args):
+    """Run a blocking call on a shared thread pool without tying up shutdown"""
+    # run_in_executor does not carry context variables (tracing) over by itself
+    call = functools.partial(contextvars.copy_context().run, function, *args)
+    return await asyncio.get_running_loop().run_in_executor(_BLOCKING_EXECUTOR, call)
+
+
+def is_authoritative(record):
+    """A record answers the query only if its SMILES parses with RDKit"""
+    if not record or not record.get('smiles'):
+        return False
+    with rdBase.BlockLogs():
+        return Chem.MolFromSmiles(record['smiles']) is not None
+
+
+async def resolve_hedged(user_input, sources, budget=DEFAULT_BUDGET):
+    """Race ``sources`` and return ``(record, errors)``
+
+    ``sources`` is a list of ``(name, coroutine_function, deadline)``. The
+    record carries the winning source name under ``source``; ``errors`` maps
+    each failed source to a message.
+    """
+    started = time.monotonic()
+    tasks = {
+        asyncio.ensure_future(asyncio.wait_for(fetch(user_input), deadline)): name
+        for name, fetch, deadline in sources
+    }
+    errors = {}
+    try:
+        while tasks:
+            remaining = budget - (time.monotonic() - started)
+            if remaining <= 0:
+                break
+            done, _ = await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for task in done:
+                name = tasks.pop(task)
+                try:
+                    record = task.result()
+                except asyncio.TimeoutError:
+                    errors[name] = "deadline exceeded"
+                    continue
+                except Exception as e:
+                    errors[name] = str(e)
+                    continue
+                if is_authoritative(record):
+                    record = dict(record)
+                    record['source'] = name
+                    return record, errors
+                errors[name] = "no valid structure"
+        for name in tasks.values():
+            errors[name] = f"latency budget of {budget:g}s exceeded"
+        return None, errors
+    finally:
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class HedgedResolver:
+    """Synchronous resolver tier that races remote sources under a budget
+
+    Deadlines default to CHEMVIZ_<NAME>_DEADLINE and the overall budget to
+    CHEMVIZ_RESOLVE_BUDGET (seconds).
+    """
+
+    def __init__(self, sources, budget=None, report_error=None):
+        # List of (name, coroutine_function, default_deadline)
+        self.sources = [
+            (name, fetch, float(os.getenv(f'CHEMVIZ_{name.upper()}_DEADLINE', deadline)))
+            for name, fetch, deadline in sources
+        ]
+        self.budget = budget or float(os.getenv('CHEMVIZ_RESOLVE_BUDGET', DEFAULT_BUDGET))
+        self.report_error = report_error or logger.warning
+
+    def __call__(self, user_input):
+        record, errors = asyncio.run(resolve_hedged(user_input, self.sources, self.budget))
+        if record is None and errors:
+            details = "; ".join(f"{name}: {message}" for name, message in errors.items())
+            self.report_error(f"Remote lookup failed ({details})")
+        return record
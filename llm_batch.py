@@ -0,0 +1,157 @@
+"""Batched OpenAI resolution with schema-constrained output
+
+Resolving identifiers one chat completion at a time repeats the whole prompt
+for every identifier and leaves the JSON to be scraped out of free text.
+``BatchLLMResolver`` packs up to CHEMVIZ_LLM_BATCH_SIZE numbered identifiers
+into one request. The reply is constrained by a JSON schema to an array of
+records tagged with those numbers. The instructions are a fixed system
+message, so only the identifiers change between requests.
+
+Every SMILES the model returns must parse with RDKit before it is accepted,
+and the formula is recomputed from it. Items left out of a reply, items with
+an invalid SMILES and items whose whole request failed are retried one per
+request. An item the model explicitly answers with a null SMILES is not a
+compound and is not retried.
+
+Set OPENAI_BASE_URL to run against any compatible server, e.g. a local mock.
+"""
+import contextvars
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from rdkit import Chem, rdBase
+from rdkit.Chem import rdMolDescriptors
+
+from telemetry import span
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_CONCURRENCY = 4
+
+RECORD_FIELDS = ('smiles', 'iupac_name', 'common_name', 'molecular_formula', 'description', 'pubchem_cid')
+
+SYSTEM_PROMPT = (
+    "You are a chemistry expert. The user sends a JSON array of chemical identifiers (names, synonyms, "
+    "formulas, codes), each with an index. Return one result per identifier with the same index: its SMILES, "
+    "IUPAC name, common name, molecular formula, a one-sentence description and PubChem CID if known. "
+    "If an identifier is not a valid chemical compound, set every field to null except description, "
+    "which explains why."
+)
+
+_NULLABLE_STRING = {'type': ['string', 'null']}
+RESPONSE_FORMAT = {
+    'type': 'json_schema',
+    'json_schema': {
+        'name': 'molecule_records',
+        'strict': True,
+        'schema': {
+            'type': 'object',
+            'properties': {
+                'results': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'properties': {
+                            'index': {'type': 'integer'},
+                            'smiles': _NULLABLE_STRING,
+                            'iupac_name': _NULLABLE_STRING,
+                            'common_name': _NULLABLE_STRING,
+                            'molecular_formula': _NULLABLE_STRING,
+                            'description': _NULLABLE_STRING,
+                            'pubchem_cid': {'type': ['integer', 'null']},
+                        },
+                        'required': ['index', *RECORD_FIELDS],
+                        'additionalProperties': False,
+                    },
+                },
+            },
+            'required': ['results'],
+            'additionalProperties': False,
+        },
+    },
+}
+
+
+def validate_record(item):
+    """Record with a canonical SMILES and recomputed formula, or None if the SMILES does not parse"""
+    smiles = item.get('smiles')
+    with rdBase.BlockLogs():
+        mol = Chem.MolFromSmiles(smiles) if isinstance(smiles, str) and smiles.strip() else None
+    if mol is None or not mol.GetNumAtoms():
+        return None
+    record = {field: item.get(field) for field in RECORD_FIELDS}
+    record['smiles'] = Chem.MolToSmiles(mol)
+    record['molecular_formula'] = rdMolDescriptors.CalcMolFormula(mol)
+    return record
+
+
+class BatchLLMResolver:
+    """Resolve many identifiers with few chat completions"""
+
+    def __init__(self, client, model, batch_size=None, concurrency=DEFAULT_CONCURRENCY, retries=1):
+        self.client = client
+        self.model = model
+        self.batch_size = batch_size or int(os.getenv('CHEMVIZ_LLM_BATCH_SIZE', DEFAULT_BATCH_SIZE))
+        self.concurrency = concurrency
+        self.retries = retries
+
+    def resolve_many(self, inputs):
+        """Records keyed by input, None where unresolved; inputs are deduplicated"""
+        inputs = list(dict.fromkeys(text for text in inputs if text and text.strip()))
+        results = {}
+        pending = inputs
+        # First pass in full batches, then the failures one per request
+        for attempt in range(1 + self.retries):
+            size = self.batch_size if attempt == 0 else 1
+            chunks = [pending[start:start + size] for start in range(0, len(pending), size)]
+            if not chunks:
+                break
+            # A context per chunk carries the caller's trace into the worker threads
+            contexts = [contextvars.copy_context() for _ in chunks]
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(chunks))) as pool:
+                for answered in pool.map(lambda context, chunk: context.run(self._resolve_chunk, chunk),
+                                         contexts, chunks):
+                    results.update(answered)
+            pending = [text for text in pending if text not in results]
+        return {text: results.get(text) for text in inputs}
+
+    def _resolve_chunk(self, chunk):
+        # {input: record or None} for the items the reply settled; the rest are retried
+        with span('llm.batch', model=self.model, items=len(chunk)) as stage:
+            try:
+                response = self.client.chat.completions.create(
+                    model=self.model,
+                    messages=[
+                        {'role': 'system', 'content': SYSTEM_PROMPT},
+                        {'role': 'user', 'content': json.dumps(
+                            [{'index': index, 'input': text} for index, text in enumerate(chunk)])},
+                    ],
+                    response_format=RESPONSE_FORMAT,
+                    temperature=0
+                )
+                usage = getattr(response, 'usage', None)
+                if usage is not None:
+                    stage.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+                items = json.loads(response.choices[0].message.content)['results']
+            except Exception as e:
+                stage.error = type(e).__name__
+                logger.warning("Batched OpenAI request for %d identifiers failed: %s", len(chunk), e)
+                return {}
+
+            answered = {}
+            for item in items:
+                index = item.get('index') if isinstance(item, dict) else None
+                if not isinstance(index, int) or not 0 <= index < len(chunk) or chunk[index] in answered:
+                    continue
+                if item.get('smiles') is None:
+                    # The model says this is not a compound
+                    answered[chunk[index]] = None
+                    continue
+                record = validate_record(item)
+                if record is not None:
+                    answered[chunk[index]] = record
+            stage.set(resolved=sum(1 for record in answered.values() if record))
+        return answered
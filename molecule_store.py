@@ -0,0 +1,415 @@
+"""Columnar store of resolved molecules with their 3D structures
+
+Everything the service computes for a molecule is kept across sessions,
+without holding Python objects: the resolved record, its 3D structure and
+its descriptors. A store is a directory of flat files:
+
+    manifest.json           Arrow segments, in row order
+    segments/*.arrow        Arrow IPC files: identifiers, source, embedding
+                            path, descriptors, and each row's atom and bond ranges
+    atoms.bin / charges.bin     atomic numbers (uint8) and formal charges (int8)
+    coords.bin              float32 x, y, z per atom
+    bonds.bin / bond_orders.bin     atom index pairs (uint32) and RDKit bond types (uint8)
+
+Arrow segments and the structure files are memory-mapped on open, so a
+library of a million molecules opens in milliseconds. Rows are only read
+when they are browsed or exported. Structures are stored Kekulé with
+explicit hydrogens, in the atom order of the molecule that was added.
+
+Appends write the structure files first, then a new segment, then the
+manifest, which is replaced atomically, so readers never see a half-written
+row. Small segments at the end are merged once there are more than
+``MAX_SEGMENTS``. One process writes to a store at a time; any number read.
+
+Usage:
+    python molecule_store.py info data/molecules
+    python molecule_store.py list data/molecules --offset 1000 --limit 20
+    python molecule_store.py export data/molecules library.parquet    # or library.sdf
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from rdkit import Chem
+from rdkit.Geometry import Point3D
+
+from cache import default_cache_dir
+from descriptors import CORE_DESCRIPTORS, is_integer_descriptor
+
+# More segments than this and the small ones at the end are merged
+MAX_SEGMENTS = 16
+# Segments with fewer rows than this count as small
+SMALL_SEGMENT_ROWS = 10000
+# Rows per batch when exporting
+EXPORT_BATCH = 5000
+
+IDENTIFIERS = ('smiles', 'iupac_name', 'common_name', 'molecular_formula', 'description', 'source')
+
+SCHEMA = pa.schema([
+    ('key', pa.uint64()),
+    *[(name, pa.string()) for name in IDENTIFIERS],
+    ('pubchem_cid', pa.int64()),
+    ('embedding', pa.string()),
+    ('added_at', pa.float64()),
+    *[(name, pa.int64() if is_integer_descriptor(name) else pa.float64()) for name in CORE_DESCRIPTORS],
+    ('atom_start', pa.int64()),
+    ('atom_count', pa.int32()),
+    ('bond_start', pa.int64()),
+    ('bond_count', pa.int32()),
+])
+
+# Structure files: name -> (dtype, values per atom or bond)
+_ATOM_FILES = {'atoms.bin': (np.uint8, 1), 'charges.bin': (np.int8, 1), 'coords.bin': (np.float32, 3)}
+_BOND_FILES = {'bonds.bin': (np.uint32, 2), 'bond_orders.bin': (np.uint8, 1)}
+
+
+def _smiles_key(smiles):
+    return int.from_bytes(hashlib.blake2b(smiles.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _map(path, dtype, width):
+    # np.memmap refuses empty files
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.zeros((0, width), dtype=dtype)
+    array = np.memmap(path, dtype=dtype, mode='r')
+    return array[:len(array) // width * width].reshape(-1, width)
+
+
+def structure_arrays(mol):
+    """Atomic numbers, charges, coordinates, bonds and bond types of a molecule's first conformer"""
+    mol = Chem.Mol(mol)
+    Chem.Kekulize(mol, clearAromaticFlags=True)
+    atoms = mol.GetAtoms()
+    bonds = mol.GetBonds()
+    return {
+        'atoms.bin': np.array([a.GetAtomicNum() for a in atoms], dtype=np.uint8).reshape(-1, 1),
+        'charges.bin': np.array([a.GetFormalCharge() for a in atoms], dtype=np.int8).reshape(-1, 1),
+        'coords.bin': np.asarray(mol.GetConformer().GetPositions(), dtype=np.float32).reshape(-1, 3),
+        'bonds.bin': np.array([(b.GetBeginAtomIdx(), b.GetEndAtomIdx()) for b in bonds], dtype=np.uint32).reshape(-1, 2),
+        'bond_orders.bin': np.array([int(b.GetBondType()) for b in bonds], dtype=np.uint8).reshape(-1, 1),
+    }
+
+
+class MoleculeStore:
+    """Append-only, memory-mapped columnar store of molecules, records and descriptors"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'segments'), exist_ok=True)
+        self._lock = threading.Lock()
+        self._manifest_stamp = ()
+        self._refresh()
+
+    def __len__(self):
+        self._refresh()
+        return self.table.num_rows
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_manifest(self):
+        path = self._path('manifest.json')
+        if not os.path.exists(path):
+            return {'segments': []}
+        with open(path) as handle:
+            return json.load(handle)
+
+    def _refresh(self):
+        # Remap when a writer (this one or another process) replaced the manifest
+        path = self._path('manifest.json')
+        stat = os.stat(path) if os.path.exists(path) else None
+        # A replaced manifest is a new inode even where mtimes are coarse
+        stamp = (stat.st_ino, stat.st_mtime_ns) if stat else None
+        if stamp == self._manifest_stamp:
+            return
+        self._manifest_stamp = stamp
+        self._segments = self._read_manifest()['segments']
+        tables = [pa.ipc.open_file(pa.memory_map(self._path(f'segments/{name}'))).read_all()
+                  for name in self._segments]
+        self.table = pa.concat_tables(tables) if tables else SCHEMA.empty_table()
+        # First row of each segment, for finding a row's segment
+        self._starts = np.cumsum([0] + [t.num_rows for t in tables])[:-1].tolist()
+        self._keys = self.table.column('key').to_numpy() if self.table.num_rows else np.zeros(0, np.uint64)
+        self._arrays = {name: _map(self._path(name), dtype, width)
+                        for name, (dtype, width) in {**_ATOM_FILES, **_BOND_FILES}.items()}
+
+    def find(self, smiles):
+        """Row of a canonical SMILES, or None"""
+        self._refresh()
+        rows = np.nonzero(self._keys == _smiles_key(smiles))[0]
+        return int(rows[0]) if len(rows) else None
+
+    def record(self, index):
+        """Identifiers and descriptors of the molecule at row ``index``"""
+        self._refresh()
+        row = self.table.slice(index, 1).to_pylist()[0]
+        for name in ('key', 'atom_start', 'atom_count', 'bond_start', 'bond_count'):
+            del row[name]
+        return row
+
+    def structure(self, index):
+        """Memory-mapped views of a row's structure arrays, keyed by file name"""
+        self._refresh()
+        row = self.table.slice(index, 1).select(['atom_start', 'atom_count', 'bond_start', 'bond_count']).to_pylist()[0]
+        return self._slice(row)
+
+    def _slice(self, row):
+        atoms = slice(row['atom_start'], row['atom_start'] + row['atom_count'])
+        bonds = slice(row['bond_start'], row['bond_start'] + row['bond_count'])
+        arrays = {name: self._arrays[name][atoms] for name in _ATOM_FILES}
+        arrays.update((name, self._arrays[name][bonds]) for name in _BOND_FILES)
+        return arrays
+
+    def molecule(self, index):
+        """RDKit molecule with hydrogens and 3D conformer for row ``index``"""
+        self._refresh()
+        row = self.table.slice(index, 1).to_pylist()[0]
+        return self._molecule(row, self._slice(row))
+
+    @staticmethod
+    def _molecule(row, arrays):
+        mol = Chem.RWMol()
+        for number, charge in zip(arrays['atoms.bin'][:, 0].tolist(), arrays['charges.bin'][:, 0].tolist()):
+            atom = Chem.Atom(number)
+            atom.SetFormalCharge(charge)
+            # Hydrogens are stored as atoms
+            atom.SetNoImplicit(True)
+            mol.AddAtom(atom)
+        for (begin, end), order in zip(arrays['bonds.bin'].tolist(), arrays['bond_orders.bin'][:, 0].tolist()):
+            mol.AddBond(begin, end, Chem.BondType.values[order])
+        conf = Chem.Conformer(mol.GetNumAtoms())
+        for idx, (x, y, z) in enumerate(arrays['coords.bin'].tolist()):
+            conf.SetAtomPosition(idx, Point3D(x, y, z))
+        conf.Set3D(row['embedding'] != '2d')
+        mol = mol.GetMol()
+        mol.AddConformer(conf, assignId=True)
+        Chem.SanitizeMol(mol)
+        mol.SetProp('embedding', row['embedding'] or 'etkdg')
+        mol.SetProp('_Name', row['common_name'] or row['iupac_name'] or row['smiles'])
+        return mol
+
+    def add_many(self, items):
+        """Append ``(record, mol, properties)`` for molecules not stored yet; returns how many were added
+
+        ``mol`` must carry a conformer; ``properties`` are raw descriptor values.
+        """
+        rows, structures, seen = [], [], set()
+        for record, mol, properties in items:
+            if mol is None or not mol.GetNumConformers() or not record.get('smiles'):
+                continue
+            smiles = Chem.MolToSmiles(Chem.RemoveHs(mol))
+            key = _smiles_key(smiles)
+            if key in seen:
+                continue
+            seen.add(key)
+            row = {name: record.get(name) for name in IDENTIFIERS}
+            row.update({name: (properties or {}).get(name) for name in CORE_DESCRIPTORS})
+            row.update(key=key, smiles=smiles, added_at=time.time(),
+                       pubchem_cid=int(record['pubchem_cid']) if record.get('pubchem_cid') else None,
+                       embedding=mol.GetProp('embedding') if mol.HasProp('embedding') else None)
+            rows.append(row)
+            structures.append(structure_arrays(mol))
+        if not rows:
+            return 0
+
+        with self._lock:
+            self._refresh()
+            fresh = ~np.isin(np.array([row['key'] for row in rows], dtype=np.uint64), self._keys)
+            rows = [row for row, keep in zip(rows, fresh) if keep]
+            structures = [arrays for arrays, keep in zip(structures, fresh) if keep]
+            if not rows:
+                return 0
+
+            # Ranges start at the current ends of the files, so an append that
+            # failed halfway only leaves unreferenced bytes behind
+            atom_start = len(self._arrays['atoms.bin'])
+            bond_start = len(self._arrays['bonds.bin'])
+            for row, arrays in zip(rows, structures):
+                row.update(atom_start=atom_start, atom_count=len(arrays['atoms.bin']),
+                           bond_start=bond_start, bond_count=len(arrays['bonds.bin']))
+                atom_start += row['atom_count']
+                bond_start += row['bond_count']
+            for name in (*_ATOM_FILES, *_BOND_FILES):
+                with open(self._path(name), 'ab') as handle:
+                    for arrays in structures:
+                        handle.write(arrays[name].tobytes())
+
+            segments = self._segments + [self._write_segment(pa.Table.from_pylist(rows, schema=SCHEMA))]
+            self._write_manifest(segments)
+            self._compact_tail()
+            return len(rows)
+
+    def add(self, record, mol, properties=None):
+        """Store one molecule; False if it was already stored"""
+        return self.add_many([(record, mol, properties)]) > 0
+
+    def _write_segment(self, table):
+        name = f"{uuid.uuid4().hex}.arrow"
+        path = self._path(f'segments/{name}')
+        with pa.OSFile(f"{path}.tmp", 'wb') as sink, pa.ipc.new_file(sink, SCHEMA) as writer:
+            writer.write_table(table)
+        os.replace(f"{path}.tmp", path)
+        return name
+
+    def _write_manifest(self, segments):
+        path = self._path('manifest.json')
+        with open(f"{path}.tmp", 'w') as handle:
+            json.dump({'segments': segments}, handle)
+        os.replace(f"{path}.tmp", path)
+        self._refresh()
+
+    def _compact_tail(self):
+        # Merge the small segments at the end into one
+        if len(self._segments) <= MAX_SEGMENTS:
+            return
+        sizes = [end - start for start, end in zip(self._starts, self._starts[1:] + [self.table.num_rows])]
+        first = len(sizes)
+        while first > 0 and sizes[first - 1] < SMALL_SEGMENT_ROWS:
+            first -= 1
+        if len(sizes) - first < 2:
+            return
+        merged = self._write_segment(self.table.slice(self._starts[first]))
+        stale = self._segments[first:]
+        self._write_manifest(self._segments[:first] + [merged])
+        for name in stale:
+            # Readers that still map an old segment keep it until they refresh
+            os.remove(self._path(f'segments/{name}'))
+
+    def compact(self):
+        """Rewrite every segment into one"""
+        with self._lock:
+            self._refresh()
+            if len(self._segments) < 2:
+                return
+            stale = self._segments
+            self._write_manifest([self._write_segment(self.table)])
+            for name in stale:
+                os.remove(self._path(f'segments/{name}'))
+
+    def batches(self, start=0, stop=None, size=EXPORT_BATCH):
+        """Yield the rows in ``[start, stop)`` as Arrow record batches"""
+        self._refresh()
+        stop = self.table.num_rows if stop is None else min(stop, self.table.num_rows)
+        for offset in range(start, stop, size):
+            yield from self.table.slice(offset, min(size, stop - offset)).to_batches()
+
+    def export_sdf(self, path):
+        """Stream every molecule with its record and descriptors to an SDF file; returns the count"""
+        count = 0
+        writer = Chem.SDWriter(path)
+        try:
+            for batch in self.batches():
+                for row in batch.to_pylist():
+                    mol = self._molecule(row, self._slice(row))
+                    for name in (*IDENTIFIERS, 'pubchem_cid', *CORE_DESCRIPTORS):
+                        if row[name] is not None:
+                            mol.SetProp(name, str(row[name]))
+                    writer.write(mol)
+                    count += 1
+        finally:
+            writer.close()
+        return count
+
+    def export_parquet(self, path):
+        """Stream every row to Parquet, structures as list columns; returns the count"""
+        count = 0
+        writer = None
+        try:
+            for batch in self.batches():
+                table = self._with_structures(pa.Table.from_batches([batch]))
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                count += table.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            pq.write_table(self._with_structures(SCHEMA.empty_table()), path)
+        return count
+
+    def _with_structures(self, table):
+        # Replace the range columns with list columns gathered from the structure files
+        for count, start, files in (('atom_count', 'atom_start', _ATOM_FILES), ('bond_count', 'bond_start', _BOND_FILES)):
+            counts = table.column(count).to_numpy().astype(np.int64)
+            offsets = np.concatenate([[0], np.cumsum(counts)])
+            # Each row's range in the file, laid end to end
+            gather = np.repeat(table.column(start).to_numpy() - offsets[:-1], counts) + np.arange(offsets[-1])
+            for file, (dtype, width) in files.items():
+                values = pa.array(self._arrays[file][gather].reshape(-1))
+                # Pairs and coordinates are flattened within each row
+                column = pa.ListArray.from_arrays(pa.array(offsets * width, pa.int32()), values)
+                table = table.append_column(file[:-len('.bin')], column)
+        return table.drop_columns(['key', 'atom_start', 'atom_count', 'bond_start', 'bond_count'])
+
+    def stats(self):
+        """Rows, segments and bytes on disk"""
+        self._refresh()
+        files = [self._path(name) for name in (*_ATOM_FILES, *_BOND_FILES)]
+        files += [self._path(f'segments/{name}') for name in self._segments]
+        return {'rows': self.table.num_rows, 'segments': len(self._segments),
+                'atoms': len(self._arrays['atoms.bin']), 'bonds': len(self._arrays['bonds.bin']),
+                'bytes': sum(os.path.getsize(path) for path in files if os.path.exists(path))}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_molecule_store():
+    """Process-wide store from CHEMVIZ_MOLECULE_STORE, else one in the cache directory"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = MoleculeStore(os.getenv('CHEMVIZ_MOLECULE_STORE') or os.path.join(default_cache_dir(), 'molecules'))
+        return _store
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect, browse or export a molecule store")
+    commands = parser.add_subparsers(dest='command', required=True)
+    info = commands.add_parser('info', help="Rows, segments and size on disk")
+    info.add_argument('directory')
+    listing = commands.add_parser('list', help="Identifiers and descriptors of a range of rows")
+    listing.add_argument('directory')
+    listing.add_argument('--offset', type=int, default=0)
+    listing.add_argument('--limit', type=int, default=20)
+    export = commands.add_parser('export', help="Stream the store to an .sdf or .parquet file")
+    export.add_argument('directory')
+    export.add_argument('output')
+    compact = commands.add_parser('compact', help="Merge every segment into one")
+    compact.add_argument('directory')
+    args = parser.parse_args(argv)
+
+    store = MoleculeStore(args.directory)
+    if args.command == 'info':
+        print(json.dumps(store.stats(), indent=2))
+    elif args.command == 'list':
+        for batch in store.batches(args.offset, args.offset + args.limit):
+            for row in batch.select(['smiles', 'common_name', 'source', 'embedding']).to_pylist():
+                print('\t'.join(str(value or '') for value in row.values()))
+    elif args.command == 'export':
+        started = time.perf_counter()
+        if args.output.lower().endswith(('.sdf', '.sd')):
+            count = store.export_sdf(args.output)
+        elif args.output.lower().endswith('.parquet'):
+            count = store.export_parquet(args.output)
+        else:
+            parser.error("output must end in .sdf or .parquet")
+        sys.stderr.write(f"Exported {count} molecules to {args.output} in {time.perf_counter() - started:.1f}s\n")
+    else:
+        store.compact()
+        print(json.dumps(store.stats(), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
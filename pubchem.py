@@ -0,0 +1,168 @@
+"""Pooled, rate-limited PubChem PUG-REST client
+
+Only the property-table endpoint is used, asking for the handful of fields
+ChemViz needs rather than whole compound records. Connections are kept alive
+in a pooled session, and every request takes a token from a bucket refilled
+at PubChem's limit of 5 requests per second, shared across threads. Busy
+answers (429/503/504) and dropped connections are retried by the client
+itself, so every retry takes a token too and the limit holds.
+
+PUG-REST accepts lists only in the CID namespace, so CID lookups are batched
+into one POST per chunk. Names are looked up one per request, spread over the
+pooled connections so bulk jobs still run at the full rate limit; a name
+whose lookup fails is reported as not found without failing the others.
+"""
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = 'https://pubchem.ncbi.nlm.nih.gov/rest/pug'
+PROPERTIES = ('IsomericSMILES', 'CanonicalSMILES', 'MolecularFormula', 'MolecularWeight', 'IUPACName')
+# PubChem has renamed SMILES columns over time; first present wins
+SMILES_KEYS = ('IsomericSMILES', 'SMILES', 'CanonicalSMILES', 'ConnectivitySMILES')
+
+RATE_LIMIT = 5.0
+CID_BATCH_SIZE = 100
+# Attempts after the first for busy answers and dropped connections
+RETRIES = 3
+RETRY_STATUSES = (429, 503, 504)
+BACKOFF = 0.5
+
+
+class TokenBucket:
+    """Thread-safe token bucket; ``acquire`` blocks until a token is free
+
+    ``capacity`` is the burst allowed after an idle spell. It defaults to one
+    token, so no second holds more than ``rate`` requests: a bucket of
+    ``rate`` tokens would let ``2 * rate`` through in the first second.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _record(row):
+    smiles = next((row[key] for key in SMILES_KEYS if row.get(key)), None)
+    weight = row.get('MolecularWeight')
+    return {
+        'cid': row.get('CID'),
+        'smiles': smiles,
+        'molecular_formula': row.get('MolecularFormula'),
+        'molecular_weight': float(weight) if weight is not None else None,
+        'iupac_name': row.get('IUPACName'),
+    }
+
+
+class PubChemClient:
+    """Property lookups against PUG-REST (or a compatible server at ``base_url``)"""
+
+    def __init__(self, base_url=None, rate=RATE_LIMIT, timeout=10.0, pool_size=8, retries=RETRIES,
+                 backoff=BACKOFF):
+        self.base_url = (base_url or os.getenv('CHEMVIZ_PUBCHEM_URL') or DEFAULT_BASE_URL).rstrip('/')
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate)
+        # No transport retries: they would bypass the token bucket
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def properties_by_name(self, name):
+        """Record for the best match of a compound name, or None if not found"""
+        path = f"compound/name/{urllib.parse.quote(name.strip(), safe='')}/property/{','.join(PROPERTIES)}/JSON"
+        rows = self._request('GET', path)
+        return _record(rows[0]) if rows else None
+
+    def properties_by_cids(self, cids):
+        """Records keyed by CID, fetched in batched POST requests"""
+        cids = [int(cid) for cid in cids]
+        records = {}
+        for start in range(0, len(cids), CID_BATCH_SIZE):
+            batch = cids[start:start + CID_BATCH_SIZE]
+            rows = self._request('POST', f"compound/cid/property/{','.join(PROPERTIES)}/JSON",
+                                 data={'cid': ','.join(map(str, batch))})
+            for row in rows or []:
+                records[row['CID']] = _record(row)
+        return records
+
+    def lookup_names(self, names):
+        """Records keyed by name (None when not found), fetched concurrently"""
+        names = list(dict.fromkeys(names))
+        with ThreadPoolExecutor(max_workers=self.pool_size) as pool:
+            return dict(zip(names, pool.map(self._lookup_name, names)))
+
+    def _lookup_name(self, name):
+        # One failed name must not lose the rest of a bulk lookup
+        try:
+            return self.properties_by_name(name)
+        except (requests.RequestException, ValueError) as e:
+            logger.warning("PubChem lookup failed for %r: %s", name, e)
+            return None
+
+    def _request(self, method, path, data=None):
+        for attempt in range(self.retries + 1):
+            # Every attempt, retries included, counts against the rate limit
+            self.bucket.acquire()
+            try:
+                response = self.session.request(method, f"{self.base_url}/{path}", data=data, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+                continue
+            if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                break
+            # PubChem answers 503 when busy; back off and retry rather than fail
+            time.sleep(_retry_after(response) or self.backoff * 2 ** attempt)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json().get('PropertyTable', {}).get('Properties', [])
+
+
+def _retry_after(response):
+    # Seconds asked for by a Retry-After header, when it gives a number
+    try:
+        return min(float(response.headers.get('Retry-After', '')), 30.0)
+    except ValueError:
+        return None
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def get_client():
+    """Process-wide client so every caller shares one pool and rate limit"""
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            _default_client = PubChemClient()
+        return _default_client
@@ -0,0 +1,207 @@
+"""Tiered resolution of chemical input into a molecule record
+
+Tiers run cheapest first: RDKit parsing of SMILES/InChI, a local name and
+formula table, an optional persistent cache, then network-backed tiers
+(PubChem, OpenAI) supplied by the caller. The first tier that yields a SMILES
+answers, and its name is stored in the record under ``source``. Concurrent
+remote lookups of the same normalized input run once (``singleflight``).
+"""
+import logging
+import re
+from collections import Counter
+
+from rdkit import Chem, rdBase
+from rdkit.Chem import rdMolDescriptors
+
+from singleflight import flights
+from telemetry import span
+
+logger = logging.getLogger(__name__)
+
+# Common compounds answered without any network round trip
+COMMON_COMPOUNDS = {
+    'water': ('O', 'oxidane', 962),
+    'methanol': ('CO', 'methanol', 887),
+    'ethanol': ('CCO', 'ethanol', 702),
+    'benzene': ('C1=CC=CC=C1', 'benzene', 241),
+    'caffeine': ('CN1C=NC2=C1C(=O)N(C(=O)N2C)C', '1,3,7-trimethylpurine-2,6-dione', 2519),
+    'aspirin': ('CC(=O)OC1=CC=CC=C1C(=O)O', '2-acetyloxybenzoic acid', 2244),
+    'glucose': ('C([C@@H]1[C@H]([C@@H]([C@H](C(O1)O)O)O)O)O',
+                '(3R,4S,5S,6R)-6-(hydroxymethyl)oxane-2,3,4,5-tetrol', 5793),
+    'paracetamol': ('CC(=O)NC1=CC=C(C=C1)O', 'N-(4-hydroxyphenyl)acetamide', 1983),
+    'ibuprofen': ('CC(C)CC1=CC=C(C=C1)C(C)C(=O)O', '2-[4-(2-methylpropyl)phenyl]propanoic acid', 3672),
+    'acetone': ('CC(=O)C', 'propan-2-one', 180),
+    'acetic acid': ('CC(=O)O', 'acetic acid', 176),
+    'methane': ('C', 'methane', 297),
+    'ammonia': ('N', 'azane', 222),
+    'carbon dioxide': ('O=C=O', 'carbon dioxide', 280),
+    'nicotine': ('CN1CCC[C@H]1C2=CN=CC=C2', '3-[(2S)-1-methylpyrrolidin-2-yl]pyridine', 89594),
+    'dopamine': ('C1=CC(=C(C=C1CCN)O)O', '4-(2-aminoethyl)benzene-1,2-diol', 681),
+    'serotonin': ('C1=CC2=C(C=C1O)C(=CN2)CCN', '3-(2-aminoethyl)-1H-indol-5-ol', 5202),
+    'toluene': ('CC1=CC=CC=C1', 'toluene', 1140),
+    'naphthalene': ('C1=CC=C2C=CC=CC2=C1', 'naphthalene', 931),
+    'urea': ('C(=O)(N)N', 'urea', 1176),
+    'glycine': ('C(C(=O)O)N', '2-aminoacetic acid', 750),
+}
+
+SYNONYMS = {
+    'acetaminophen': 'paracetamol',
+    'acetylsalicylic acid': 'aspirin',
+    '1,3,7-trimethylxanthine': 'caffeine',
+    'dextrose': 'glucose',
+    'ethyl alcohol': 'ethanol',
+    'methyl alcohol': 'methanol',
+    'benzol': 'benzene',
+    'methylbenzene': 'toluene',
+}
+
+FORMULA_PATTERN = re.compile(r'^(?:[A-Z][a-z]?\d*)+$')
+FORMULA_TOKEN = re.compile(r'([A-Z][a-z]?)(\d*)')
+
+
+def normalize_name(text):
+    """Lowercase and collapse whitespace so name lookups ignore formatting"""
+    return ' '.join(text.split()).casefold()
+
+
+def parse_formula(text):
+    """Return element counts for a molecular formula, or None if it is not one"""
+    text = text.strip()
+    if not FORMULA_PATTERN.match(text):
+        return None
+    counts = Counter()
+    for element, count in FORMULA_TOKEN.findall(text):
+        counts[element] += int(count) if count else 1
+    return counts
+
+
+def _mol_from_text(text):
+    """Parse SMILES or InChI with RDKit, keeping parse failures out of the log"""
+    with rdBase.BlockLogs():
+        if text.startswith('InChI='):
+            return Chem.MolFromInchi(text)
+        return Chem.MolFromSmiles(text)
+
+
+def resolve_with_rdkit(user_input):
+    """Resolve input that is already a valid SMILES or InChI string"""
+    text = user_input.strip()
+    # The SMILES parser treats anything after whitespace as a molecule name
+    if not text or any(ch.isspace() for ch in text):
+        return None
+    mol = _mol_from_text(text)
+    if mol is None:
+        return None
+    notation = 'InChI' if text.startswith('InChI=') else 'SMILES'
+    return {
+        'smiles': Chem.MolToSmiles(mol),
+        'iupac_name': None,
+        'common_name': None,
+        'molecular_formula': rdMolDescriptors.CalcMolFormula(mol),
+        'description': f"{notation} notation: {text}",
+        'pubchem_cid': None
+    }
+
+
+def _compound_record(name):
+    smiles, iupac_name, cid = COMMON_COMPOUNDS[name]
+    mol = Chem.MolFromSmiles(smiles)
+    return {
+        'smiles': smiles,
+        'iupac_name': iupac_name,
+        'common_name': name,
+        'molecular_formula': rdMolDescriptors.CalcMolFormula(mol),
+        'description': f"Chemical compound: {name}",
+        'pubchem_cid': cid
+    }
+
+
+def _build_formula_index():
+    index = {}
+    for name, (smiles, _, _) in COMMON_COMPOUNDS.items():
+        formula = rdMolDescriptors.CalcMolFormula(Chem.MolFromSmiles(smiles))
+        index.setdefault(frozenset(parse_formula(formula).items()), name)
+    return index
+
+
+_FORMULA_INDEX = _build_formula_index()
+
+
+def resolve_from_local_table(user_input):
+    """Resolve common names, synonyms and formulas from the built-in table"""
+    name = normalize_name(user_input)
+    name = SYNONYMS.get(name, name)
+    if name in COMMON_COMPOUNDS:
+        return _compound_record(name)
+
+    counts = parse_formula(user_input)
+    if counts:
+        match = _FORMULA_INDEX.get(frozenset(counts.items()))
+        if match:
+            return _compound_record(match)
+    return None
+
+
+class ChemicalResolver:
+    """Run resolution tiers in order and return the first record with a SMILES
+
+    Local tiers always run first. When a cache is given it is consulted before
+    the remote tiers, and records produced by remote tiers are written back.
+    """
+
+    def __init__(self, local_tiers, remote_tiers=(), cache=None):
+        # Lists of (name, callable) pairs, cheapest first
+        self.local_tiers = list(local_tiers)
+        self.remote_tiers = list(remote_tiers)
+        self.cache = cache
+
+    def resolve(self, user_input, remote=True):
+        """Resolve input to a record tagged with the tier that answered
+
+        With ``remote=False`` only the local tiers and the cache are consulted.
+        """
+        record = self._run_tiers(self.local_tiers, user_input)
+        if record:
+            return record
+
+        if self.cache is not None:
+            with span('resolve.cache') as stage:
+                try:
+                    record = self.cache.get(user_input)
+                except Exception:
+                    logger.exception("Resolution cache lookup failed for %r", user_input)
+                stage.set(cache_hit=bool(record))
+            if record:
+                return record
+
+        if not remote:
+            return None
+        # Everyone asking for the same input right now shares one remote lookup
+        return flights.do(('resolve', normalize_name(user_input)),
+                          lambda: self._resolve_remote(user_input), share=dict)
+
+    def _resolve_remote(self, user_input):
+        record = self._run_tiers(self.remote_tiers, user_input)
+        if record and self.cache is not None:
+            try:
+                self.cache.put(user_input, record)
+            except Exception:
+                logger.exception("Resolution cache write failed for %r", user_input)
+        return record
+
+    def _run_tiers(self, tiers, user_input):
+        for name, tier in tiers:
+            with span(f'resolve.{name}') as stage:
+                try:
+                    record = tier(user_input)
+                except Exception as e:
+                    stage.error = type(e).__name__
+                    logger.exception("Resolver tier %s failed for %r", name, user_input)
+                    continue
+                stage.set(found=bool(record and record.get('smiles')))
+            if record and record.get('smiles'):
+                record = dict(record)
+                # Composite tiers may already name the source that answered
+                record.setdefault('source', name)
+                return record
+        return None
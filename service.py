@@ -0,0 +1,342 @@
+"""ChemViz service: resolution, 3D structure, properties and viewer HTML
+
+Kept free of Streamlit so the same steps can run in the app, in batch worker
+processes and from scripts. Errors meant for the user go through
+``report_error``, which the app points at ``st.error``.
+"""
+import json
+import logging
+import os
+
+from rdkit import Chem
+from rdkit.Chem.Draw import rdMolDraw2D
+
+from resolver import ChemicalResolver, resolve_with_rdkit, resolve_from_local_table
+from conformers import build_3d_molecule, canonical_smiles
+from descriptors import DescriptorEngine
+from hedged import HedgedResolver, is_authoritative, run_blocking
+from llm_batch import BatchLLMResolver
+from pubchem import get_client as get_pubchem_client
+from compound_dictionary import get_dictionary
+from viewer import comparison_html, trajectory_html, viewer_html
+from similarity import get_similarity_index
+from telemetry import span
+
+logger = logging.getLogger(__name__)
+
+
+LLM_MODEL = "gpt-4o-mini"  # Using available model instead of gpt-5-nano
+
+# Per-source deadlines (seconds) for hedged remote resolution
+PUBCHEM_DEADLINE = 5.0
+LLM_DEADLINE = 15.0
+
+
+def build_llm_prompt(user_input):
+    """Prompt asking the model for a JSON record describing the input"""
+    return f"""
+            You are a chemistry expert. Given the input: "{user_input}"
+            
+            Please provide a JSON response with the following information:
+            1. "smiles": The SMILES notation for this molecule (if possible)
+            2. "iupac_name": The IUPAC name of the compound
+            3. "common_name": Common name(s) of the compound
+            4. "molecular_formula": The molecular formula
+            5. "description": A brief description of the molecule
+            6. "pubchem_cid": PubChem CID if known (or null)
+            
+            If the input is unclear or not a valid chemical compound, set all fields to null except "description" which should explain the issue.
+            
+            Return ONLY valid JSON with no additional text, comments, or formatting.
+            
+            Example for aspirin:
+            {{"smiles": "CC(=O)OC1=CC=CC=C1C(=O)O", "iupac_name": "2-acetoxybenzoic acid", "common_name": "aspirin", "molecular_formula": "C9H8O4", "description": "A common pain reliever and anti-inflammatory drug", "pubchem_cid": 2244}}
+            """
+
+
+def parse_llm_response(content):
+    """Extract the JSON record from a model reply; raises JSONDecodeError"""
+    content = content.strip()
+    
+    # Try to extract JSON if there's extra text
+    if content.startswith('```json'):
+        content = content.replace('```json', '').replace('```', '').strip()
+    elif content.startswith('```'):
+        content = content.replace('```', '').strip()
+    
+    # Find JSON object in the response
+    start_idx = content.find('{')
+    end_idx = content.rfind('}') + 1
+    
+    if start_idx != -1 and end_idx != 0:
+        return json.loads(content[start_idx:end_idx])
+    return json.loads(content)
+
+
+def pubchem_record(user_input, pubchem_data):
+    """Resolution record from a PubChem property row"""
+    return {
+        'smiles': pubchem_data.get('smiles'),
+        'iupac_name': pubchem_data.get('iupac_name'),
+        'common_name': user_input,
+        'molecular_formula': pubchem_data.get('molecular_formula'),
+        'description': f"Chemical compound: {user_input}",
+        'pubchem_cid': pubchem_data.get('cid')
+    }
+
+
+def record_usage(stage, response):
+    """Attach an OpenAI response's token usage to a tracing span"""
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        stage.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+
+
+class ChemVizService:
+    def __init__(self, cache=None, conformer_store=None, report_error=None, use_llm=True, hedge=True,
+                 pubchem_client=None, dictionary=None, offline=None, embed_threads=None, openai_client=None):
+        self._openai_client = openai_client
+        self._llm_batch = None
+        self.use_llm = use_llm
+        self.pubchem_client = pubchem_client or get_pubchem_client()
+        self.report_error = report_error or logger.error
+        self.atom_colors = {
+            'H': '#FFFFFF',   # White
+            'C': '#909090',   # Gray
+            'N': '#3050F8',   # Blue
+            'O': '#FF0D0D',   # Red
+            'F': '#90E050',   # Green
+            'Cl': '#1FF01F',  # Bright Green
+            'Br': '#A62929',  # Brown
+            'I': '#940094',   # Purple
+            'P': '#FF8000',   # Orange
+            'S': '#FFFF30',   # Yellow
+            'B': '#FFB5B5',   # Pink
+            'Si': '#F0C8A0',  # Tan
+            'default': '#FF1493'  # Hot Pink for unknown atoms
+        }
+        # Cheap local tiers first; remote services only when nothing else answers
+        local_tiers = [
+            ('rdkit', resolve_with_rdkit),
+            ('local', resolve_from_local_table),
+        ]
+        dictionary = dictionary or get_dictionary()
+        if dictionary is not None:
+            local_tiers.append(('dictionary', dictionary.resolve))
+        
+        if offline is None:
+            offline = os.getenv('CHEMVIZ_OFFLINE') == '1'
+        self.offline = offline
+        if offline:
+            # Air-gapped: never touch the network
+            remote_tiers = []
+        elif hedge:
+            # PubChem and OpenAI race each other under deadlines
+            remote_tiers = [('remote', HedgedResolver(
+                [('pubchem', self.resolve_with_pubchem_async, PUBCHEM_DEADLINE)] +
+                ([('llm', self.resolve_with_llm_async, LLM_DEADLINE)] if use_llm else []),
+                report_error=self.report_error
+            ))]
+        else:
+            remote_tiers = [('pubchem', self.resolve_with_pubchem)] + \
+                           ([('llm', self.resolve_with_llm)] if use_llm else [])
+        self.resolver = ChemicalResolver(
+            local_tiers=local_tiers,
+            remote_tiers=remote_tiers,
+            cache=cache
+        )
+        self.conformer_store = conformer_store
+        self.embed_threads = embed_threads
+        self.descriptor_engine = DescriptorEngine('core')
+    
+    @property
+    def openai_client(self):
+        """OpenAI client, created on first use so offline callers never need a key"""
+        if self._openai_client is None:
+            # Imported here: the SDK takes longer to import than everything else in the service
+            import openai
+            self._openai_client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        return self._openai_client
+    
+    def parse_chemical_input(self, user_input):
+        """Resolve chemical input through the tiered resolver"""
+        with span('resolve') as stage:
+            record = self.resolver.resolve(user_input)
+            stage.set(source=record.get('source') if record else None)
+        return record
+    
+    def resolve_many(self, inputs):
+        """Resolve many inputs at once; records keyed by input, None where unresolved
+
+        Each input goes through the local tiers and the cache as usual. Whatever
+        is left is looked up on PubChem concurrently, and what PubChem does not
+        know is sent to OpenAI a batch at a time rather than one request each.
+        """
+        inputs = list(dict.fromkeys(inputs))
+        with span('resolve.many', inputs=len(inputs)) as stage:
+            records = {text: self.resolver.resolve(text, remote=False) for text in inputs}
+            pending = [text for text, record in records.items() if not record and text.strip()]
+            stage.set(local=len(inputs) - len(pending))
+            if pending and not self.offline:
+                try:
+                    with span('pubchem', items=len(pending)):
+                        found = self.pubchem_client.lookup_names(pending)
+                except Exception as e:
+                    self.report_error(f"Error with PubChem: {str(e)}")
+                    found = {}
+                remote = {text: dict(pubchem_record(text, data), source='pubchem')
+                          for text, data in found.items() if data and is_authoritative(data)}
+                if self.use_llm:
+                    unresolved = [text for text in pending if text not in remote]
+                    remote.update((text, dict(record, source='llm'))
+                                  for text, record in self.llm_batch.resolve_many(unresolved).items() if record)
+                for text, record in remote.items():
+                    records[text] = record
+                    if self.resolver.cache is not None:
+                        try:
+                            self.resolver.cache.put(text, record)
+                        except Exception:
+                            logger.exception("Resolution cache write failed for %r", text)
+                stage.set(remote=len(remote))
+        return records
+    
+    @property
+    def llm_batch(self):
+        """Batched OpenAI resolver sharing this service's client"""
+        if self._llm_batch is None:
+            self._llm_batch = BatchLLMResolver(self.openai_client, LLM_MODEL)
+        return self._llm_batch
+    
+    def resolve_locally(self, user_input):
+        """Resolve from local tiers and the cache only, never PubChem or OpenAI"""
+        with span('resolve', remote=False) as stage:
+            record = self.resolver.resolve(user_input, remote=False)
+            stage.set(source=record.get('source') if record else None)
+        return record
+    
+    def resolve_with_llm(self, user_input):
+        """Use OpenAI to parse and understand chemical input"""
+        try:
+            with span('llm', model=LLM_MODEL) as stage:
+                response = self.openai_client.chat.completions.create(
+                    model=LLM_MODEL,
+                    messages=[{"role": "user", "content": build_llm_prompt(user_input)}],
+                    temperature=0
+                )
+                record_usage(stage, response)
+            return parse_llm_response(response.choices[0].message.content)
+        except json.JSONDecodeError as e:
+            self.report_error(f"Error parsing JSON response: {str(e)}")
+            return None
+        except Exception as e:
+            self.report_error(f"Error with OpenAI API: {str(e)}")
+            return None
+    
+    async def resolve_with_llm_async(self, user_input):
+        """Async OpenAI lookup for hedged resolution; errors propagate to the caller"""
+        import openai
+        # A client per call: async HTTP clients cannot be shared across event loops
+        with span('llm', model=LLM_MODEL) as stage:
+            async with openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0) as client:
+                response = await client.chat.completions.create(
+                    model=LLM_MODEL,
+                    messages=[{"role": "user", "content": build_llm_prompt(user_input)}],
+                    temperature=0
+                )
+            record_usage(stage, response)
+        return parse_llm_response(response.choices[0].message.content)
+    
+    async def resolve_with_pubchem_async(self, user_input):
+        """PubChem lookup on a worker thread so it can be raced and abandoned"""
+        return await run_blocking(self.resolve_with_pubchem, user_input)
+    
+    def resolve_with_pubchem(self, user_input):
+        """Resolve a compound name through PubChem"""
+        # Errors propagate so the resolver can report which source failed
+        with span('pubchem') as stage:
+            pubchem_data = self.pubchem_client.properties_by_name(user_input)
+            stage.set(found=bool(pubchem_data))
+        if pubchem_data:
+            return pubchem_record(user_input, pubchem_data)
+        return None
+    
+    def get_molecule_from_pubchem(self, compound_name):
+        """Get molecule data from PubChem"""
+        try:
+            return self.pubchem_client.properties_by_name(compound_name)
+        except Exception:
+            logger.exception("PubChem lookup failed for %r", compound_name)
+        return None
+    
+    def create_molecule_from_smiles(self, smiles):
+        """Create RDKit molecule from SMILES"""
+        try:
+            # Embeds and optimizes only if the conformer store has no coordinates yet;
+            # the molecule's 'embedding' property says which embedding path was taken
+            with span('structure_3d'):
+                return build_3d_molecule(smiles, store=self.conformer_store, threads=self.embed_threads)
+        except Exception as e:
+            self.report_error(f"Error creating molecule: {str(e)}")
+            return None
+    
+    def create_molecule_2d(self, smiles):
+        """Hydrogen-complete molecule without coordinates, for instant properties"""
+        canonical = canonical_smiles(smiles)
+        # Same atoms as the 3D build, so descriptors match it exactly
+        return Chem.AddHs(Chem.MolFromSmiles(canonical)) if canonical else None
+    
+    def depict_molecule_2d(self, mol, width=450, height=300, highlight=None):
+        """SVG depiction of a molecule for the dark theme, optionally highlighting heavy atoms"""
+        if mol is None:
+            return None
+        with span('render.2d') as stage:
+            drawer = rdMolDraw2D.MolDraw2DSVG(width, height)
+            rdMolDraw2D.SetDarkMode(drawer.drawOptions())
+            drawer.drawOptions().clearBackground = False
+            drawer.DrawMolecule(rdMolDraw2D.PrepareMolForDrawing(Chem.RemoveHs(mol)), highlightAtoms=list(highlight or []))
+            drawer.FinishDrawing()
+            svg = drawer.GetDrawingText()
+            stage.set(bytes=len(svg))
+        return svg
+    
+    def visualize_molecule_3d(self, mol, width=800, height=600, highlight=None, style='ball_and_stick', spin=True):
+        """Create the 3Dmol.js viewer document for a molecule, optionally highlighting atoms"""
+        if mol is None:
+            return None
+        
+        with span('render.3d', atoms=mol.GetNumAtoms()) as stage:
+            html = viewer_html(mol, self.atom_colors, width=width, height=height, spin=spin, highlight=highlight,
+                               style=style)
+            stage.set(bytes=len(html))
+        return html
+    
+    def visualize_trajectory(self, trajectory, width=800, height=600, interval=100):
+        """Create an animated viewer document for a conformer ensemble or trajectory"""
+        with span('render.trajectory', frames=len(trajectory)) as stage:
+            html = trajectory_html(trajectory, self.atom_colors, width=width, height=height, interval=interval)
+            stage.set(bytes=len(html))
+        return html
+    
+    def visualize_comparison(self, molecules, labels, layout='grid', width=900, height=600, style='stick',
+                             spin=False, hydrogens=True):
+        """Create one viewer document for many molecules, on a grid or overlaid"""
+        with span('render.comparison', molecules=len(molecules), layout=layout) as stage:
+            html = comparison_html(molecules, labels, self.atom_colors, layout=layout, width=width, height=height,
+                                   style=style, spin=spin, hydrogens=hydrogens)
+            stage.set(bytes=len(html))
+        return html
+    
+    def get_molecule_properties(self, mol):
+        """Calculate raw molecular descriptor values; format with format_properties"""
+        if mol is None:
+            return {}
+        
+        with span('descriptors'):
+            return self.descriptor_engine.compute_one(mol)
+    
+    def find_similar(self, smiles, k=8, threshold=0.2):
+        """Most similar compounds in the local fingerprint library, best first"""
+        with span('similarity') as stage:
+            hits = get_similarity_index().search(smiles, k=k, threshold=threshold)
+            stage.set(hits=len(hits))
+        return hits
@@ -0,0 +1,324 @@
+"""Morgan fingerprint similarity search over a memory-mapped compound library
+
+Fingerprints are stored as packed bits, one fixed-width row per compound, in
+flat files that are only ever appended to:
+
+    fingerprints.bin    packed Morgan bits (uint8 rows)
+    counts.bin          bits set per fingerprint (uint16)
+    keys.bin            hash of each canonical SMILES (uint64), for dedup
+    records.bin / record_ends.bin   JSON records and their end offsets
+
+Everything is memory-mapped, so a library of millions of compounds opens
+instantly and is shared between processes through the page cache. Tanimoto
+scores are computed in vectorized chunks over only the fingerprint bytes the
+query has bits in, with a popcount table. Top-k queries
+first score the rows whose bit counts make them the most similar possible
+(Tanimoto is at most min(a, b) / max(a, b)), then only the rows that could
+still beat the k-th best, which usually skips most of the library.
+
+New molecules are appended as they are resolved; ``record_ends.bin`` is
+written last, so readers never see a half-written row. Writers in any
+process take an exclusive lock on ``library.lock`` and first cut every file
+back to the length ``record_ends.bin`` commits to, dropping whatever an
+interrupted append left behind.
+
+Usage:
+    python similarity.py build compounds.csv data/similarity
+    python similarity.py search data/similarity "CN1C=NC2=C1C(=O)N(C)C(=O)N2C"
+"""
+import argparse
+import contextlib
+import csv
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import threading
+
+import numpy as np
+from rdkit import Chem, rdBase
+from rdkit.Chem import rdFingerprintGenerator
+
+from cache import default_cache_dir
+from resolver import COMMON_COMPOUNDS
+
+FINGERPRINT_BITS = 2048
+FINGERPRINT_RADIUS = 2
+# Rows scored per vectorized step
+CHUNK_ROWS = 65536
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(1 << 16)], dtype=np.uint8)
+
+
+def _smiles_key(smiles):
+    return int.from_bytes(hashlib.blake2b(smiles.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _map(path, dtype, rows=None):
+    # np.memmap refuses empty files; a torn trailing item is left out
+    count = os.path.getsize(path) // np.dtype(dtype).itemsize if os.path.exists(path) else 0
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    array = np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+    return array if rows is None else array[:rows]
+
+
+@contextlib.contextmanager
+def exclusive(path):
+    """Hold an exclusive lock on ``path`` across processes"""
+    with open(path, 'ab') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def truncate(path, length):
+    """Cut ``path`` back to ``length`` bytes if an interrupted append left it longer"""
+    if os.path.exists(path) and os.path.getsize(path) > length:
+        os.truncate(path, length)
+
+
+class SimilarityIndex:
+    """Append-only, memory-mapped fingerprint library with top-k Tanimoto search"""
+
+    def __init__(self, directory, bits=FINGERPRINT_BITS, radius=FINGERPRINT_RADIUS):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as handle:
+                meta = json.load(handle)
+            bits, radius = meta['bits'], meta['radius']
+        else:
+            with open(meta_path, 'w') as handle:
+                json.dump({'bits': bits, 'radius': radius}, handle)
+        self.bits = bits
+        self.radius = radius
+        self.width = bits // 8
+        self._generator = rdFingerprintGenerator.GetMorganGenerator(radius=radius, fpSize=bits)
+        self._lock = threading.Lock()
+        self._size = -1
+        self._refresh()
+
+    def __len__(self):
+        self._refresh()
+        return self._size
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _refresh(self):
+        # Remap when another writer (or this one) has appended rows
+        ends = _map(self._path('record_ends.bin'), np.int64)
+        if len(ends) == self._size:
+            return
+        size = len(ends)
+        self._ends = ends
+        self._fingerprints = _map(self._path('fingerprints.bin'), np.uint8, size * self.width).reshape(size, self.width)
+        self._counts = _map(self._path('counts.bin'), np.uint16, size)
+        self._keys = _map(self._path('keys.bin'), np.uint64, size)
+        self._records = _map(self._path('records.bin'), np.uint8)
+        self._size = size
+
+    def fingerprint(self, mol):
+        """Packed fingerprint row (uint8) of an RDKit molecule"""
+        bits = self._generator.GetFingerprintAsNumPy(mol).astype(np.uint8)
+        return np.packbits(bits)
+
+    def record(self, index):
+        """JSON record of the compound at row ``index``"""
+        start = int(self._ends[index - 1]) if index else 0
+        return json.loads(self._records[start:int(self._ends[index])].tobytes())
+
+    def add_many(self, compounds):
+        """Append ``(smiles, name)`` pairs not already present; returns how many were added"""
+        rows, counts, keys, records = [], [], [], []
+        with rdBase.BlockLogs():
+            for smiles, name in compounds:
+                mol = Chem.MolFromSmiles(smiles) if smiles else None
+                if mol is None:
+                    continue
+                canonical = Chem.MolToSmiles(mol)
+                rows.append(self.fingerprint(mol))
+                keys.append(_smiles_key(canonical))
+                records.append(json.dumps({'smiles': canonical, 'name': name or None}).encode('utf-8'))
+        if not rows:
+            return 0
+
+        with self._lock, exclusive(self._path('library.lock')):
+            self._refresh()
+            self._truncate()
+            keys = np.array(keys, dtype=np.uint64)
+            # Skip compounds already indexed, and repeats within this batch
+            _, first = np.unique(keys, return_index=True)
+            fresh = np.zeros(len(keys), dtype=bool)
+            fresh[first] = True
+            fresh &= ~np.isin(keys, self._keys)
+            if not fresh.any():
+                return 0
+            rows = np.stack(rows)[fresh]
+            records = [r for r, keep in zip(records, fresh) if keep]
+            counts = _POPCOUNT[rows.view(np.uint16)].sum(axis=1, dtype=np.uint16)
+            offset = int(self._ends[-1]) if self._size else 0
+            ends = offset + np.cumsum([len(r) for r in records], dtype=np.int64)
+
+            for name, data in (('fingerprints.bin', rows.tobytes()), ('counts.bin', counts.tobytes()),
+                               ('keys.bin', keys[fresh].tobytes()), ('records.bin', b''.join(records)),
+                               ('record_ends.bin', ends.tobytes())):
+                with open(self._path(name), 'ab') as handle:
+                    handle.write(data)
+            self._refresh()
+            return int(fresh.sum())
+
+    def _truncate(self):
+        # Bring every file back to the committed row count
+        size = self._size
+        for name, length in (('fingerprints.bin', size * self.width), ('counts.bin', size * 2),
+                             ('keys.bin', size * 8), ('records.bin', int(self._ends[-1]) if size else 0),
+                             ('record_ends.bin', size * 8)):
+            truncate(self._path(name), length)
+
+    def add(self, smiles, name=None):
+        """Index one molecule, e.g. after it has been resolved"""
+        return self.add_many([(smiles, name)]) > 0
+
+    def _scores(self, query, rows=None):
+        # Tanimoto of the query against ``rows`` (all rows if None). Only the
+        # bytes set in the query can contribute to the intersection, and
+        # bytes holding a single query bit need a nonzero test, not a popcount
+        columns = np.nonzero(query)[0]
+        single = _POPCOUNT[query[columns]] == 1
+        columns = np.concatenate([columns[single], columns[~single]])
+        values, split = query[columns], int(single.sum())
+        query_count = int(_POPCOUNT[query].sum())
+
+        total = self._size if rows is None else len(rows)
+        scores = []
+        for start in range(0, total, CHUNK_ROWS):
+            if rows is None:
+                chunk = slice(start, start + CHUNK_ROWS)
+                block = np.take(self._fingerprints[chunk], columns, axis=1)
+            else:
+                chunk = rows[start:start + CHUNK_ROWS]
+                block = self._fingerprints[chunk[:, None], columns]
+            block &= values
+            common = np.count_nonzero(block[:, :split], axis=1)
+            if split < len(columns):
+                common += _POPCOUNT[block[:, split:]].sum(axis=1, dtype=np.int64)
+            union = self._counts[chunk].astype(np.int64) + query_count - common
+            scores.append(common / np.maximum(union, 1))
+        return np.concatenate(scores) if scores else np.zeros(0)
+
+    def search(self, smiles, k=10, threshold=0.0, exclude_self=True):
+        """Most similar compounds to a SMILES, best first
+
+        Returns a list of ``{'smiles', 'name', 'similarity'}``; the query
+        molecule itself is left out unless ``exclude_self`` is False.
+        """
+        with rdBase.BlockLogs():
+            mol = Chem.MolFromSmiles(smiles) if smiles else None
+        if mol is None:
+            return []
+        self._refresh()
+        if not self._size:
+            return []
+        query = self.fingerprint(mol)
+        query_count = int(_POPCOUNT[query].sum())
+        counts = self._counts.astype(np.int64)
+        bound = np.minimum(counts, query_count) / np.maximum(np.maximum(counts, query_count), 1)
+
+        # Score the rows with the best bounds first; only rows whose bound
+        # reaches the k-th best score so far can still make the top k
+        wanted = min(self._size, k + 1 if exclude_self else k)
+        first = np.argpartition(-bound, wanted - 1)[:wanted]
+        floor = max(threshold, self._scores(query, first).min())
+        candidates = np.nonzero(bound >= floor)[0]
+        if len(candidates) > self._size // 4:
+            # A contiguous scan beats gathering scattered rows
+            indices, values = np.arange(self._size), self._scores(query)
+        else:
+            indices, values = candidates, self._scores(query, candidates)
+
+        top = min(len(values), wanted)
+        best = np.argpartition(-values, top - 1)[:top]
+        order = best[np.argsort(-values[best], kind='stable')]
+        own_key = _smiles_key(Chem.MolToSmiles(mol))
+        results = []
+        for position in order:
+            if values[position] < threshold or len(results) == k:
+                break
+            index = int(indices[position])
+            if exclude_self and self._keys[index] == own_key:
+                continue
+            record = self.record(index)
+            record['similarity'] = round(float(values[position]), 3)
+            results.append(record)
+        return results
+
+
+def _read_compounds(source):
+    delimiter = '\t' if source.lower().endswith('.tsv') else ','
+    with open(source, newline='', encoding='utf-8') as handle:
+        for row in csv.DictReader(handle, delimiter=delimiter):
+            row = {k.strip().lower(): (v or '').strip() for k, v in row.items() if k}
+            if row.get('smiles'):
+                yield row['smiles'], row.get('name') or None
+
+
+def build_index(source, directory, batch_size=10000):
+    """Append the compounds of a CSV/TSV (name, smiles) to an index; returns the count added"""
+    index = SimilarityIndex(directory)
+    added, batch = 0, []
+    for compound in _read_compounds(source):
+        batch.append(compound)
+        if len(batch) == batch_size:
+            added += index.add_many(batch)
+            batch = []
+    return added + index.add_many(batch)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_similarity_index():
+    """Process-wide index from CHEMVIZ_SIMILARITY_INDEX, else one in the cache directory
+
+    A new index is seeded with the built-in compound table.
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            path = os.getenv('CHEMVIZ_SIMILARITY_INDEX') or os.path.join(default_cache_dir(), 'similarity')
+            _index = SimilarityIndex(path)
+            if not len(_index):
+                _index.add_many((smiles, name) for name, (smiles, _, _) in COMMON_COMPOUNDS.items())
+        return _index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query a fingerprint similarity index")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help="Add the compounds of a CSV/TSV to an index")
+    build.add_argument('source')
+    build.add_argument('directory')
+    search = commands.add_parser('search', help="Most similar compounds to a SMILES")
+    search.add_argument('directory')
+    search.add_argument('smiles')
+    search.add_argument('-k', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        added = build_index(args.source, args.directory)
+        sys.stderr.write(f"Added {added} compounds to {args.directory}\n")
+        return 0
+    for hit in SimilarityIndex(args.directory).search(args.smiles, k=args.k):
+        print(f"{hit['similarity']:.3f}\t{hit['smiles']}\t{hit['name'] or ''}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""Process-wide coalescing of identical in-flight work (single flight)
+
+When many sessions ask for the same molecule at once, only the first caller,
+the leader, resolves or embeds it. The others wait for that call and share
+its result. Keys are tuples whose first element names what is computed, e.g.
+``('resolve', normalized input)`` or ``('embed', canonical SMILES, parameters)``.
+
+A leader that raises or is cancelled fails only itself. The callers waiting
+on it elect a new leader among themselves and run the work again, so one
+session's timeout, rerun or error is never handed to the others. A waiter
+with its own ``cancel`` event stops waiting once it is set.
+
+Calls are counted in ``chemviz_singleflight_total`` by kind and role:
+
+    leader    ran the work
+    shared    received a leader's result without running it
+    retry     waited for a leader that failed, then tried again
+"""
+import collections
+import threading
+
+from telemetry import metrics, span
+
+
+class Cancelled(Exception):
+    """Raised by work, or a waiter, that gave up because its ``cancel`` event was set"""
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+        self.result = None
+
+
+class SingleFlight:
+    """Run a function once per key at a time; concurrent callers share the result"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._counts = collections.Counter()
+
+    def do(self, key, function, cancel=None, share=None):
+        """Result of ``function()``, or of the identical call already in flight
+
+        ``share`` copies results callers may modify. The leader publishes a
+        copy of its result that nobody touches and keeps the original, and
+        every waiter receives its own copy of the published one.
+        """
+        kind = key[0]
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+            if leader:
+                self._count(kind, 'leader')
+                try:
+                    result = function()
+                    # Published before the leader's caller can modify its own result
+                    flight.result = share(result) if share is not None and result is not None else result
+                    flight.ok = True
+                    return result
+                finally:
+                    with self._lock:
+                        del self._flights[key]
+                    flight.done.set()
+
+            with span('singleflight.wait', kind=kind) as stage:
+                # Poll so a waiter's own cancellation is noticed
+                while not flight.done.wait(0.1):
+                    if cancel is not None and cancel.is_set():
+                        raise Cancelled()
+                stage.set(shared=flight.ok)
+            if flight.ok:
+                self._count(kind, 'shared')
+                result = flight.result
+                return share(result) if share is not None and result is not None else result
+            self._count(kind, 'retry')
+
+    def stats(self):
+        """Calls per kind and role, plus the number of computations in flight"""
+        with self._lock:
+            counts = {}
+            for (kind, role), count in sorted(self._counts.items()):
+                counts.setdefault(kind, {'leader': 0, 'shared': 0, 'retry': 0})[role] = count
+            return {'in_flight': len(self._flights), 'calls': counts}
+
+    def _count(self, kind, role):
+        with self._lock:
+            self._counts[kind, role] += 1
+        metrics.increment('chemviz_singleflight_total', kind=kind, role=role)
+
+
+flights = SingleFlight()
@@ -0,0 +1,367 @@
+"""Streaming PDB/mmCIF loading and level-of-detail selection for large structures
+
+Files are read line by line (memory-mapped when on disk, gzip-compressed
+files decompressed on the fly) straight into compact columnar arrays, so a
+structure never exists as text or as per-atom Python objects. Only the first
+model and the first alternate location of each atom are kept.
+
+What is sent to the viewer depends on size. Small structures are drawn with
+every atom. Larger ones draw polymers as a cartoon through CA/P atoms only,
+and very large ones as a thinned backbone trace. Ligands and any residues
+picked by the user are always drawn with full atoms, up to a cap. The
+payload, and so memory and render time in the browser, stays bounded however
+big the structure is.
+"""
+import array
+import gzip
+import mmap
+import os
+import re
+
+import numpy as np
+
+from telemetry import traced
+
+# Structures up to this many atoms are drawn atom by atom
+FULL_ATOM_LIMIT = 5000
+# Backbone atoms above this are thinned to a trace
+BACKBONE_LIMIT = 20000
+# Atoms drawn as sticks (ligands, focus residues) on large structures
+DETAIL_ATOM_LIMIT = 5000
+
+BACKBONE_ATOMS = (b'CA', b'P')
+WATER = (b'HOH', b'WAT', b'DOD', b'H2O')
+
+# Fixed byte widths of the string columns
+NAME_WIDTH, RESNAME_WIDTH, CHAIN_WIDTH, ELEMENT_WIDTH = 4, 5, 4, 2
+
+_CIF_TOKEN = re.compile(rb"'[^']*'|\"[^\"]*\"|\S+")
+_CIF_NULLS = {b'.', b'?'}
+
+# Covalent radii (Å) for bond perception; others use 1.5
+COVALENT_RADII = {
+    b'H': 0.31, b'C': 0.76, b'N': 0.71, b'O': 0.66, b'S': 1.05, b'P': 1.07, b'F': 0.57,
+    b'CL': 1.02, b'BR': 1.20, b'I': 1.39, b'SE': 1.20, b'FE': 1.32, b'ZN': 1.22, b'MG': 1.41,
+}
+
+
+class Structure:
+    """Columnar atoms of one model, with secondary structure ranges"""
+
+    def __init__(self, coords, names, resnames, chains, elements, resseq, hetero, helices=(), sheets=()):
+        self.coords = coords
+        self.names = names
+        self.resnames = resnames
+        self.chains = chains
+        self.elements = elements
+        self.resseq = resseq
+        self.hetero = hetero
+        self.helices = list(helices)
+        self.sheets = list(sheets)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def residue_starts(self):
+        """Index of the first atom of every residue"""
+        if not len(self):
+            return np.zeros(0, dtype=np.int64)
+        change = (self.resseq[1:] != self.resseq[:-1]) | (self.chains[1:] != self.chains[:-1])
+        return np.concatenate([[0], np.nonzero(change)[0] + 1])
+
+    def ligand_mask(self):
+        """Hetero atoms other than water"""
+        return self.hetero & ~np.isin(self.resnames, WATER)
+
+    def secondary_structure(self):
+        """Per-atom 'h' (helix), 's' (sheet) or 'c' (coil) codes"""
+        codes = np.full(len(self), b'c', dtype='S1')
+        for ranges, code in ((self.helices, b'h'), (self.sheets, b's')):
+            for chain, start, end in ranges:
+                codes[(self.chains == chain) & (self.resseq >= start) & (self.resseq <= end)] = code
+        return codes
+
+    def summary(self):
+        """Counts shown next to the viewer"""
+        ligands = self.ligand_mask()
+        starts = self.residue_starts()
+        return {
+            'atoms': len(self),
+            'residues': len(starts),
+            'chains': len(np.unique(self.chains)),
+            'ligands': sorted({name.decode() for name in np.unique(self.resnames[ligands])}),
+            'waters': int(np.isin(self.resnames[starts], WATER).sum()) if len(starts) else 0,
+        }
+
+
+class _Columns:
+    # Append-only buffers that become the Structure's numpy arrays
+
+    def __init__(self):
+        self.coords = array.array('f')
+        self.resseq = array.array('i')
+        self.hetero = bytearray()
+        self.names, self.resnames = bytearray(), bytearray()
+        self.chains, self.elements = bytearray(), bytearray()
+
+    def append(self, name, resname, chain, element, resseq, hetero, x, y, z):
+        self.names += name[:NAME_WIDTH].ljust(NAME_WIDTH)
+        self.resnames += resname[:RESNAME_WIDTH].ljust(RESNAME_WIDTH)
+        self.chains += chain[:CHAIN_WIDTH].ljust(CHAIN_WIDTH)
+        self.elements += element[:ELEMENT_WIDTH].upper().ljust(ELEMENT_WIDTH)
+        self.resseq.append(resseq)
+        self.hetero.append(hetero)
+        self.coords.extend((x, y, z))
+
+    def structure(self, helices, sheets):
+        def strings(buffer, width):
+            # np.char.strip keeps the fixed-width bytes dtype
+            return np.char.strip(np.frombuffer(bytes(buffer), dtype=f'S{width}'))
+        return Structure(
+            coords=np.frombuffer(self.coords, dtype=np.float32).reshape(-1, 3),
+            names=strings(self.names, NAME_WIDTH),
+            resnames=strings(self.resnames, RESNAME_WIDTH),
+            chains=strings(self.chains, CHAIN_WIDTH),
+            elements=strings(self.elements, ELEMENT_WIDTH),
+            resseq=np.frombuffer(self.resseq, dtype=np.int32),
+            hetero=np.frombuffer(bytes(self.hetero), dtype=np.bool_),
+            helices=helices,
+            sheets=sheets,
+        )
+
+
+def _element_from_name(name):
+    # Old PDB files leave the element column empty
+    letters = bytes(c for c in name if 65 <= c <= 90 or 97 <= c <= 122)
+    return letters[:1]
+
+
+def read_pdb(lines):
+    """Parse PDB lines (bytes) into a Structure"""
+    columns = _Columns()
+    helices, sheets = [], []
+    for line in lines:
+        record = line[:6]
+        if record == b'ATOM  ' or record == b'HETATM':
+            if line[16:17] not in (b' ', b'A', b''):
+                continue
+            name = line[12:16].strip()
+            columns.append(
+                name, line[17:20].strip(), line[21:22].strip(),
+                line[76:78].strip() or _element_from_name(name),
+                int(line[22:26]), record == b'HETATM',
+                float(line[30:38]), float(line[38:46]), float(line[46:54]),
+            )
+        elif record == b'HELIX ':
+            helices.append((line[19:20].strip(), int(line[21:25]), int(line[33:37])))
+        elif record == b'SHEET ':
+            sheets.append((line[21:22].strip(), int(line[22:26]), int(line[33:37])))
+        elif record == b'ENDMDL':
+            break
+    return columns.structure(helices, sheets)
+
+
+def _unquote(token):
+    if token[:1] in (b"'", b'"'):
+        return token[1:-1]
+    return b'' if token in _CIF_NULLS else token
+
+
+def _cif_rows(lines):
+    # Yield (category, items, values) for loop rows and single-value items
+    lines = iter(lines)
+    category, headers, values, single = None, [], [], {}
+    in_loop, looped, awaiting = False, False, None
+    for line in lines:
+        stripped = line.strip()
+        if line.startswith(b';'):
+            # Multi-line text field; never needed, so kept as an empty value
+            for text in lines:
+                if text.startswith(b';'):
+                    break
+            tokens = [b'']
+        elif not stripped or stripped.startswith(b'#') or stripped == b'loop_':
+            if single:
+                yield category, list(single), list(single.values())
+            headers, values, single, awaiting = [], [], {}, None
+            in_loop, looped = stripped == b'loop_', False
+            continue
+        elif stripped.startswith(b'_') and not values:
+            if looped:
+                # Items straight after a loop's rows start a new category
+                headers, in_loop, looped = [], False, False
+            tokens = _CIF_TOKEN.findall(stripped)
+            category, item = tokens[0][1:].split(b'.', 1)
+            if in_loop:
+                headers.append(item)
+            elif len(tokens) > 1:
+                single[item] = _unquote(tokens[1])
+            else:
+                awaiting = item
+            continue
+        elif b'"' in stripped or b"'" in stripped:
+            tokens = [_unquote(token) for token in _CIF_TOKEN.findall(stripped)]
+        else:
+            # Fast path for the unquoted rows that make up most of atom_site
+            tokens = [b'' if token in _CIF_NULLS else token for token in stripped.split()]
+
+        if awaiting is not None:
+            single[awaiting], awaiting = tokens[0], None
+        elif headers:
+            # Rows may wrap across lines
+            values += tokens
+            while len(values) >= len(headers):
+                looped = True
+                yield category, headers, values[:len(headers)]
+                values = values[len(headers):]
+    if single:
+        yield category, list(single), list(single.values())
+
+
+def read_mmcif(lines):
+    """Parse mmCIF lines (bytes) into a Structure, first model only"""
+    columns = _Columns()
+    helices, sheets = [], []
+    model, items, column = None, None, None
+    for category, headers, values in _cif_rows(lines):
+        if category == b'atom_site':
+            if headers is not items:
+                # Column positions, looked up once per loop; auth_* preferred
+                items = headers
+                position = {item: i for i, item in enumerate(headers)}
+                column = [
+                    position.get(b'auth_atom_id', position.get(b'label_atom_id')),
+                    position.get(b'auth_comp_id', position.get(b'label_comp_id')),
+                    position.get(b'auth_asym_id', position.get(b'label_asym_id')),
+                    position.get(b'type_symbol'),
+                    position.get(b'auth_seq_id', position.get(b'label_seq_id')),
+                    position.get(b'group_PDB'),
+                    position[b'Cartn_x'], position[b'Cartn_y'], position[b'Cartn_z'],
+                    position.get(b'label_alt_id'), position.get(b'pdbx_PDB_model_num'),
+                ]
+            name_at, resname_at, chain_at, element_at, seq_at, group_at, x_at, y_at, z_at, alt_at, model_at = column
+            if model_at is not None:
+                model = model or values[model_at]
+                if values[model_at] != model:
+                    break
+            if alt_at is not None and values[alt_at] not in (b'', b'A'):
+                continue
+            name = values[name_at]
+            columns.append(
+                name, values[resname_at], values[chain_at],
+                (values[element_at] if element_at is not None else b'') or _element_from_name(name),
+                int(values[seq_at] or 0) if seq_at is not None else 0,
+                group_at is not None and values[group_at] == b'HETATM',
+                float(values[x_at]), float(values[y_at]), float(values[z_at]),
+            )
+            continue
+        row = dict(zip(headers, values))
+        if category == b'struct_conf' and row.get(b'conf_type_id', b'').startswith(b'HELX'):
+            helices.append((row[b'beg_auth_asym_id'], int(row[b'beg_auth_seq_id']), int(row[b'end_auth_seq_id'])))
+        elif category == b'struct_sheet_range':
+            sheets.append((row[b'beg_auth_asym_id'], int(row[b'beg_auth_seq_id']), int(row[b'end_auth_seq_id'])))
+    return columns.structure(helices, sheets)
+
+
+def structure_format(name):
+    """'pdb' or 'mmcif' from a file name (optionally .gz)"""
+    base = name.lower()[:-3] if name.lower().endswith('.gz') else name.lower()
+    return 'mmcif' if base.endswith(('.cif', '.mmcif')) else 'pdb'
+
+
+@traced('structure.load')
+def load_structure(source, name=None):
+    """Load a PDB/mmCIF file from a path or a binary file object"""
+    name = name or getattr(source, 'name', None) or str(source)
+    reader = read_mmcif if structure_format(name) == 'mmcif' else read_pdb
+    if isinstance(source, (str, os.PathLike)):
+        if str(source).lower().endswith('.gz'):
+            with gzip.open(source, 'rb') as handle:
+                return reader(handle)
+        with open(source, 'rb') as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return reader(iter(mapped.readline, b''))
+    if name.lower().endswith('.gz'):
+        return reader(gzip.GzipFile(fileobj=source))
+    return reader(source)
+
+
+def parse_selection(text):
+    """Focus selection like 'A:45-60, B:101, HEM' into (chain, start, end) and residue names"""
+    ranges, names = [], []
+    for part in filter(None, (p.strip() for p in (text or '').split(','))):
+        match = re.fullmatch(r'([A-Za-z0-9]+):(-?\d+)(?:-(-?\d+))?', part)
+        if match:
+            chain, start, end = match.groups()
+            ranges.append((chain.encode(), int(start), int(end or start)))
+        else:
+            names.append(part.upper().encode())
+    return ranges, names
+
+
+def _bonds(structure, index):
+    # Distance-based bonds within each residue and to the next one
+    coords = structure.coords[index]
+    radii = np.array([COVALENT_RADII.get(e, 1.5) for e in structure.elements[index]], dtype=np.float32)
+    keys = np.stack([structure.resseq[index], np.unique(structure.chains[index], return_inverse=True)[1]], axis=1)
+    starts = np.concatenate([[0], np.nonzero(np.any(keys[1:] != keys[:-1], axis=1))[0] + 1, [len(index)]])
+    pairs = []
+    for r in range(len(starts) - 1):
+        lo, mid, hi = starts[r], starts[r + 1], starts[min(r + 2, len(starts) - 1)]
+        block = coords[lo:hi]
+        distance = np.linalg.norm(coords[lo:mid, None, :] - block[None, :, :], axis=2)
+        limit = radii[lo:mid, None] + radii[None, lo:hi] + 0.45
+        i, j = np.nonzero((distance < limit) & (distance > 0.4))
+        keep = j + lo > i + lo
+        pairs.append(np.stack([i[keep] + lo, j[keep] + lo], axis=1))
+    return np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+
+
+def distance_bonds(elements, coords, chunk=512):
+    """Bonds from interatomic distances alone, e.g. for XYZ files"""
+    radii = np.array([COVALENT_RADII.get(e, 1.5) for e in elements], dtype=np.float32)
+    pairs = []
+    for lo in range(0, len(coords), chunk):
+        distance = np.linalg.norm(coords[lo:lo + chunk, None, :] - coords[None, :, :], axis=2)
+        limit = radii[lo:lo + chunk, None] + radii[None, :] + 0.45
+        i, j = np.nonzero((distance < limit) & (distance > 0.4))
+        keep = j > i + lo
+        pairs.append(np.stack([i[keep] + lo, j[keep]], axis=1))
+    return np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+
+
+def level_of_detail(structure, selection=''):
+    """Choose what to draw; returns the atom indices, their style and bonds
+
+    ``level`` is ``full``, ``cartoon`` or ``trace``. ``sticks`` flags atoms
+    drawn with full detail; the others are backbone atoms for the cartoon.
+    """
+    n = len(structure)
+    if n <= FULL_ATOM_LIMIT:
+        index = np.arange(n)
+        sticks = np.ones(n, dtype=bool)
+        level = 'full'
+    else:
+        ranges, names = parse_selection(selection)
+        detail = structure.ligand_mask() | np.isin(structure.resnames, names)
+        for chain, start, end in ranges:
+            detail |= (structure.chains == chain) & (structure.resseq >= start) & (structure.resseq <= end)
+        # Ligands and focus residues in file order until the cap
+        detail_index = np.nonzero(detail)[0][:DETAIL_ATOM_LIMIT]
+        backbone_index = np.nonzero(~structure.hetero & np.isin(structure.names, BACKBONE_ATOMS))[0]
+        level = 'cartoon'
+        if len(backbone_index) > BACKBONE_LIMIT:
+            step = int(np.ceil(len(backbone_index) / BACKBONE_LIMIT))
+            backbone_index = backbone_index[::step]
+            level = 'trace'
+        index = np.union1d(backbone_index, detail_index)
+        sticks = np.isin(index, detail_index)
+    # Bond indices refer to positions among the drawn atoms
+    bonds = np.nonzero(sticks)[0][_bonds(structure, index[sticks])]
+    if level != 'full':
+        # Link backbone atoms directly: a thinned trace is too sparse for a
+        # cartoon, and trajectory frames draw the backbone as sticks
+        backbone = np.nonzero(~sticks)[0]
+        chains = structure.chains[index[backbone]]
+        link = chains[1:] == chains[:-1]
+        bonds = np.concatenate([bonds, np.stack([backbone[:-1][link], backbone[1:][link]], axis=1)])
+    return {'level': level, 'index': index, 'sticks': sticks, 'bonds': bonds}
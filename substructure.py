@@ -0,0 +1,278 @@
+"""SMARTS substructure search over the compound library
+
+The library is the similarity index (``similarity.py``). Next to its
+fingerprints we keep RDKit pattern fingerprints in ``patterns.bin``, one
+packed row per compound, appended whenever the library has grown. A compound
+can only contain the query if its pattern fingerprint has every bit of the
+query's, so screening is a vectorized bit test over the memory-mapped rows
+and typically rules out almost the whole library before any molecule is
+parsed.
+
+Survivors are verified with ``HasSubstructMatch``-style matching in batches,
+on a process pool when there are enough of them to pay for it, and hits are
+yielded as they are confirmed, in library order. ``SubstructureSearch``
+wraps that stream and pulls only as many hits as the requested page needs.
+
+Usage:
+    python substructure.py build data/similarity
+    python substructure.py search data/similarity "c1ccccc1C(=O)[OH]"
+"""
+import argparse
+import collections
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from rdkit import Chem, DataStructs, rdBase
+
+from similarity import SimilarityIndex, exclusive, get_similarity_index, truncate
+from telemetry import span
+
+PATTERN_BITS = 2048
+# Rows screened per vectorized step
+SCREEN_ROWS = 65536
+# Survivors sent to a worker at a time
+VERIFY_BATCH = 500
+# Fewer survivors than this are verified in-process
+INLINE_LIMIT = 2000
+
+
+def parse_smarts(smarts):
+    """Query molecule for a SMARTS pattern; raises ValueError if it does not parse"""
+    with rdBase.BlockLogs():
+        pattern = Chem.MolFromSmarts(smarts.strip()) if smarts and smarts.strip() else None
+    if pattern is None or not pattern.GetNumAtoms():
+        raise ValueError(f"not a valid SMARTS pattern: {smarts!r}")
+    return pattern
+
+
+def pattern_fingerprint(mol):
+    """Packed RDKit pattern fingerprint (uint8 row) of a molecule or query"""
+    bits = np.zeros(PATTERN_BITS, dtype=np.uint8)
+    DataStructs.ConvertToNumpyArray(Chem.PatternFingerprint(mol, fpSize=PATTERN_BITS), bits)
+    return np.packbits(bits)
+
+
+def verify(smarts, items):
+    """``(index, matched atom indices)`` for the ``(index, smiles)`` items containing the pattern"""
+    pattern = parse_smarts(smarts)
+    hits = []
+    with rdBase.BlockLogs():
+        for index, smiles in items:
+            mol = Chem.MolFromSmiles(smiles)
+            match = mol.GetSubstructMatch(pattern) if mol is not None else ()
+            if match:
+                hits.append((index, match))
+    return hits
+
+
+def match_atoms(mol, smarts):
+    """Atom indices of the first match in a molecule, ignoring explicit hydrogens
+
+    Hydrogens added with ``Chem.AddHs`` come after the heavy atoms, so the
+    indices are valid in the hydrogen-complete molecule too.
+    """
+    with rdBase.BlockLogs():
+        return list(Chem.RemoveHs(mol).GetSubstructMatch(parse_smarts(smarts)))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def default_workers():
+    """Verification processes from CHEMVIZ_SEARCH_WORKERS; 0 means every core"""
+    return int(os.getenv('CHEMVIZ_SEARCH_WORKERS', 0)) or os.cpu_count() or 1
+
+
+def _get_pool():
+    # Spawned rather than forked: the caller may be a threaded server
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(default_workers(), mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+class SubstructureIndex:
+    """Pattern-fingerprint screen over a ``SimilarityIndex`` library"""
+
+    def __init__(self, library, workers=None):
+        self.library = library
+        self.workers = workers or default_workers()
+        self.width = PATTERN_BITS // 8
+        self._path = os.path.join(library.directory, 'patterns.bin')
+        self._lock = threading.Lock()
+        self._patterns = np.zeros((0, self.width), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def update(self, progress=None):
+        """Fingerprint library compounds added since the last update
+
+        Updaters in any process take turns on ``patterns.lock``; a row torn
+        by an interrupted update is dropped before appending.
+        """
+        with self._lock, exclusive(os.path.join(self.library.directory, 'patterns.lock')):
+            total = len(self.library)
+            done = min(os.path.getsize(self._path) // self.width if os.path.exists(self._path) else 0, total)
+            truncate(self._path, done * self.width)
+            with rdBase.BlockLogs(), open(self._path, 'ab') as handle:
+                for start in range(done, total, 10000):
+                    rows = []
+                    for index in range(start, min(start + 10000, total)):
+                        mol = Chem.MolFromSmiles(self.library.record(index)['smiles'])
+                        rows.append(pattern_fingerprint(mol) if mol is not None else np.zeros(self.width, np.uint8))
+                    handle.write(np.stack(rows).tobytes())
+                    if progress:
+                        progress(start + len(rows), total)
+            if total and len(self._patterns) != total:
+                self._patterns = np.memmap(self._path, dtype=np.uint8, mode='r')[:total * self.width].reshape(total, self.width)
+
+    def screen(self, pattern):
+        """Yield arrays of row indices whose fingerprints could contain the pattern"""
+        query = pattern_fingerprint(pattern)
+        columns = np.nonzero(query)[0]
+        values = query[columns]
+        for start in range(0, len(self._patterns), SCREEN_ROWS):
+            block = np.take(self._patterns[start:start + SCREEN_ROWS], columns, axis=1)
+            yield start + np.nonzero(((block & values) == values).all(axis=1))[0]
+
+    def _batches(self, pattern):
+        # (index, smiles) batches of screened survivors
+        batch = []
+        for rows in self.screen(pattern):
+            for index in rows.tolist():
+                batch.append((index, self.library.record(index)['smiles']))
+                if len(batch) == VERIFY_BATCH:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def search(self, smarts, stats=None):
+        """Yield ``{'index', 'smiles', 'name', 'atoms'}`` for every compound containing the pattern
+
+        ``stats``, if given, is a dict updated with ``screened`` and
+        ``candidates`` counts as the search proceeds.
+        """
+        pattern = parse_smarts(smarts)
+        self.update()
+        stats = stats if stats is not None else {}
+        stats.update(screened=len(self._patterns), candidates=0)
+
+        def hit(index, atoms):
+            record = self.library.record(index)
+            return {'index': index, 'smiles': record['smiles'], 'name': record.get('name'), 'atoms': list(atoms)}
+
+        batches = self._batches(pattern)
+        # Verify the first survivors here; go parallel once there are plenty
+        for batch in batches:
+            stats['candidates'] += len(batch)
+            for index, atoms in verify(smarts, batch):
+                yield hit(index, atoms)
+            if self.workers > 1 and stats['candidates'] >= INLINE_LIMIT:
+                break
+        else:
+            return
+
+        pool = _get_pool()
+        pending = collections.deque()
+        try:
+            exhausted = False
+            while True:
+                # Keep every worker busy while results are consumed in order
+                while not exhausted and len(pending) < 2 * self.workers:
+                    batch = next(batches, None)
+                    if batch is None:
+                        exhausted = True
+                    else:
+                        stats['candidates'] += len(batch)
+                        pending.append(pool.submit(verify, smarts, batch))
+                if not pending:
+                    break
+                for index, atoms in pending.popleft().result():
+                    yield hit(index, atoms)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class SubstructureSearch:
+    """Paginated view over a running search; hits are pulled only as pages need them"""
+
+    def __init__(self, index, smarts):
+        self.smarts = smarts
+        self.stats = {}
+        self.hits = []
+        self.done = False
+        self._stream = index.search(smarts, self.stats)
+
+    def fetch(self, count):
+        """Pull hits until ``count`` are available or the search is exhausted"""
+        while not self.done and len(self.hits) < count:
+            hit = next(self._stream, None)
+            if hit is None:
+                self.done = True
+            else:
+                self.hits.append(hit)
+
+    def page(self, number, size=12):
+        """Hits on a zero-based page, running the search as far as it needs"""
+        with span('substructure.page', page=number) as stage:
+            # One extra hit tells whether a next page exists
+            self.fetch((number + 1) * size + 1)
+            stage.set(candidates=self.stats.get('candidates'))
+        return self.hits[number * size:(number + 1) * size]
+
+    def has_page(self, number, size=12):
+        """Whether the zero-based page has any hits"""
+        self.fetch(number * size + 1)
+        return len(self.hits) > number * size
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_substructure_index():
+    """Process-wide screening index over ``similarity.get_similarity_index()``"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = SubstructureIndex(get_similarity_index())
+    return _index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query the substructure screening index")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help="Fingerprint every compound of a similarity index")
+    build.add_argument('directory')
+    search = commands.add_parser('search', help="Compounds containing a SMARTS pattern")
+    search.add_argument('directory')
+    search.add_argument('smarts')
+    search.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    index = SubstructureIndex(SimilarityIndex(args.directory))
+    if args.command == 'build':
+        index.update(progress=lambda done, total: sys.stderr.write(f"\r{done}/{total}"))
+        sys.stderr.write(f"\nIndexed {len(index)} compounds in {args.directory}\n")
+        return 0
+    try:
+        results = SubstructureSearch(index, args.smarts)
+        for hit in results.page(0, args.limit):
+            print(f"{hit['smiles']}\t{hit['name'] or ''}")
+    except ValueError as e:
+        sys.stderr.write(f"{e}\n")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""Typeahead and did-you-mean suggestions for the molecule input
+
+Names come from the built-in compound table, past successful queries (the
+resolution cache) and, by prefix only, the offline compound dictionary. Prefix
+matches use a sorted list and bisection; typo-tolerant matches use a trigram
+index to find candidates, ranked by edit distance. Both stay in memory, so a
+lookup takes well under 10 ms.
+"""
+import bisect
+import threading
+from collections import Counter
+
+from resolver import COMMON_COMPOUNDS, SYNONYMS, normalize_name
+
+MAX_SUGGESTIONS = 6
+
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, limit):
+    """Optimal string alignment distance, or ``limit + 1`` once it exceeds ``limit``"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            cost = 0 if ca == cb else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if previous2 is not None and i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class SuggestionIndex:
+    """In-memory prefix and trigram index over compound names"""
+
+    def __init__(self, names=(), dictionary=None):
+        self.dictionary = dictionary
+        self._lock = threading.Lock()
+        self._names = []
+        self._known = set()
+        self._sorted = []
+        self._postings = {}
+        for name in names:
+            self.add(name)
+
+    @classmethod
+    def from_sources(cls, cache=None, dictionary=None):
+        """Index the built-in table, its synonyms and past cached queries"""
+        names = list(COMMON_COMPOUNDS) + list(SYNONYMS)
+        if cache is not None:
+            names += cache.queries()
+        return cls(names, dictionary=dictionary)
+
+    def add(self, name):
+        """Index a name, e.g. a query a name tier just resolved; never SMILES or InChI, which are case-sensitive"""
+        name = normalize_name(name)
+        with self._lock:
+            if not name or name in self._known:
+                return
+            index = len(self._names)
+            self._names.append(name)
+            self._known.add(name)
+            bisect.insort(self._sorted, name)
+            for gram in _trigrams(name):
+                self._postings.setdefault(gram, []).append(index)
+
+    def __contains__(self, name):
+        return normalize_name(name) in self._known
+
+    def suggest(self, text, limit=MAX_SUGGESTIONS):
+        """Prefix completions first, then close misspellings"""
+        query = normalize_name(text)
+        if not query:
+            return []
+        suggestions = self._prefix(query, limit)
+        if len(suggestions) < limit:
+            seen = {s['name'] for s in suggestions}
+            suggestions += [s for s in self._fuzzy(query, limit) if s['name'] not in seen]
+        return suggestions[:limit]
+
+    def did_you_mean(self, text):
+        """Closest known name to a query that is not itself known, or None"""
+        query = normalize_name(text)
+        if not query or query in self:
+            return None
+        matches = self._fuzzy(query, 1)
+        return matches[0]['name'] if matches else None
+
+    def _prefix(self, query, limit):
+        with self._lock:
+            start = bisect.bisect_left(self._sorted, query)
+            matches = []
+            for name in self._sorted[start:start + limit * 4]:
+                if not name.startswith(query):
+                    break
+                matches.append(name)
+        # Shortest completions are usually what is being typed
+        matches.sort(key=len)
+        suggestions = [{'name': name, 'kind': 'prefix'} for name in matches[:limit]]
+        if self.dictionary is not None and len(suggestions) < limit:
+            seen = {s['name'] for s in suggestions}
+            for name, _ in self.dictionary.prefix(query, limit):
+                if name not in seen and len(suggestions) < limit:
+                    suggestions.append({'name': name, 'kind': 'prefix'})
+        return suggestions
+
+    def _fuzzy(self, query, limit):
+        max_distance = 1 if len(query) <= 5 else 2
+        grams = _trigrams(query)
+        with self._lock:
+            shared = Counter()
+            for gram in grams:
+                shared.update(self._postings.get(gram, ()))
+            # Names sharing too few trigrams cannot be within the distance
+            needed = max(1, len(grams) - 3 * max_distance)
+            candidates = [self._names[i] for i, count in shared.most_common(200) if count >= needed]
+        scored = []
+        for name in candidates:
+            distance = edit_distance(query, name, max_distance)
+            if 0 < distance <= max_distance:
+                scored.append((distance, len(name), name))
+        scored.sort()
+        return [{'name': name, 'kind': 'fuzzy', 'distance': d} for d, _, name in scored[:limit]]
@@ -0,0 +1,262 @@
+"""Tracing spans and latency histograms for the visualization pipeline
+
+Each pipeline stage runs inside ``span(name)``, which times it and carries
+attributes such as ``cache_hit``, ``bytes`` or token counts. Finished spans
+feed process-wide metrics:
+
+    chemviz_stage_seconds          histogram per stage
+    chemviz_stage_errors_total     stages that raised
+    chemviz_cache_requests_total   cache lookups per stage, by hit/miss
+    chemviz_payload_bytes          histogram of payload sizes per stage
+    chemviz_llm_tokens_total       OpenAI tokens, by prompt/completion
+
+A ``trace()`` block additionally collects the spans of one request, nested
+by parent, for the debug panel. Spans follow ``contextvars``, so work handed
+to a thread with ``contextvars.copy_context()`` lands in the right trace.
+
+Metrics export as JSON or Prometheus text; set CHEMVIZ_METRICS_FILE to have
+the Prometheus text written there after every trace, e.g. for the node
+exporter's textfile collector.
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds: seconds and bytes
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7)
+
+_HELP = {
+    'chemviz_stage_seconds': ('histogram', "Time spent in each pipeline stage"),
+    'chemviz_stage_errors_total': ('counter', "Pipeline stages that raised an exception"),
+    'chemviz_cache_requests_total': ('counter', "Cache lookups by stage and result"),
+    'chemviz_payload_bytes': ('histogram', "Size of generated payloads by stage"),
+    'chemviz_llm_tokens_total': ('counter', "OpenAI tokens used, by kind"),
+    'chemviz_api_requests_total': ('counter', "HTTP API requests by endpoint and status"),
+    'chemviz_singleflight_total': ('counter', "Coalesced calls by kind and role (leader, shared, retry)"),
+}
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating within its bucket"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                # The observed range is tighter than the outer buckets
+                lower = max(self.buckets[i - 1] if i else 0.0, self.min)
+                upper = min(self.buckets[i] if i < len(self.buckets) else self.max, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Metrics:
+    """Thread-safe registry of histograms and counters keyed by name and labels"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def snapshot(self):
+        """Plain-dict copy of every metric, as exported to JSON"""
+        with self._lock:
+            histograms = [
+                {'name': name, 'labels': dict(labels), 'count': h.count, 'sum': h.sum,
+                 'p50': h.quantile(0.5), 'p95': h.quantile(0.95),
+                 'buckets': dict(zip([*map(str, h.buckets), '+Inf'], h.counts))}
+                for (name, labels), h in sorted(self._histograms.items())
+            ]
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+        return {'histograms': histograms, 'counters': counters}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        """Prometheus text exposition format"""
+        def labels_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+            return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described and name in _HELP:
+                kind, text = _HELP[name]
+                lines.extend([f"# HELP {name} {text}", f"# TYPE {name} {kind}"])
+            described.add(name)
+
+        with self._lock:
+            for (name, labels), h in sorted(self._histograms.items()):
+                describe(name)
+                cumulative = 0
+                for bound, count in zip([*map(repr, h.buckets), '+Inf'], h.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{labels_text(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{labels_text(labels)} {h.sum!r}")
+                lines.append(f"{name}_count{labels_text(labels)} {h.count}")
+            for (name, labels), value in sorted(self._counters.items()):
+                describe(name)
+                lines.append(f"{name}{labels_text(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+_trace = contextvars.ContextVar('chemviz_trace', default=None)
+_current = contextvars.ContextVar('chemviz_span', default=None)
+
+
+class Span:
+    """One timed stage; ``set`` adds attributes while it runs"""
+
+    def __init__(self, name, attributes, parent):
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent is not None else 0
+        self.started = time.time()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def as_dict(self):
+        return {'name': self.name, 'depth': self.depth, 'started': self.started,
+                'ms': round(self.duration * 1000, 2) if self.duration is not None else None,
+                'error': self.error, **self.attributes}
+
+
+def _record(span):
+    stage = span.name
+    metrics.observe('chemviz_stage_seconds', span.duration, stage=stage)
+    if span.error:
+        metrics.increment('chemviz_stage_errors_total', stage=stage)
+    attributes = span.attributes
+    if 'cache_hit' in attributes:
+        metrics.increment('chemviz_cache_requests_total', stage=stage,
+                          result='hit' if attributes['cache_hit'] else 'miss')
+    if attributes.get('bytes') is not None:
+        metrics.observe('chemviz_payload_bytes', attributes['bytes'], SIZE_BUCKETS, stage=stage)
+    for kind in ('prompt', 'completion'):
+        if attributes.get(f'{kind}_tokens'):
+            metrics.increment('chemviz_llm_tokens_total', attributes[f'{kind}_tokens'], kind=kind)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Time a pipeline stage; yields the ``Span`` so attributes can be added"""
+    current = Span(name, attributes, _current.get())
+    spans = _trace.get()
+    if spans is not None:
+        spans.append(current)
+    token = _current.set(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.duration = time.perf_counter() - started
+        _current.reset(token)
+        _record(current)
+
+
+def traced(name):
+    """Decorator form of ``span`` for a whole function"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@contextlib.contextmanager
+def trace():
+    """Collect the spans of one request; yields the list they are appended to"""
+    spans = []
+    token = _trace.set(spans)
+    try:
+        yield spans
+    finally:
+        _trace.reset(token)
+        export_textfile()
+
+
+def export_textfile(path=None):
+    """Write Prometheus text to CHEMVIZ_METRICS_FILE (or ``path``), atomically"""
+    path = path or os.getenv('CHEMVIZ_METRICS_FILE')
+    if not path:
+        return
+    try:
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as handle:
+            handle.write(metrics.to_prometheus())
+        os.replace(temporary, path)
+    except OSError:
+        logger.exception("Could not write metrics to %s", path)
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stand_in import StandIn  # noqa: E402
+
+
+@pytest.fixture
+def stand_in():
+    """Start local stand-in servers for a test: ``stand_in(handler)``"""
+    servers = []
+
+    def start(handler):
+        server = StandIn(handler)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
@@ -0,0 +1,71 @@
+"""Local HTTP stand-in for PubChem and OpenAI-compatible servers"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def chat_completion(content, model='stand-in'):
+    """Minimal chat completion response carrying ``content``"""
+    return {
+        'id': 'chatcmpl-stand-in', 'object': 'chat.completion', 'created': 0, 'model': model,
+        'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+        'usage': {'prompt_tokens': 10, 'completion_tokens': 10, 'total_tokens': 20},
+    }
+
+
+def property_table(*rows):
+    """PUG-REST property table response"""
+    return {'PropertyTable': {'Properties': list(rows)}}
+
+
+class StandIn:
+    """Server answering every request with ``handler(method, path, body)``
+
+    The handler returns ``(status, payload)``, payload being JSON-ready or
+    None, and may sleep to simulate a slow service. Requests are recorded
+    with the time they arrived and the client port they came from.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+        self._lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._answer()
+
+            def do_POST(self):
+                self._answer()
+
+            def _answer(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode() if length else ''
+                with stand_in._lock:
+                    stand_in.requests.append({'method': self.command, 'path': self.path, 'body': body,
+                                              'time': time.monotonic(), 'port': self.client_address[1]})
+                status, payload = stand_in.handler(self.command, self.path, body)
+                data = json.dumps(payload).encode() if payload is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        # Slow handlers a test has given up on must not hold up its teardown
+        self.server.daemon_threads = True
+        self.server.block_on_close = False
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,22 @@
+import gzip
+import os
+
+import pytest
+from streamlit.testing.v1 import AppTest
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+PDB = b"".join(
+    b"ATOM  %5d  CA  ALA A%4d    %8.3f%8.3f%8.3f  1.00  0.00           C\n" % (i, i, i * 3.8, 0.0, 0.0)
+    for i in range(1, 200)
+)
+
+
+@pytest.mark.parametrize('name', ['protein.pdb.gz', 'frames.xyz.gz'])
+def test_truncated_gzip_upload_is_reported(name):
+    truncated = gzip.compress(PDB)[:200]
+    at = AppTest.from_file(APP, default_timeout=60)
+    at.run()
+    at.file_uploader[0].set_value((name, truncated, 'application/gzip'))
+    at.run()
+    assert not at.exception
+    assert any('Could not read' in error.value for error in at.error)
@@ -0,0 +1,23 @@
+import pytest
+
+from batch import count_inputs, main, read_inputs
+
+CSV = "id,Name,smiles\n1,ethanol,CCO\n2,,CO\n3,benzene,\n\n4,water,O\n"
+
+
+def test_count_matches_the_rows_read(tmp_path):
+    path = tmp_path / 'molecules.csv'
+    path.write_text(CSV)
+    for column in (None, 'name', 'SMILES'):
+        assert count_inputs(str(path), column) == len(list(read_inputs(str(path), column)))
+    assert list(read_inputs(str(path), 'name')) == ['ethanol', 'benzene', 'water']
+    assert list(read_inputs(str(path))) == ['CCO', 'CO', 'O']
+
+
+def test_unknown_column_is_a_usage_error(tmp_path, capsys):
+    path = tmp_path / 'molecules.csv'
+    path.write_text(CSV)
+    with pytest.raises(SystemExit) as exit:
+        main([str(path), '-o', str(tmp_path / 'out.parquet'), '--column', 'inchi'])
+    assert exit.value.code == 2
+    assert "columns: id, Name, smiles" in capsys.readouterr().err
@@ -0,0 +1,59 @@
+import sqlite3
+
+from cache import ResolutionCache
+
+ETHANOL = {'name': 'ethanol', 'smiles': 'CCO'}
+METHANOL = {'name': 'methanol', 'smiles': 'CO'}
+
+
+def _counters(path):
+    conn = sqlite3.connect(path)
+    try:
+        return dict(conn.execute("SELECT name, value FROM counters").fetchall())
+    finally:
+        conn.close()
+
+
+def test_lookups_are_counted_in_memory_until_flushed(tmp_path):
+    path = str(tmp_path / 'resolution.sqlite3')
+    cache = ResolutionCache(path)
+    cache.put('ethanol', ETHANOL)
+    for _ in range(3):
+        assert cache.get('ethanol')['smiles'] == 'CCO'
+    assert cache.get('water') is None
+
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert _counters(path) == {}
+
+    cache.flush()
+    assert _counters(path) == {'hits': 3, 'misses': 1}
+    cache.get('ethanol')
+    cache.close()
+    assert _counters(path) == {'hits': 4, 'misses': 1}
+
+
+def test_eviction_sees_lookups_not_yet_flushed(tmp_path):
+    cache = ResolutionCache(str(tmp_path / 'resolution.sqlite3'), max_entries=2)
+    cache.put('ethanol', ETHANOL)
+    cache.put('methanol', METHANOL)
+    cache.get('ethanol')
+    cache.put('propane', {'name': 'propane', 'smiles': 'CCC'})
+
+    assert cache.get('ethanol') is not None
+    assert cache.get('methanol') is None
+    assert cache.stats()['total_hits'] == 2
+    cache.close()
+
+
+def test_expired_entries_are_misses_removed_by_the_next_put(tmp_path):
+    path = str(tmp_path / 'resolution.sqlite3')
+    cache = ResolutionCache(path, ttl_seconds=60)
+    cache.put('ethanol', ETHANOL)
+    cache._conn.execute("UPDATE molecules SET created_at = created_at - 120")
+
+    assert cache.get('ethanol') is None
+    assert cache.stats()['entries'] == 1
+    cache.put('methanol', METHANOL)
+    assert cache.stats()['entries'] == 1
+    assert cache.get('methanol') is not None
+    cache.close()
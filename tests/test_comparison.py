@@ -0,0 +1,24 @@
+import numpy as np
+from rdkit import Chem
+from rdkit.Chem import AllChem
+
+from comparison import align_molecules
+
+
+def embedded(smiles, seed):
+    mol = Chem.AddHs(Chem.MolFromSmiles(smiles))
+    AllChem.EmbedMolecule(mol, randomSeed=seed)
+    return mol
+
+
+def test_align_molecules_leaves_inputs_untouched():
+    molecules = [embedded('OC(=O)c1ccccc1O', 1), embedded('CC(=O)Oc1ccccc1C(=O)O', 2),
+                 embedded('NC(=O)c1ccccc1O', 3)]
+    before = [mol.GetConformer().GetPositions().copy() for mol in molecules]
+
+    aligned = align_molecules(molecules, workers=1)
+
+    for mol, positions in zip(molecules, before):
+        assert np.array_equal(mol.GetConformer().GetPositions(), positions)
+    assert [mol.GetProp('alignment') for mol in aligned] == ['reference', 'mmff', 'mmff']
+    assert not np.allclose(aligned[1].GetConformer().GetPositions(), before[1])
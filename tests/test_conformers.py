@@ -0,0 +1,25 @@
+import conformers
+from conformers import ConformerStore, build_3d_molecule
+from embedding import flat_coordinates
+
+
+def test_fallback_embeddings_are_not_stored(tmp_path, monkeypatch):
+    store = ConformerStore(str(tmp_path / 'conformers.sqlite3'))
+    monkeypatch.setattr(conformers, 'embed_smiles',
+                        lambda smiles, **kwargs: (flat_coordinates(smiles) + 1.0, 'random_coords'))
+    mol = build_3d_molecule('CCO', store=store)
+    assert mol.GetProp('embedding') == 'random_coords'
+    assert store.get('CCO') is None
+
+    monkeypatch.undo()
+    assert build_3d_molecule('CCO', store=store).GetProp('embedding') == 'etkdg'
+    assert store.get('CCO').GetProp('embedding') == 'etkdg'
+
+
+def test_stored_fallback_is_not_reused(tmp_path):
+    store = ConformerStore(str(tmp_path / 'conformers.sqlite3'))
+    mol = conformers.mol_from_coordinates('CCO', flat_coordinates('CCO') + 1.0, 'random_coords')
+    # As written by earlier versions, which kept random-coordinate results
+    store.put('CCO', mol)
+    assert store.get('CCO') is None
+    assert build_3d_molecule('CCO', store=store).GetProp('embedding') == 'etkdg'
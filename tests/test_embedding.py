@@ -0,0 +1,24 @@
+import time
+
+from rdkit import Chem
+
+from embedding import choose_profile, embed_smiles, needs_isolation
+
+# 50 heavy atoms: the multi-conformer medium profile
+MEDIUM = 'CC(C)' * 16 + 'CC'
+
+
+def test_only_small_molecules_embed_in_process():
+    assert not needs_isolation(Chem.MolFromSmiles('CC(=O)Oc1ccccc1C(=O)O'))
+    mol = Chem.MolFromSmiles(MEDIUM)
+    assert choose_profile(mol) == 'medium'
+    assert needs_isolation(mol)
+
+
+def test_medium_molecule_keeps_to_the_budget():
+    started = time.monotonic()
+    positions, path = embed_smiles(MEDIUM, budget=0.3)
+    # The child process is killed; the flat layout is the last resort
+    assert path == '2d'
+    assert positions.shape == (Chem.AddHs(Chem.MolFromSmiles(MEDIUM)).GetNumAtoms(), 3)
+    assert time.monotonic() - started < 3.0
@@ -0,0 +1,28 @@
+import threading
+import time
+
+from ensembles import build_ensemble
+
+# 40 heavy atoms: the largest molecule of the small profile
+SMALL_LIMIT = 'C' * 40
+
+
+def test_ensemble_keeps_to_the_budget_at_any_size():
+    started = time.monotonic()
+    assert build_ensemble(SMALL_LIMIT, budget=1.0) is None
+    assert time.monotonic() - started < 3.0
+
+
+def test_cancelled_ensemble_stops_early():
+    cancel = threading.Event()
+    threading.Timer(0.3, cancel.set).start()
+    started = time.monotonic()
+    assert build_ensemble(SMALL_LIMIT, budget=30.0, cancel=cancel) is None
+    assert time.monotonic() - started < 3.0
+
+
+def test_small_molecule_ensemble_is_ordered_by_energy():
+    ensemble = build_ensemble('CCCCO', budget=30.0)
+    energies = [conf.GetDoubleProp('energy') for conf in ensemble.GetConformers()]
+    assert energies[0] == 0.0
+    assert energies == sorted(energies)
@@ -0,0 +1,83 @@
+import json
+import time
+
+import openai  # noqa: F401  (imported up front so it is not timed)
+import pytest
+
+from pubchem import PubChemClient
+from service import ChemVizService
+from stand_in import chat_completion, property_table
+
+ASPIRIN = 'CC(=O)Oc1ccccc1C(=O)O'
+
+
+@pytest.fixture
+def remote(stand_in, monkeypatch):
+    """Service racing a stand-in PubChem against a stand-in OpenAI
+
+    ``delays`` sets how long each source takes and ``answers`` what the
+    OpenAI stand-in replies with.
+    """
+    delays = {'pubchem': 0.0, 'llm': 0.0}
+    answers = {'llm': {'smiles': ASPIRIN, 'common_name': 'aspirin', 'molecular_formula': 'C9H8O4'}}
+
+    def handler(method, path, body):
+        if path.startswith('/pubchem'):
+            time.sleep(delays['pubchem'])
+            return 200, property_table({'CID': 2244, 'IsomericSMILES': ASPIRIN, 'MolecularFormula': 'C9H8O4',
+                                        'MolecularWeight': '180.16', 'IUPACName': '2-acetyloxybenzoic acid'})
+        time.sleep(delays['llm'])
+        return 200, chat_completion(json.dumps(answers['llm']))
+
+    server = stand_in(handler)
+    monkeypatch.setenv('OPENAI_BASE_URL', f"{server.url}/v1")
+    monkeypatch.setenv('OPENAI_API_KEY', 'stand-in')
+    errors = []
+
+    def make(**env):
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        service = ChemVizService(cache=None, conformer_store=None, report_error=errors.append, hedge=True,
+                                 offline=False, pubchem_client=PubChemClient(f"{server.url}/pubchem", retries=0))
+        return service
+
+    return make, delays, answers, errors
+
+
+def resolve(service, name):
+    started = time.monotonic()
+    record = service.parse_chemical_input(name)
+    return record, time.monotonic() - started
+
+
+def test_fastest_source_wins(remote):
+    make, delays, _, _ = remote
+    delays['llm'] = 2.0
+    record, seconds = resolve(make(), 'hedge-race-pubchem')
+    assert record['source'] == 'pubchem'
+    assert seconds < 1.5
+
+    delays.update(pubchem=2.0, llm=0.0)
+    record, seconds = resolve(make(), 'hedge-race-llm')
+    assert record['source'] == 'llm'
+    assert seconds < 1.5
+
+
+def test_source_deadline_abandons_slow_source(remote):
+    make, delays, answers, errors = remote
+    delays['pubchem'] = 3.0
+    answers['llm'] = {'smiles': None, 'description': 'not a compound'}
+    record, seconds = resolve(make(CHEMVIZ_PUBCHEM_DEADLINE=0.3), 'hedge-deadline')
+    assert record is None
+    assert seconds < 2.0
+    assert 'pubchem: deadline exceeded' in errors[-1]
+    assert 'llm: no valid structure' in errors[-1]
+
+
+def test_overall_budget_bounds_the_lookup(remote):
+    make, delays, _, errors = remote
+    delays.update(pubchem=3.0, llm=3.0)
+    record, seconds = resolve(make(CHEMVIZ_RESOLVE_BUDGET=0.5), 'hedge-budget')
+    assert record is None
+    assert seconds < 2.0
+    assert 'latency budget of 0.5s exceeded' in errors[-1]
@@ -0,0 +1,67 @@
+import json
+
+import openai
+import pytest
+
+from llm_batch import BatchLLMResolver
+from stand_in import chat_completion
+
+KNOWN = {'caffeine': 'Cn1cnc2c1c(=O)n(C)c(=O)n2C', 'ethanol': 'OCC', 'benzene': 'c1ccccc1',
+         'menthol': 'CC(C)C1CCC(C)CC1O', 'glycine': 'NCC(=O)O', 'urea': 'NC(N)=O', 'acetone': 'CC(C)=O',
+         'broken': 'C1CC('}
+
+
+def answer(items):
+    return [{'index': item['index'], 'smiles': KNOWN.get(item['input']), 'iupac_name': None,
+             'common_name': item['input'], 'molecular_formula': 'wrong', 'description': None, 'pubchem_cid': None}
+            for item in items]
+
+
+@pytest.fixture
+def llm(stand_in, monkeypatch):
+    """Resolver against a stand-in OpenAI server; returns it and the batches sent"""
+    batches = []
+    behaviour = {'malformed': False}
+
+    def handler(method, path, body):
+        request = json.loads(body)
+        assert request['response_format']['json_schema']['strict']
+        items = json.loads(request['messages'][-1]['content'])
+        batches.append([item['input'] for item in items])
+        if behaviour['malformed'] and len(items) > 1:
+            return 200, chat_completion('{"results": [{"index": 0, "smiles"')
+        return 200, chat_completion(json.dumps({'results': answer(items)}))
+
+    server = stand_in(handler)
+    monkeypatch.setenv('OPENAI_BASE_URL', f"{server.url}/v1")
+    client = openai.OpenAI(api_key='stand-in', max_retries=0)
+    return BatchLLMResolver(client, 'stand-in', batch_size=3, concurrency=1), batches, behaviour
+
+
+def test_inputs_are_sent_in_chunks(llm):
+    resolver, batches, _ = llm
+    names = ['caffeine', 'ethanol', 'benzene', 'menthol', 'glycine', 'urea', 'acetone']
+    records = resolver.resolve_many(names + ['ethanol'])
+    assert batches == [names[0:3], names[3:6], names[6:]]
+    assert list(records) == names
+    assert records['ethanol']['smiles'] == 'CCO'
+    # Formulas are recomputed from the SMILES, not taken from the reply
+    assert records['caffeine']['molecular_formula'] == 'C8H10N4O2'
+
+
+def test_malformed_batch_reply_falls_back_to_single_requests(llm):
+    resolver, batches, behaviour = llm
+    behaviour['malformed'] = True
+    records = resolver.resolve_many(['caffeine', 'ethanol', 'benzene'])
+    assert batches == [['caffeine', 'ethanol', 'benzene'], ['caffeine'], ['ethanol'], ['benzene']]
+    assert all(record is not None for record in records.values())
+
+
+def test_invalid_smiles_is_rejected_and_retried_alone(llm):
+    resolver, batches, _ = llm
+    records = resolver.resolve_many(['caffeine', 'broken', 'nonsense'])
+    assert records['caffeine']['smiles'] == 'Cn1c(=O)c2c(ncn2C)n(C)c1=O'
+    assert records['broken'] is None
+    # A null SMILES is the model's final answer; an unparsable one is retried once
+    assert batches == [['caffeine', 'broken', 'nonsense'], ['broken']]
+    assert records['nonsense'] is None
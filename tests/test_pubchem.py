@@ -0,0 +1,88 @@
+import time
+import urllib.parse
+
+from pubchem import PubChemClient
+from stand_in import property_table
+
+SMILES = {'aspirin': 'CC(=O)Oc1ccccc1C(=O)O', 'caffeine': 'Cn1cnc2c1c(=O)n(C)c(=O)n2C', 'ethanol': 'CCO'}
+
+
+def row(cid, smiles):
+    return {'CID': cid, 'IsomericSMILES': smiles, 'MolecularFormula': 'X', 'MolecularWeight': '1.0'}
+
+
+def by_name(method, path, body):
+    name = urllib.parse.unquote(path.split('/')[3])
+    if name not in SMILES:
+        return 404, {'Fault': {'Code': 'PUGREST.NotFound'}}
+    return 200, property_table(row(list(SMILES).index(name) + 1, SMILES[name]))
+
+
+def test_connections_are_kept_alive(stand_in):
+    server = stand_in(by_name)
+    client = PubChemClient(server.url, rate=100)
+    for _ in range(5):
+        assert client.properties_by_name('aspirin')['smiles'] == SMILES['aspirin']
+    assert len(server.requests) == 5
+    assert len({request['port'] for request in server.requests}) == 1
+
+
+def test_requests_respect_the_rate_limit(stand_in):
+    server = stand_in(by_name)
+    client = PubChemClient(server.url, rate=20)
+    # Times the requests were let through; server arrival times add thread scheduling jitter
+    granted = []
+    acquire = client.bucket.acquire
+    client.bucket.acquire = lambda: acquire() or granted.append(time.monotonic())
+    client.lookup_names([f'aspirin{i}' for i in range(30)])
+    assert len(server.requests) == 30
+    granted.sort()
+    # No second, including the first, holds more than 20 requests
+    assert all(last - first >= 1.0 for first, last in zip(granted, granted[20:]))
+
+
+def test_cids_are_batched(stand_in):
+    def handler(method, path, body):
+        cids = [int(cid) for cid in urllib.parse.parse_qs(body)['cid'][0].split(',')]
+        return 200, property_table(*(row(cid, 'C') for cid in cids))
+
+    server = stand_in(handler)
+    records = PubChemClient(server.url, rate=100).properties_by_cids(range(1, 251))
+    assert sorted(records) == list(range(1, 251))
+    assert [request['method'] for request in server.requests] == ['POST'] * 3
+    assert [len(urllib.parse.parse_qs(request['body'])['cid'][0].split(',')) for request in server.requests] == \
+        [100, 100, 50]
+
+
+def test_unknown_name_is_none(stand_in):
+    server = stand_in(by_name)
+    assert PubChemClient(server.url, rate=100).properties_by_name('unobtainium') is None
+
+
+def test_failed_name_does_not_fail_bulk_lookup(stand_in):
+    def handler(method, path, body):
+        if 'broken' in path:
+            return 500, None
+        return by_name(method, path, body)
+
+    server = stand_in(handler)
+    found = PubChemClient(server.url, rate=100, retries=0).lookup_names(['aspirin', 'broken', 'caffeine', 'nothing'])
+    assert found['aspirin']['smiles'] == SMILES['aspirin']
+    assert found['caffeine']['smiles'] == SMILES['caffeine']
+    assert found['broken'] is None and found['nothing'] is None
+
+
+def test_retries_take_tokens(stand_in):
+    answers = [(503, None), (503, None)]
+
+    def handler(method, path, body):
+        return answers.pop(0) if answers else by_name(method, path, body)
+
+    server = stand_in(handler)
+    client = PubChemClient(server.url, rate=100, backoff=0.01)
+    taken = []
+    acquire = client.bucket.acquire
+    client.bucket.acquire = lambda: taken.append(1) or acquire()
+    assert client.properties_by_name('ethanol')['smiles'] == 'CCO'
+    assert len(server.requests) == 3
+    assert len(taken) == 3
@@ -0,0 +1,60 @@
+import multiprocessing
+import os
+
+import numpy as np
+from rdkit import Chem
+
+from similarity import SimilarityIndex, _smiles_key
+
+ALKANES = [('C' * n, f'C{n}') for n in range(1, 13)]
+ALCOHOLS = [('C' * n + 'O', f'C{n}OH') for n in range(1, 13)]
+
+
+def assert_aligned(index):
+    # Every key, count and fingerprint row belongs to the record at its position
+    for row in range(len(index)):
+        smiles = index.record(row)['smiles']
+        mol = Chem.MolFromSmiles(smiles)
+        assert index._keys[row] == _smiles_key(smiles)
+        assert np.array_equal(index._fingerprints[row], index.fingerprint(mol))
+        assert index._counts[row] == int(np.unpackbits(index.fingerprint(mol)).sum())
+
+
+def test_interrupted_append_is_dropped(tmp_path):
+    index = SimilarityIndex(str(tmp_path))
+    index.add_many(ALKANES[:4])
+    # A crash after some files were extended but before record_ends.bin was
+    for name, size in (('fingerprints.bin', index.width * 3), ('counts.bin', 6), ('keys.bin', 24),
+                       ('records.bin', 90), ('record_ends.bin', 5)):
+        with open(os.path.join(tmp_path, name), 'ab') as handle:
+            handle.write(os.urandom(size))
+
+    reopened = SimilarityIndex(str(tmp_path))
+    assert len(reopened) == 4
+    assert reopened.add_many(ALKANES[4:8]) == 4
+    assert len(reopened) == 8
+    assert_aligned(reopened)
+    assert reopened.search('CCCCCCC', k=1, exclude_self=False)[0] == {'smiles': 'CCCCCCC', 'name': 'C7',
+                                                                       'similarity': 1.0}
+
+
+def _append(directory, compounds):
+    index = SimilarityIndex(directory)
+    for compound in compounds:
+        index.add_many([compound])
+
+
+def test_concurrent_processes_append_safely(tmp_path):
+    SimilarityIndex(str(tmp_path))
+    context = multiprocessing.get_context('spawn')
+    writers = [context.Process(target=_append, args=(str(tmp_path), compounds))
+               for compounds in (ALKANES, ALCOHOLS)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+        assert writer.exitcode == 0
+
+    index = SimilarityIndex(str(tmp_path))
+    assert len(index) == len(ALKANES) + len(ALCOHOLS)
+    assert_aligned(index)
@@ -0,0 +1,45 @@
+import threading
+
+from singleflight import SingleFlight
+
+
+def test_every_caller_gets_its_own_copy():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def work():
+        started.set()
+        release.wait(5)
+        return {'atoms': [1, 2, 3]}
+
+    def slow_copy(result):
+        # Leaves the leader's caller time to change its result mid-copy
+        threading.Event().wait(0.1)
+        return {'atoms': list(result['atoms'])}
+
+    results = []
+
+    def leader():
+        result = flights.do(('embed', 'x'), work, share=slow_copy)
+        result['atoms'].append('changed by the leader')
+        results.append(result)
+
+    def waiter():
+        results.append(flights.do(('embed', 'x'), work, share=slow_copy))
+
+    threads = [threading.Thread(target=leader)]
+    threads[0].start()
+    started.wait(5)
+    threads += [threading.Thread(target=waiter) for _ in range(3)]
+    for thread in threads[1:]:
+        thread.start()
+    # Let the waiters join the flight before the leader finishes
+    threading.Event().wait(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(results) == 4
+    assert len({id(result) for result in results}) == 4
+    assert sum(result['atoms'] == [1, 2, 3] for result in results) == 3
+    assert flights.stats()['calls']['embed'] == {'leader': 1, 'shared': 3, 'retry': 0}
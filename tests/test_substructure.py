@@ -0,0 +1,30 @@
+import os
+
+import numpy as np
+from rdkit import Chem
+
+from similarity import SimilarityIndex
+from substructure import SubstructureIndex, pattern_fingerprint
+
+COMPOUNDS = [('c1ccccc1O', 'phenol'), ('CCO', 'ethanol'), ('c1ccccc1C(=O)O', 'benzoic acid'),
+             ('CC(=O)Oc1ccccc1C(=O)O', 'aspirin'), ('CCN', 'ethylamine'), ('OC(=O)c1ccccc1O', 'salicylic acid')]
+
+
+def test_torn_pattern_row_is_dropped(tmp_path):
+    library = SimilarityIndex(str(tmp_path))
+    library.add_many(COMPOUNDS[:3])
+    index = SubstructureIndex(library, workers=1)
+    index.update()
+    # An update interrupted part-way through a row
+    with open(os.path.join(tmp_path, 'patterns.bin'), 'ab') as handle:
+        handle.write(os.urandom(index.width // 2))
+
+    library.add_many(COMPOUNDS[3:])
+    index = SubstructureIndex(library, workers=1)
+    index.update()
+    assert len(index) == len(COMPOUNDS)
+    for row in range(len(index)):
+        mol = Chem.MolFromSmiles(library.record(row)['smiles'])
+        assert np.array_equal(index._patterns[row], pattern_fingerprint(mol))
+    names = {hit['name'] for hit in index.search('c1ccccc1C(=O)[OH]')}
+    assert names == {'benzoic acid', 'aspirin', 'salicylic acid'}
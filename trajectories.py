@@ -0,0 +1,154 @@
+"""Multi-frame coordinates: conformer ensembles and uploaded MD trajectories
+
+A ``Trajectory`` is one topology (elements and bonds) plus a stack of float32
+frames. Multi-model PDB and multi-frame XYZ files are streamed frame by
+frame; at most ``MAX_FRAMES`` are kept, evenly spaced, by doubling the stride
+whenever the buffer fills, so memory stays bounded for any trajectory
+length. Large PDB systems are reduced with ``structures.level_of_detail``
+before any frame is stored.
+"""
+import gzip
+import os
+
+import numpy as np
+
+from structures import distance_bonds, level_of_detail, read_pdb
+from telemetry import traced
+
+MAX_FRAMES = 300
+# XYZ frames above this many atoms keep heavy atoms only
+MAX_XYZ_ATOMS = 5000
+
+
+class Trajectory:
+    """Topology plus (frames, atoms, 3) float32 coordinates"""
+
+    def __init__(self, elements, bonds, frames, orders=None, labels=None, stride=1):
+        self.elements = list(elements)
+        self.bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+        self.orders = np.ones(len(self.bonds), dtype=np.uint8) if orders is None else np.asarray(orders, dtype=np.uint8)
+        self.frames = np.asarray(frames, dtype=np.float32)
+        self.labels = list(labels or [])
+        self.stride = stride
+
+    def __len__(self):
+        return len(self.frames)
+
+    @classmethod
+    def from_molecule(cls, mol):
+        """Every conformer of an RDKit molecule as a frame, labelled by energy"""
+        from rdkit import Chem
+
+        mol = Chem.Mol(mol)
+        Chem.Kekulize(mol, clearAromaticFlags=True)
+        bonds = mol.GetBonds()
+        conformers = list(mol.GetConformers())
+        return cls(
+            elements=[atom.GetSymbol() for atom in mol.GetAtoms()],
+            bonds=[(b.GetBeginAtomIdx(), b.GetEndAtomIdx()) for b in bonds],
+            orders=[int(b.GetBondTypeAsDouble()) for b in bonds],
+            frames=[conf.GetPositions() for conf in conformers],
+            labels=[f"ΔE {conf.GetDoubleProp('energy'):.2f} kcal/mol" if conf.HasProp('energy') else ''
+                    for conf in conformers],
+        )
+
+
+class _FrameSampler:
+    # Keeps every stride-th frame; halves the buffer and doubles the stride when full
+
+    def __init__(self, max_frames):
+        self.max_frames = max_frames
+        self.stride = 1
+        self.frames = []
+        self.labels = []
+
+    def wants(self, index):
+        return index % self.stride == 0
+
+    def add(self, coords, label):
+        self.frames.append(coords)
+        self.labels.append(label)
+        if len(self.frames) > self.max_frames:
+            self.frames = self.frames[::2]
+            self.labels = self.labels[::2]
+            self.stride *= 2
+
+
+def read_xyz_trajectory(lines, max_frames=MAX_FRAMES):
+    """Multi-frame XYZ lines (bytes) into a Trajectory"""
+    lines = iter(lines)
+    sampler = _FrameSampler(max_frames)
+    elements, keep = None, None
+    for index, header in enumerate(lines):
+        if not header.strip():
+            break
+        count = int(header)
+        comment = next(lines).strip().decode('utf-8', 'replace')[:60]
+        block = [next(lines) for _ in range(count)]
+        if elements is None:
+            symbols = [line.split()[0] for line in block]
+            keep = np.arange(count)
+            if count > MAX_XYZ_ATOMS:
+                keep = np.array([i for i, s in enumerate(symbols) if s.upper() != b'H'])
+            elements = [symbols[i].decode() for i in keep]
+        if sampler.wants(index):
+            coords = np.array([line.split()[1:4] for line in block], dtype=np.float32)[keep]
+            sampler.add(coords, comment)
+    if elements is None:
+        raise ValueError("no frames found")
+    frames = np.stack(sampler.frames)
+    bonds = distance_bonds([e.upper().encode() for e in elements], frames[0])
+    return Trajectory(elements, bonds, frames, labels=sampler.labels, stride=sampler.stride)
+
+
+def _pdb_models(lines):
+    # Atom lines of each model in turn
+    model = []
+    for line in lines:
+        record = line[:6]
+        if record == b'ATOM  ' or record == b'HETATM':
+            if line[16:17] in (b' ', b'A', b''):
+                model.append(line)
+        elif record == b'ENDMDL' and model:
+            yield model
+            model = []
+    if model:
+        yield model
+
+
+def read_pdb_trajectory(lines, max_frames=MAX_FRAMES):
+    """Multi-model PDB lines (bytes) into a Trajectory, reduced by level of detail"""
+    sampler = _FrameSampler(max_frames)
+    view, structure = None, None
+    for index, model in enumerate(_pdb_models(lines)):
+        if structure is None:
+            structure = read_pdb(model)
+            view = level_of_detail(structure)
+        if not sampler.wants(index):
+            continue
+        if len(model) != len(structure):
+            raise ValueError(f"model {index + 1} has {len(model)} atoms, expected {len(structure)}")
+        coords = np.array([(line[30:38], line[38:46], line[46:54]) for line in model], dtype=np.float32)
+        sampler.add(coords[view['index']], f"model {index + 1}")
+    if structure is None:
+        raise ValueError("no models found")
+    elements = [e.decode().capitalize() for e in structure.elements[view['index']]]
+    return Trajectory(elements, view['bonds'], np.stack(sampler.frames), labels=sampler.labels, stride=sampler.stride)
+
+
+def is_trajectory_file(name):
+    """XYZ files are always played as trajectories"""
+    name = name.lower()
+    return name.endswith(('.xyz', '.xyz.gz'))
+
+
+@traced('trajectory.load')
+def load_trajectory(source, name=None, max_frames=MAX_FRAMES):
+    """Load an XYZ or multi-model PDB trajectory from a path or binary file object"""
+    name = name or getattr(source, 'name', None) or str(source)
+    reader = read_xyz_trajectory if is_trajectory_file(name) else read_pdb_trajectory
+    compressed = name.lower().endswith('.gz')
+    if isinstance(source, (str, os.PathLike)):
+        with (gzip.open(source, 'rb') if compressed else open(source, 'rb')) as handle:
+            return reader(handle, max_frames)
+    return reader(gzip.GzipFile(fileobj=source) if compressed else source, max_frames)
@@ -0,0 +1,465 @@
+"""Lean 3Dmol.js viewer: compact coordinate payload and a cached library
+
+The viewer document carries only what changes per molecule: element symbols,
+float32 coordinates and bonds as base64 typed arrays, which is several times
+smaller than a MolBlock. 3Dmol.js itself is loaded from ``static/`` through
+Streamlit's static file serving, so the browser caches it once and the app
+works offline. Without a local copy the library comes from the CDN, unless
+CHEMVIZ_VIEWER_CDN=0 (the default under CHEMVIZ_OFFLINE=1) rules that out;
+either way the viewer says so instead of staying blank when it cannot load.
+
+The same compact form carries PDB/mmCIF structures, at the level of detail
+chosen by ``structures.level_of_detail``, and trajectories, whose frames after
+the first travel as zlib-compressed int16 coordinate deltas. Many molecules
+can share one viewer, on a grid or overlaid, as a single model. Every viewer
+reports its payload size and time to first frame in a corner overlay and on
+the browser console.
+
+Usage:
+    python viewer.py fetch    # download 3Dmol-min.js into static/
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import sys
+import zlib
+from html import escape
+
+import numpy as np
+from rdkit import Chem
+
+logger = logging.getLogger(__name__)
+
+LIBRARY_NAME = '3Dmol-min.js'
+CDN_URL = 'https://3Dmol.csb.pitt.edu/build/3Dmol-min.js'
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+# Where Streamlit serves static/ when server.enableStaticServing is on
+STATIC_URL = 'app/static'
+
+DEFAULT_COLOR = '#FF1493'
+HIGHLIGHT_COLOR = '#FFD60A'
+
+# 3Dmol.js atom styles for molecules, by name; `scheme` colours by element
+MOLECULE_STYLES = {
+    'ball_and_stick': "{stick: {radius: 0.15, colorscheme: scheme}, sphere: {scale: 0.35, colorscheme: scheme}}",
+    'stick': "{stick: {radius: 0.2, colorscheme: scheme}}",
+    'spacefill': "{sphere: {scale: 1.0, colorscheme: scheme}}",
+}
+
+
+def _b64(array):
+    return base64.b64encode(np.ascontiguousarray(array).tobytes()).decode('ascii')
+
+
+_warned_cdn = False
+
+
+def cdn_allowed():
+    """Whether 3Dmol.js may come from the CDN: CHEMVIZ_VIEWER_CDN, off by default when offline"""
+    default = '0' if os.getenv('CHEMVIZ_OFFLINE') == '1' else '1'
+    return os.getenv('CHEMVIZ_VIEWER_CDN', default) == '1'
+
+
+def library_url():
+    """Local copy of 3Dmol.js if one has been fetched, else the CDN if allowed, else None"""
+    global _warned_cdn
+    if os.path.exists(os.path.join(STATIC_DIR, LIBRARY_NAME)):
+        return f"{STATIC_URL}/{LIBRARY_NAME}"
+    if not cdn_allowed():
+        return None
+    if not _warned_cdn:
+        _warned_cdn = True
+        logger.warning("No local 3Dmol.js in %s; viewers load it from %s. Run 'python viewer.py fetch' "
+                       "to bundle it, or set CHEMVIZ_VIEWER_CDN=0 to never use the CDN", STATIC_DIR, CDN_URL)
+    return CDN_URL
+
+
+# Shown in place of the viewer when 3Dmol.js did not load
+_MISSING_LIBRARY = ('<p style="padding: 2rem; font: 14px sans-serif; color: white;">3Dmol.js could not be loaded. '
+                    'Run <code>python viewer.py fetch</code> to bundle it with the app.</p>')
+
+
+def molecule_payload(mol, atom_colors, highlight=None):
+    """Compact JSON-ready description of a molecule's first conformer
+
+    ``e`` lists the element symbols present, ``a`` indexes them per atom,
+    ``x`` holds little-endian float32 coordinates, ``b`` uint32 bond atom
+    pairs, ``o`` uint8 bond orders, ``c`` the colour of each element and
+    ``h`` the indices of highlighted atoms, if any.
+    """
+    mol = Chem.Mol(mol)
+    Chem.Kekulize(mol, clearAromaticFlags=True)
+    symbols = [atom.GetSymbol() for atom in mol.GetAtoms()]
+    elements = sorted(set(symbols))
+    lookup = {symbol: i for i, symbol in enumerate(elements)}
+    bonds = mol.GetBonds()
+    payload = {
+        'e': elements,
+        'a': _b64(np.array([lookup[s] for s in symbols], dtype=np.uint8)),
+        'x': _b64(mol.GetConformer().GetPositions().astype('<f4')),
+        'b': _b64(np.array([(b.GetBeginAtomIdx(), b.GetEndAtomIdx()) for b in bonds], dtype='<u4').reshape(-1)),
+        'o': _b64(np.array([int(b.GetBondTypeAsDouble()) for b in bonds], dtype=np.uint8)),
+        'c': {e: atom_colors.get(e, atom_colors.get('default', DEFAULT_COLOR)) for e in elements},
+    }
+    if highlight:
+        payload['h'] = [int(i) for i in highlight]
+    return payload
+
+
+# Decodes the payload into 3Dmol atoms: P.e element symbols, P.a element index
+# per atom, P.x float32 coordinates, P.b uint32 bond pairs, P.o bond orders
+_DECODE_JS = """
+const bytes = s => Uint8Array.from(atob(s), c => c.charCodeAt(0)).buffer;
+const xyz = new Float32Array(bytes(P.x)), el = new Uint8Array(bytes(P.a));
+const pairs = new Uint32Array(bytes(P.b)), orders = new Uint8Array(bytes(P.o));
+const atoms = Array.from(el, (e, i) => ({index: i, serial: i, elem: P.e[e],
+  x: xyz[3 * i], y: xyz[3 * i + 1], z: xyz[3 * i + 2], bonds: [], bondOrder: []}));
+for (let k = 0; k < orders.length; k++) {
+  const i = pairs[2 * k], j = pairs[2 * k + 1];
+  atoms[i].bonds.push(j); atoms[i].bondOrder.push(orders[k]);
+  atoms[j].bonds.push(i); atoms[j].bondOrder.push(orders[k]);
+}
+"""
+
+
+def _document(payload, script, width, height, spin, controls=''):
+    # Viewer page around a payload and a script that styles `viewer`
+    url = library_url()
+    html = f"""<!DOCTYPE html>
+<html>
+<head>
+{f'<script src="{url}"></script>' if url else ''}
+<style>
+#container {{ width: {width}px; height: {height}px; margin: 0 auto; position: relative;
+  border: 1px solid #ddd; border-radius: 10px; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); }}
+#stats {{ position: absolute; right: 10px; bottom: 8px; z-index: 10; font: 11px monospace; color: #888; }}
+#controls {{ position: absolute; left: 10px; top: 8px; z-index: 10; font: 12px monospace; color: #555; }}
+</style>
+</head>
+<body>
+<div id="container">{controls}<div id="stats"></div></div>
+<script>
+if (typeof $3Dmol === 'undefined') {{
+  document.getElementById('container').innerHTML = {json.dumps(_MISSING_LIBRARY)};
+}} else {{
+const P = {json.dumps(payload, separators=(',', ':'))};
+{_DECODE_JS}
+const viewer = $3Dmol.createViewer(document.getElementById('container'), {{backgroundColor: 'white'}});
+{script}
+viewer.zoomTo();
+viewer.render();
+requestAnimationFrame(() => {{
+  const ttff = performance.now();
+  const kb = (__PAYLOAD_BYTES__ / 1024).toFixed(1);
+  document.getElementById('stats').textContent = `${{atoms.length}} atoms · ${{kb}} kB · first frame ${{ttff.toFixed(0)}} ms`;
+  console.log('chemviz viewer', {{atoms: atoms.length, payload_kb: kb, ttff_ms: ttff}});
+  {'viewer.spin(true);' if spin else ''}
+}});
+}}
+</script>
+</body>
+</html>
+"""
+    # The reported size is that of the whole document, library excluded
+    size = len(html.encode('utf-8'))
+    size = len(html.replace('__PAYLOAD_BYTES__', str(size)).encode('utf-8'))
+    logger.debug("Viewer document: %d bytes", size)
+    return html.replace('__PAYLOAD_BYTES__', str(size))
+
+
+def viewer_html(mol, atom_colors, width=800, height=600, spin=True, highlight=None, style='ball_and_stick'):
+    """Self-contained viewer document for a molecule with 3D coordinates
+
+    ``highlight`` atom indices, e.g. a substructure match, are drawn thicker
+    and in a highlight colour. ``style`` is a key of ``MOLECULE_STYLES``.
+    """
+    script = """viewer.addModel().addAtoms(atoms);
+const scheme = {prop: 'elem', map: P.c};
+viewer.setStyle({}, """ + MOLECULE_STYLES[style] + """);
+if (P.h) viewer.setStyle({index: P.h}, {stick: {radius: 0.25, color: '""" + HIGHLIGHT_COLOR + """'}, sphere: {scale: 0.4, color: '""" + HIGHLIGHT_COLOR + """'}});"""
+    return _document(molecule_payload(mol, atom_colors, highlight), script, width, height, spin)
+
+
+def structure_payload(structure, view):
+    """Compact payload for the atoms picked by ``structures.level_of_detail``
+
+    On top of the molecule fields, ``n``/``ni`` hold atom names and their
+    index per atom, ``c``/``ci`` chain ids, ``m``/``mi`` residue names,
+    ``ri`` residue numbers (int32), ``ss`` secondary structure codes, ``h``
+    hetero flags and ``s`` the atoms drawn as sticks.
+    """
+    index = view['index']
+
+    def table(values):
+        labels, positions = np.unique(values[index], return_inverse=True)
+        return [label.decode() for label in labels], _b64(positions.astype('<u2'))
+
+    elements, element_index = np.unique(structure.elements[index], return_inverse=True)
+    bonds = view['bonds']
+    names, name_index = table(structure.names)
+    chains, chain_index = table(structure.chains)
+    resnames, resname_index = table(structure.resnames)
+    return {
+        'e': [e.decode().capitalize() for e in elements],
+        'a': _b64(element_index.astype(np.uint8)),
+        'x': _b64(structure.coords[index].astype('<f4')),
+        'b': _b64(np.asarray(bonds, dtype='<u4').reshape(-1)),
+        'o': _b64(np.ones(len(bonds), dtype=np.uint8)),
+        'n': names, 'ni': name_index,
+        'c': chains, 'ci': chain_index,
+        'm': resnames, 'mi': resname_index,
+        'ri': _b64(structure.resseq[index].astype('<i4')),
+        'ss': structure.secondary_structure()[index].tobytes().decode('ascii'),
+        'h': _b64(structure.hetero[index].astype(np.uint8)),
+        's': _b64(view['sticks'].astype(np.uint8)),
+    }
+
+
+# One style pass per representation; `sticks` marks full-detail atoms
+_STRUCTURE_STYLES = {
+    'full': "viewer.setStyle({}, {cartoon: {color: 'spectrum'}, stick: {radius: 0.15, colorscheme: 'Jmol'}});",
+    'cartoon': "viewer.setStyle({sticks: false}, {cartoon: {color: 'spectrum'}});\n"
+               "viewer.setStyle({sticks: true}, {stick: {radius: 0.2, colorscheme: 'Jmol'}});",
+    'trace': "viewer.setStyle({sticks: false}, {stick: {radius: 0.5, colorscheme: 'chain'}});\n"
+             "viewer.setStyle({sticks: true}, {stick: {radius: 0.2, colorscheme: 'Jmol'}});",
+}
+
+
+def structure_html(structure, view, width=900, height=600):
+    """Viewer document for a PDB/mmCIF structure at the chosen level of detail"""
+    script = """const names = new Uint16Array(bytes(P.ni)), chains = new Uint16Array(bytes(P.ci));
+const resnames = new Uint16Array(bytes(P.mi)), resi = new Int32Array(bytes(P.ri));
+const hetero = new Uint8Array(bytes(P.h)), sticks = new Uint8Array(bytes(P.s));
+atoms.forEach((atom, i) => Object.assign(atom, {atom: P.n[names[i]], chain: P.c[chains[i]],
+  resi: resi[i], resn: P.m[resnames[i]], ss: P.ss[i], hetflag: !!hetero[i], sticks: !!sticks[i]}));
+viewer.addModel().addAtoms(atoms);
+""" + _STRUCTURE_STYLES[view['level']]
+    return _document(structure_payload(structure, view), script, width, height, spin=False)
+
+
+def _frame_deltas(frames):
+    # Quantize each frame as int16 steps from the previous *reconstructed*
+    # frame, so rounding errors never accumulate over the trajectory
+    steps = np.abs(np.diff(frames, axis=0)).max() if len(frames) > 1 else 0.0
+    scale = max(0.001, float(steps) * 1.01 / 32767)
+    previous = frames[0].astype(np.float32)
+    deltas = np.empty(frames[1:].shape, dtype='<i2')
+    for k, frame in enumerate(frames[1:]):
+        delta = np.clip(np.rint((frame - previous) / scale), -32767, 32767)
+        deltas[k] = delta
+        # Mirrors the browser: float64 arithmetic stored into a Float32Array
+        previous = (previous.astype(np.float64) + delta * scale).astype(np.float32)
+    return deltas, scale
+
+
+def trajectory_payload(trajectory, atom_colors, interval=100):
+    """Compact payload for a ``trajectories.Trajectory``
+
+    The molecule fields describe the topology and first frame; ``d`` holds
+    the remaining frames as zlib-compressed int16 deltas in units of ``q``
+    Angstrom, ``f`` is the frame count, ``l`` the frame labels and ``ms`` the
+    playback interval.
+    """
+    elements = sorted(set(trajectory.elements))
+    lookup = {symbol: i for i, symbol in enumerate(elements)}
+    deltas, scale = _frame_deltas(trajectory.frames)
+    return {
+        'e': elements,
+        'a': _b64(np.array([lookup[s] for s in trajectory.elements], dtype=np.uint8)),
+        'x': _b64(trajectory.frames[0].astype('<f4')),
+        'b': _b64(trajectory.bonds.astype('<u4').reshape(-1)),
+        'o': _b64(trajectory.orders.astype(np.uint8)),
+        'c': {e: atom_colors.get(e, atom_colors.get('default', DEFAULT_COLOR)) for e in elements},
+        'd': base64.b64encode(zlib.compress(deltas.tobytes(), 6)).decode('ascii'),
+        'q': scale,
+        'f': len(trajectory),
+        'l': trajectory.labels,
+        'ms': interval,
+    }
+
+
+_TRAJECTORY_CONTROLS = '<div id="controls"><button id="play" disabled>&#9654;</button> <span id="frame"></span></div>'
+
+
+def trajectory_html(trajectory, atom_colors, width=800, height=600, interval=100):
+    """Viewer document that plays a trajectory's frames in a loop"""
+    script = """const scheme = {prop: 'elem', map: P.c};
+const style = () => viewer.setStyle({}, {stick: {radius: 0.15, colorscheme: scheme}, sphere: {scale: 0.3, colorscheme: scheme}});
+const frames = [xyz], label = document.getElementById('frame'), play = document.getElementById('play');
+let current = 0, timer = null;
+const caption = k => `frame ${k + 1}/${P.f}` + (P.l[k] ? ` · ${P.l[k]}` : '');
+const show = k => {
+  const f = frames[k];
+  viewer.removeAllModels();
+  viewer.addModel().addAtoms(atoms.map((atom, i) => ({...atom, x: f[3 * i], y: f[3 * i + 1], z: f[3 * i + 2],
+    bonds: atom.bonds.slice(), bondOrder: atom.bondOrder.slice()})));
+  style();
+  viewer.render();
+  label.textContent = caption(k);
+  current = k;
+};
+viewer.addModel().addAtoms(atoms.map(atom => ({...atom, bonds: atom.bonds.slice(), bondOrder: atom.bondOrder.slice()})));
+style();
+label.textContent = caption(0);
+const toggle = () => {
+  if (timer) { clearInterval(timer); timer = null; play.innerHTML = '&#9654;'; return; }
+  timer = setInterval(() => show((current + 1) % frames.length), P.ms);
+  play.innerHTML = '&#10074;&#10074;';
+};
+if (P.f > 1) (async () => {
+  const stream = new Blob([bytes(P.d)]).stream().pipeThrough(new DecompressionStream('deflate'));
+  const deltas = new Int16Array(await new Response(stream).arrayBuffer());
+  const size = xyz.length;
+  for (let k = 1; k < P.f; k++) {
+    const prev = frames[k - 1], next = new Float32Array(size);
+    for (let i = 0, o = (k - 1) * size; i < size; i++) next[i] = prev[i] + deltas[o + i] * P.q;
+    frames.push(next);
+  }
+  play.onclick = toggle;
+  play.disabled = false;
+  toggle();
+})();"""
+    payload = trajectory_payload(trajectory, atom_colors, interval)
+    return _document(payload, script, width, height, spin=False, controls=_TRAJECTORY_CONTROLS)
+
+
+# Carbon colours that tell overlaid molecules apart; the reference keeps its own
+OVERLAY_PALETTE = ['#E6194B', '#3CB44B', '#4363D8', '#F58231', '#911EB4', '#42D4F4',
+                   '#F032E6', '#9A6324', '#469990', '#800000', '#808000', '#000075']
+# Gap between grid cells, in Angstrom
+GRID_MARGIN = 2.0
+
+
+def comparison_payload(molecules, labels, atom_colors, layout='grid', hydrogens=True):
+    """Compact payload that puts many molecules into one viewer model
+
+    The molecule fields hold every molecule's atoms back to back, with bonds
+    indexed across the whole set. ``k`` (uint16) gives the molecule of each
+    atom, ``c`` is a colour table and ``ci`` (uint16) each atom's entry in it,
+    and ``l`` holds the labels. For the grid layout every molecule is
+    centred in its own cell and ``p`` holds float32 label positions; for the
+    overlay, coordinates are kept as they are and the carbons of every
+    molecule but the first take a colour from ``OVERLAY_PALETTE``.
+    """
+    colors, color_index = [], {}
+
+    def color(value):
+        if value not in color_index:
+            color_index[value] = len(colors)
+            colors.append(value)
+        return color_index[value]
+
+    prepared = []
+    for mol in molecules:
+        mol = Chem.Mol(mol) if hydrogens else Chem.RemoveHs(mol)
+        Chem.Kekulize(mol, clearAromaticFlags=True)
+        positions = mol.GetConformer().GetPositions()
+        prepared.append((mol, positions - positions.mean(axis=0) if layout == 'grid' else positions))
+
+    if layout == 'grid':
+        columns = max(1, int(np.ceil(np.sqrt(len(prepared)))))
+        radius = max(float(np.linalg.norm(positions, axis=1).max()) for _, positions in prepared)
+        cell = 2 * radius + GRID_MARGIN
+        cells = np.array([(k % columns * cell, -(k // columns) * cell, 0.0) for k in range(len(prepared))])
+        label_positions = cells - (0.0, radius + GRID_MARGIN / 4, 0.0)
+
+    symbols, coords, molecule, tints, pairs, orders = [], [], [], [], [], []
+    offset = 0
+    for k, (mol, positions) in enumerate(prepared):
+        if layout == 'grid':
+            positions = positions + cells[k]
+        for atom in mol.GetAtoms():
+            symbol = atom.GetSymbol()
+            symbols.append(symbol)
+            value = atom_colors.get(symbol, atom_colors.get('default', DEFAULT_COLOR))
+            if layout == 'overlay' and k and symbol == 'C':
+                value = OVERLAY_PALETTE[(k - 1) % len(OVERLAY_PALETTE)]
+            tints.append(color(value))
+        coords.append(positions)
+        molecule.extend([k] * mol.GetNumAtoms())
+        for bond in mol.GetBonds():
+            pairs.append((bond.GetBeginAtomIdx() + offset, bond.GetEndAtomIdx() + offset))
+            orders.append(int(bond.GetBondTypeAsDouble()))
+        offset += mol.GetNumAtoms()
+
+    elements = sorted(set(symbols))
+    lookup = {symbol: i for i, symbol in enumerate(elements)}
+    payload = {
+        'e': elements,
+        'a': _b64(np.array([lookup[s] for s in symbols], dtype=np.uint8)),
+        'x': _b64(np.concatenate(coords).astype('<f4')),
+        'b': _b64(np.array(pairs, dtype='<u4').reshape(-1)),
+        'o': _b64(np.array(orders, dtype=np.uint8)),
+        'k': _b64(np.array(molecule, dtype='<u2')),
+        'c': colors,
+        'ci': _b64(np.array(tints, dtype='<u2')),
+        'l': [str(label) for label in labels],
+    }
+    if layout == 'grid':
+        payload['p'] = _b64(label_positions.astype('<f4'))
+    return payload
+
+
+def _legend(labels, atom_colors):
+    # Overlay key: the reference's carbon colour, then each molecule's
+    rows = []
+    for k, label in enumerate(labels):
+        swatch = atom_colors.get('C', DEFAULT_COLOR) if k == 0 else OVERLAY_PALETTE[(k - 1) % len(OVERLAY_PALETTE)]
+        rows.append(f'<div><span style="color: {swatch};">&#9679;</span> {escape(str(label))}</div>')
+    return ('<div id="controls" style="max-height: 45%; overflow-y: auto; padding: 4px 6px; '
+            'background: rgba(255,255,255,0.8); border-radius: 6px;">' + ''.join(rows) + '</div>')
+
+
+def comparison_html(molecules, labels, atom_colors, layout='grid', width=900, height=600, style='stick',
+                    spin=False, hydrogens=True):
+    """One viewer document for many molecules, on a grid or overlaid
+
+    All molecules go into a single model styled in one pass, so the browser
+    keeps one WebGL context and one set of buffers however many there are.
+    Overlays expect coordinates already aligned, e.g. by
+    ``comparison.align_molecules``.
+    """
+    script = """const owner = new Uint16Array(bytes(P.k)), tint = new Uint16Array(bytes(P.ci));
+atoms.forEach((atom, i) => { atom.molecule = owner[i]; atom.tint = tint[i]; });
+viewer.addModel().addAtoms(atoms);
+const scheme = {prop: 'tint', map: P.c};
+viewer.setStyle({}, """ + MOLECULE_STYLES[style] + """);
+if (P.p) {
+  const at = new Float32Array(bytes(P.p));
+  P.l.forEach((text, k) => viewer.addLabel(text, {position: {x: at[3 * k], y: at[3 * k + 1], z: at[3 * k + 2]},
+    alignment: 'topCenter', fontSize: 11, fontColor: 'black', backgroundColor: 'white', backgroundOpacity: 0.7}));
+}"""
+    payload = comparison_payload(molecules, labels, atom_colors, layout, hydrogens)
+    controls = _legend(labels, atom_colors) if layout == 'overlay' else ''
+    return _document(payload, script, width, height, spin, controls=controls)
+
+
+def fetch_library(url=CDN_URL, directory=STATIC_DIR):
+    """Download 3Dmol.js into ``static/`` so the viewer works offline"""
+    import requests
+
+    response = requests.get(url, timeout=60)
+    response.raise_for_status()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, LIBRARY_NAME)
+    with open(path, 'wb') as handle:
+        handle.write(response.content)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the bundled 3Dmol.js viewer library")
+    commands = parser.add_subparsers(dest='command', required=True)
+    fetch = commands.add_parser('fetch', help="Download 3Dmol-min.js into static/")
+    fetch.add_argument('--url', default=CDN_URL)
+    args = parser.parse_args(argv)
+
+    path = fetch_library(args.url)
+    sys.stderr.write(f"Saved {os.path.getsize(path)} bytes to {path}\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())